@@ -0,0 +1,107 @@
+#####################################################################
+#                                                                   #
+# /benchmarks/front_panel_encoding.py                               #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Compare the file size and write time of the front panel tables saved to shot files
+in the legacy layout (fixed 256 character strings, uncompressed) and the current
+compact layout, for a front panel of 1000 channels.
+
+Usage: python benchmarks/front_panel_encoding.py [n_channels]"""
+import os
+import sys
+import time
+import tempfile
+
+import labscript_utils.h5_lock, h5py
+
+from blacs.front_panel_settings import (
+    build_front_panel_tables,
+    write_front_panel_tables,
+    read_front_panel_tables,
+)
+
+N_REPEATS = 20
+
+
+def make_front_panel(n_channels, channels_per_device=32):
+    """Return arguments for build_front_panel_tables() resembling an apparatus with
+    n_channels analog outputs"""
+    tab_data = {}
+    notebook_data = {}
+    for i in range(n_channels):
+        device_name = 'device_%d' % (i // channels_per_device)
+        if device_name not in tab_data:
+            tab_data[device_name] = {'front_panel': {}, 'save_data': {'setting': 1}}
+            notebook_data[device_name] = {
+                'notebook': '1',
+                'page': len(notebook_data),
+                'visible': False,
+            }
+        channel = 'ao%d' % (i % channels_per_device)
+        tab_data[device_name]['front_panel'][channel] = {
+            'name': 'output_%d' % i,
+            'base_value': 0.1 * i,
+            'locked': False,
+            'base_step_size': 0.1,
+            'current_units': 'V',
+        }
+    main_window = {
+        'width': 1000,
+        'height': 800,
+        'xpos': 0,
+        'ypos': 0,
+        'maximized': False,
+        'frame_height': 20,
+        'frame_width': 5,
+        '_analysis': {},
+        '_queue': {},
+    }
+    return tab_data, notebook_data, {'_main_window': main_window}, {}
+
+
+def write_legacy(data_group, front_panel_array, tab_array, attrs):
+    # The layout written prior to format version 2:
+    data_group.create_dataset('front_panel', data=front_panel_array)
+    dataset = data_group.create_dataset('_notebook_data', data=tab_array)
+    for name, value in attrs.items():
+        dataset.attrs[name] = value
+
+
+def benchmark(write, tables, directory):
+    path = os.path.join(directory, write.__name__ + '.h5')
+    times = []
+    for _ in range(N_REPEATS):
+        with h5py.File(path, 'w') as f:
+            start_time = time.perf_counter()
+            write(f.create_group('front_panel'), *tables)
+            f.flush()
+            times.append(time.perf_counter() - start_time)
+    with h5py.File(path, 'r') as f:
+        front_panel_array, _, _ = read_front_panel_tables(f['front_panel'])
+        assert (front_panel_array == tables[0]).all()
+    return os.path.getsize(path), min(times)
+
+
+def main():
+    n_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    tables = build_front_panel_tables(*make_front_panel(n_channels), save_queue_data=False)
+    with tempfile.TemporaryDirectory() as directory:
+        print('%d channels:' % n_channels)
+        for write in [write_legacy, write_front_panel_tables]:
+            size, write_time = benchmark(write, tables, directory)
+            print(
+                '  %-25s %8.1f kB  %7.2f ms'
+                % (write.__name__, size / 1e3, write_time * 1e3)
+            )
+
+
+if __name__ == '__main__':
+    main()
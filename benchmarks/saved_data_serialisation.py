@@ -0,0 +1,68 @@
+#####################################################################
+#                                                                   #
+# /benchmarks/saved_data_serialisation.py                           #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Compare the time taken to save and restore the queue data of a queue of 50,000
+shots with repr()/eval(), as used by previous versions of BLACS, and with
+blacs.saved_data.
+
+Usage: python benchmarks/saved_data_serialisation.py [n_shots]"""
+import sys
+import time
+
+from blacs import saved_data
+
+N_REPEATS = 5
+
+
+def make_queue_data(n_shots):
+    """Return queue save data resembling that of a queue of n_shots shot files"""
+    files_queued = [
+        '/data/experiments/2013/05/20/0042/20130520T101010_sequence_%05d.h5' % i
+        for i in range(n_shots)
+    ]
+    return {
+        'manager_paused': False,
+        'manager_repeat': False,
+        'manager_repeat_mode': 0,
+        'files_queued': files_queued,
+        'last_opened_shots_folder': '/data/experiments/2013/05/20',
+    }
+
+
+def best_time(function, *args):
+    times = []
+    for _ in range(N_REPEATS):
+        start_time = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start_time)
+    return result, min(times)
+
+
+def main():
+    n_shots = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    queue_data = make_queue_data(n_shots)
+    print('%d queued shots:' % n_shots)
+    for name, dumps, loads in [
+        ('repr/eval', repr, eval),
+        ('saved_data', saved_data.dumps, saved_data.loads),
+    ]:
+        s, save_time = best_time(dumps, queue_data)
+        restored, restore_time = best_time(loads, s)
+        assert restored == queue_data
+        print(
+            '  %-12s save %8.2f ms  restore %8.2f ms  %8.1f kB'
+            % (name, save_time * 1e3, restore_time * 1e3, len(s) / 1e3)
+        )
+
+
+if __name__ == '__main__':
+    main()
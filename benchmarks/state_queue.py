@@ -0,0 +1,164 @@
+#####################################################################
+#                                                                   #
+# /benchmarks/state_queue.py                                        #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Compare the time taken to put and get thousands of states in a tab's state queue,
+with a list scanned from the start for each get, as previously, and with
+blacs.state_queue.StateQueue. The previous implementation is timed with a lock around
+each put and get, like StateQueue, rather than the hop through the Qt main thread that
+each of them made, which took far longer. Both are first checked to return the same
+states for a random sequence of puts and gets.
+
+Usage: python benchmarks/state_queue.py [n_states]"""
+import sys
+import time
+import random
+import threading
+from bisect import insort
+from itertools import count
+
+from blacs.state_queue import StateQueue
+
+N_REPEATS = 3
+
+MODE_MANUAL = 1
+MODE_TRANSITION_TO_BUFFERED = 2
+MODE_TRANSITION_TO_MANUAL = 4
+MODE_BUFFERED = 8
+ALL_MODES = MODE_MANUAL | MODE_TRANSITION_TO_BUFFERED | MODE_TRANSITION_TO_MANUAL | MODE_BUFFERED
+
+
+class ListStateQueue(object):
+    # The previous StateQueue, with a lock instead of the inmain decorators, and
+    # without blocking:
+    def __init__(self):
+        self.list_of_states = []
+        self._ids = count(1)
+        self._lock = threading.Lock()
+
+    def put(self, allowed_states, queue_state_indefinitely, delete_stale_states, data, priority=0):
+        with self._lock:
+            state_data = [priority, next(self._ids), allowed_states, queue_state_indefinitely, delete_stale_states, data]
+            insort(self.list_of_states, state_data)
+
+    def check_for_next_item(self, state):
+        delete_index_list = []
+        success = False
+        for i, item in enumerate(self.list_of_states):
+            priority, unique_id, allowed_states, queue_state_indefinitely, delete_stale_states, data = item
+            if allowed_states & state:
+                delete_index_list.append(i)
+                if delete_stale_states:
+                    state_function = data[0]
+                    i += 1
+                    while i < len(self.list_of_states) and state_function == self.list_of_states[i][5][0]:
+                        priority, unique_id, allowed_states, queue_state_indefinitely, delete_stale_states, data = self.list_of_states[i]
+                        delete_index_list.append(i)
+                        i += 1
+                success = True
+                break
+            elif not queue_state_indefinitely:
+                delete_index_list.append(i)
+        for index in reversed(sorted(delete_index_list)):
+            del self.list_of_states[index]
+        return data if success else None
+
+
+def get(queue, mode):
+    # The next state allowed in the given mode, or None, without blocking:
+    with queue._lock:
+        return queue.check_for_next_item(mode)
+
+
+def random_operations(n_states, seed=0):
+    rng = random.Random(seed)
+    operations = []
+    for i in range(n_states):
+        allowed_states = rng.choice([MODE_MANUAL, MODE_MANUAL | MODE_BUFFERED, ALL_MODES, MODE_BUFFERED])
+        function = rng.choice(['program_device', 'check_remote_values', 'update_status'])
+        operations.append(
+            (
+                'put',
+                allowed_states,
+                rng.random() < 0.7,
+                rng.random() < 0.3,
+                [function, [(i,), {}]],
+                rng.choice([0, 0, 0, 0, -1, 1]),
+            )
+        )
+        if rng.random() < 0.4:
+            operations.append(('get', rng.choice([MODE_MANUAL, MODE_BUFFERED, MODE_TRANSITION_TO_BUFFERED])))
+    return operations
+
+
+def check_equivalent(n_states):
+    queues = [ListStateQueue(), StateQueue('benchmark')]
+    for operation in random_operations(n_states):
+        if operation[0] == 'put':
+            for queue in queues:
+                queue.put(*operation[1:])
+        else:
+            results = [get(queue, operation[1]) for queue in queues]
+            assert results[0] == results[1], results
+    for mode in [MODE_MANUAL, MODE_BUFFERED, MODE_TRANSITION_TO_MANUAL, MODE_TRANSITION_TO_BUFFERED] * n_states:
+        results = [get(queue, mode) for queue in queues]
+        assert results[0] == results[1], results
+
+
+def backlog(queue, n_states):
+    # States for the manual mode, such as front panel changes, queued up during a run of
+    # buffered shots, whilst the buffered mode states of each shot are put and got:
+    for i in range(n_states):
+        queue.put(MODE_MANUAL, True, True, ['program_device', [(i,), {}]])
+    for i in range(n_states):
+        queue.put(MODE_BUFFERED, False, False, ['update_status', [(i,), {}]])
+        get(queue, MODE_BUFFERED)
+    for i in range(n_states):
+        queue.put(MODE_MANUAL, True, False, ['check_remote_values', [(i,), {}]])
+    while get(queue, MODE_MANUAL) is not None:
+        pass
+
+
+def mixed(queue, operations):
+    for operation in operations:
+        if operation[0] == 'put':
+            queue.put(*operation[1:])
+        else:
+            get(queue, operation[1])
+
+
+def best_time(workload, queue_class, arg):
+    times = []
+    for _ in range(N_REPEATS):
+        queue = queue_class()
+        start_time = time.perf_counter()
+        workload(queue, arg)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def main():
+    n_states = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    check_equivalent(2000)
+    print('%d states per tab:' % n_states)
+    # The random operations of the mixed workload are generated outside of the timing:
+    workloads = [(backlog, n_states), (mixed, random_operations(n_states, seed=1))]
+    for workload, arg in workloads:
+        list_time = best_time(workload, ListStateQueue, arg)
+        heap_time = best_time(workload, lambda: StateQueue('benchmark'), arg)
+        print(
+            '  %-8s list: %8.1f ms  indexed: %8.1f ms  (%.1fx)'
+            % (workload.__name__, list_time * 1e3, heap_time * 1e3, list_time / heap_time)
+        )
+
+
+if __name__ == '__main__':
+    main()
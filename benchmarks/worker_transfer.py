@@ -0,0 +1,74 @@
+#####################################################################
+#                                                                   #
+# /benchmarks/worker_transfer.py                                    #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Compare the throughput of sending a 100 MB numpy array to a worker process and
+back, pickled in-band as previously, and through shared memory with
+blacs.worker_channel. The array is sent through a multiprocessing pipe standing in for
+the worker's queues.
+
+Usage: python benchmarks/worker_transfer.py [megabytes]"""
+import sys
+import time
+import multiprocessing
+
+import numpy
+
+from blacs.worker_channel import WorkerChannel
+
+N_REPEATS = 5
+
+
+def worker(connection, shared):
+    # Echo each message back, as a worker returning acquired data would:
+    channel = WorkerChannel(shared_memory=shared)
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        data = channel.unpack(message)
+        connection.send(channel.pack(data))
+
+
+def benchmark(shared, data):
+    connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=worker, args=(child_connection, shared))
+    process.start()
+    channel = WorkerChannel(shared_memory=shared)
+    times = []
+    try:
+        for _ in range(N_REPEATS):
+            start_time = time.perf_counter()
+            connection.send(channel.pack(data))
+            result = channel.unpack(connection.recv())
+            times.append(time.perf_counter() - start_time)
+            assert result.shape == data.shape and result[-1] == data[-1]
+            del result
+    finally:
+        connection.send(None)
+        process.join()
+    return min(times)
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    data = numpy.random.random(megabytes * 1000000 // 8)
+    print('%d MB array, to worker and back:' % megabytes)
+    for name, shared in [('pickled in-band', False), ('shared memory', True)]:
+        round_trip_time = benchmark(shared, data)
+        print(
+            '  %-16s %8.1f ms  %8.0f MB/s'
+            % (name, round_trip_time * 1e3, 2 * data.nbytes / 1e6 / round_trip_time)
+        )
+
+
+if __name__ == '__main__':
+    main()
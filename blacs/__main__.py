@@ -100,6 +100,10 @@ from blacs.experiment_queue import QueueManager, QueueTreeview
 from labscript_utils import device_registry
 # Save/restore frontpanel code
 from blacs.front_panel_settings import FrontPanelSettings
+from blacs import saved_data
+# Periodic saving of the front panel
+from blacs.autosave import Autosaver
+from blacs.worker_channel import transfer_stats
 # Notifications system
 from blacs.notifications import Notifications
 # Preferences system
@@ -282,7 +286,7 @@ class BLACS(object):
         # setup the plugin system
         settings_pages = []
         self.plugins = {}
-        plugin_settings = eval(tab_data['BLACS settings']['plugin_data']) if 'plugin_data' in tab_data['BLACS settings'] else {}
+        plugin_settings = saved_data.loads(tab_data['BLACS settings']['plugin_data']) if 'plugin_data' in tab_data['BLACS settings'] else {}
         for module_name, module in plugins.modules.items():
             try:
                 # instantiate the plugin
@@ -322,7 +326,7 @@ class BLACS(object):
         if 'analysis_data' not in tab_data['BLACS settings']:
             tab_data['BLACS settings']['analysis_data'] = {}
         else:
-            tab_data['BLACS settings']['analysis_data'] = eval(tab_data['BLACS settings']['analysis_data'])
+            tab_data['BLACS settings']['analysis_data'] = saved_data.loads(tab_data['BLACS settings']['analysis_data'])
         self.analysis_submission.restore_save_data(tab_data['BLACS settings']["analysis_data"])
 
         splash.update_text("starting queue manager")
@@ -334,7 +338,7 @@ class BLACS(object):
         else:
             # quick fix for qt objects not loading that were saved before qtutil 2 changes
             try:
-                tab_data['BLACS settings']['queue_data'] = eval(tab_data['BLACS settings']['queue_data'])
+                tab_data['BLACS settings']['queue_data'] = saved_data.loads(tab_data['BLACS settings']['queue_data'])
             except NameError:
                 tab_data['BLACS settings']['queue_data'] = {}
         self.queue.restore_save_data(tab_data['BLACS settings']['queue_data'])
@@ -442,6 +446,15 @@ class BLACS(object):
                     header.insertWidget(i, self.easter_egg_button)
                     break
 
+        # Save changes to the front panel, queue and analysis data periodically, so
+        # that they are not lost if BLACS crashes:
+        logger.info('starting autosave thread')
+        self.autosaver = Autosaver(
+            self,
+            self.exp_config.getfloat('BLACS/front_panel', 'autosave_interval', fallback=60),
+        )
+        self.autosaver.start()
+
         splash.update_text('done')
         logger.info('showing UI')
         self.ui.show()
@@ -567,7 +580,7 @@ class BLACS(object):
                         else:
                             # quick fix for qt objects not loading that were saved before qtutil 2 changes
                             try:
-                                tab_data['BLACS settings']['queue_data'] = eval(tab_data['BLACS settings']['queue_data'])
+                                tab_data['BLACS settings']['queue_data'] = saved_data.loads(tab_data['BLACS settings']['queue_data'])
                             except NameError:
                                 tab_data['BLACS settings']['queue_data'] = {}
                         self.queue.restore_save_data(tab_data['BLACS settings']['queue_data'])
@@ -575,7 +588,7 @@ class BLACS(object):
                         if 'analysis_data' not in tab_data['BLACS settings']:
                             tab_data['BLACS settings']['analysis_data'] = {}
                         else:
-                            tab_data['BLACS settings']['analysis_data'] = eval(tab_data['BLACS settings']['analysis_data'])
+                            tab_data['BLACS settings']['analysis_data'] = saved_data.loads(tab_data['BLACS settings']['analysis_data'])
                         self.analysis_submission.restore_save_data(tab_data['BLACS settings']["analysis_data"])
                 except Exception as e:
                     logger.exception("Unable to load the front panel in %s."%(filepath))
@@ -610,7 +623,11 @@ class BLACS(object):
            # if 'connection table' in h5file:
                # del h5file['connection table']
 
-        self.front_panel_settings.save_front_panel_to_h5(self.settings_path,data[0],data[1],data[2],data[3],{"overwrite":True},force_new_conn_table=True)
+        # Write whatever has changed since the last autosave:
+        self.autosaver.save(data[0],data[1],data[2],data[3])
+        if self.queue.journal is not None:
+            self.queue.journal.close()
+        logger.info('Data sent to and from workers:\n' + transfer_stats.summary())
         logger.info('Shutting down workers')
         for tab in self.tablist.values():
             # Tell tab to shutdown its workers if it has a method to do so.
@@ -694,14 +711,26 @@ class BLACS(object):
 
 class ExperimentServer(ZMQServer):
     def handler(self, h5_filepath):
+        if isinstance(h5_filepath, (list, tuple)):
+            # A batch of files, validated off the main thread. Returns a list of
+            # messages, one per file:
+            messages = self.process_batch(h5_filepath)
+            logger.info('Request handler: batch of %d files' % len(messages))
+            return messages
         print(h5_filepath)
         message = self.process(h5_filepath)
         logger.info('Request handler: %s ' % message.strip())
         return message
 
-    @inmain_decorator(wait_for_return=True)
+    def process_batch(self, h5_filepaths):
+        logger.info('received batch of %d filepaths' % len(h5_filepaths))
+        # Convert paths to local slashes and shared drive prefix:
+        h5_filepaths = [labscript_utils.shared_drive.path_to_local(path) for path in h5_filepaths]
+        return app.queue.process_requests(h5_filepaths)
+
     def process(self,h5_filepath):
-        # Convert path to local slashes and shared drive prefix:
+        # Runs in the server thread, only adding the file to the queue is done in
+        # the main thread. Convert path to local slashes and shared drive prefix:
         logger.info('received filepath: %s'%h5_filepath)
         h5_filepath = labscript_utils.shared_drive.path_to_local(h5_filepath)
         logger.info('local filepath: %s'%h5_filepath)
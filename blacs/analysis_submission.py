@@ -29,6 +29,7 @@ from socket import gaierror
 import labscript_utils.shared_drive
 from labscript_utils.qtwidgets.elide_label import elide_label
 from blacs import BLACS_DIR
+from blacs.autosave import changes, ANALYSIS
 
 
 class AnalysisSubmission(object):        
@@ -90,6 +91,7 @@ class AnalysisSubmission(object):
     @inmain_decorator(True)
     def send_to_server(self, value):
         self._send_to_server = bool(value)
+        changes.mark(ANALYSIS)
         self._ui.send_to_server.setChecked(self.send_to_server)
         if self.send_to_server:
             self._ui.server.setEnabled(True)
@@ -109,6 +111,7 @@ class AnalysisSubmission(object):
     @inmain_decorator(True)
     def server(self,value):
         self._server = value
+        changes.mark(ANALYSIS)
         self._ui.server.setText(self.server)
 
     @property
@@ -167,6 +170,7 @@ class AnalysisSubmission(object):
     @inmain_decorator(True)
     def clear_waiting_files(self):
         self._waiting_for_submission = []
+        changes.mark(ANALYSIS)
         self.update_waiting_files_message()
 
     @inmain_decorator(True)
@@ -199,6 +203,7 @@ class AnalysisSubmission(object):
                 elif signal == 'file':
                     if self.send_to_server:
                         self._waiting_for_submission.append(data)
+                        changes.mark(ANALYSIS)
                         if self.server_online != 'online':
                             # Don't stack connectivity checks if many files are
                             # arriving. If we failed a connectivity check less
@@ -266,6 +271,7 @@ class AnalysisSubmission(object):
                     self.failure_reason = "unexpected reponse: %s" % str(response)
                 try:
                     self._waiting_for_submission.pop(0) 
+                    changes.mark(ANALYSIS)
                 except IndexError:
                     # Queue has been cleared
                     pass
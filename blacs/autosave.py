@@ -0,0 +1,119 @@
+#####################################################################
+#                                                                   #
+# /autosave.py                                                      #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+import logging
+import threading
+
+import labscript_utils.h5_lock, h5py
+
+from blacs.front_panel_settings import build_front_panel_tables
+
+logger = logging.getLogger('BLACS.autosave')
+
+# Parts of the saved state of BLACS whose changes are tracked:
+FRONT_PANEL = 'front_panel'
+QUEUE = 'queue'
+ANALYSIS = 'analysis'
+TABS = 'tabs'
+
+
+class ChangeTracker(object):
+    """A thread-safe record of which parts of the saved state of BLACS have changed
+    since it was last saved"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = set()
+
+    def mark(self, part):
+        with self._lock:
+            self._changed.add(part)
+
+    def take(self):
+        """Return the set of parts that have changed, and forget them"""
+        with self._lock:
+            changed = self._changed
+            self._changed = set()
+        return changed
+
+    def restore(self, parts):
+        """Mark parts as changed again, for example because saving them failed"""
+        with self._lock:
+            self._changed.update(parts)
+
+
+# Changes are marked here by the output classes, tabs, queue manager and analysis
+# submission:
+changes = ChangeTracker()
+
+
+class Autosaver(object):
+    """Periodically saves the state of BLACS to its settings file from a thread, if
+    any of it has changed. Only the parts of the front panel group that differ from
+    those last written are rewritten, so that saving on exit is also quick.
+
+    The front panel values, tab layout and plugin, queue and analysis data are
+    gathered in the main thread, and written from the autosave thread."""
+    def __init__(self, blacs, interval):
+        self.blacs = blacs
+        self.interval = interval
+        # The tables last written to the settings file, or None if the front panel has
+        # not yet been written this session:
+        self._saved_tables = None
+        self._write_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0:
+            logger.info('autosave disabled')
+            return
+        self._thread = threading.Thread(target=self.mainloop, name='autosave')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop autosaving. Does not wait for the autosave thread, which may be waiting
+        on the main thread. An autosave in progress is discarded rather than
+        written."""
+        self._stopping.set()
+
+    def mainloop(self):
+        # HDF5 errors are silenced per thread, as in the queue manager:
+        h5py._errors.silence_errors()
+        while not self._stopping.wait(self.interval):
+            changed = changes.take()
+            if not changed:
+                continue
+            try:
+                tab_data, notebook_data, window_data, plugin_data = self.blacs.front_panel_settings.get_save_data()
+                # Keep the saved values of tabs that failed to start until the user
+                # decides whether to discard them on exit:
+                tab_data.update(self.blacs.failed_device_settings)
+                self.save(tab_data, notebook_data, window_data, plugin_data, final=False)
+            except Exception:
+                changes.restore(changed)
+                logger.exception('Autosave failed')
+            else:
+                logger.debug('Autosaved after changes to %s' % ', '.join(sorted(changed)))
+
+    def save(self, tab_data, notebook_data, window_data, plugin_data, final=True):
+        """Write the given state to the settings file, rewriting only what has changed
+        since it was last written. If final, the autosave thread is stopped first
+        and will not write again."""
+        if final:
+            self.stop()
+        tables = build_front_panel_tables(tab_data, notebook_data, window_data, plugin_data)
+        with self._write_lock:
+            if self._stopping.is_set() and not final:
+                return
+            self.blacs.front_panel_settings.update_settings_file(tables, self._saved_tables)
+            self._saved_tables = tables
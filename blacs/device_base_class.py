@@ -26,6 +26,7 @@ from qtutils import UiLoader
 from blacs import BLACS_DIR
 from blacs.tab_base_classes import Tab, Worker, define_state
 from blacs.tab_base_classes import MODE_MANUAL, MODE_TRANSITION_TO_BUFFERED, MODE_TRANSITION_TO_MANUAL, MODE_BUFFERED
+from blacs.autosave import changes, TABS, FRONT_PANEL
 from blacs.output_classes import AO, DO, DDS, Image
 from labscript_utils.qtwidgets.toolpalette import ToolPaletteGroup
 from labscript_utils.shared_drive import path_to_agnostic
@@ -49,6 +50,21 @@ class DeviceTab(Tab):
         self._secondary_workers = []
         self._can_check_remote_values = False
         self._changed_radio_buttons = {}
+        # Whether the workers report tokens identifying what their hardware holds,
+        # assumed until the primary worker returns None:
+        self._supports_programmed_state_tokens = True
+        # Whether any worker implements prepare_buffered(), assumed until they have
+        # all been asked:
+        self._supports_prepare_buffered = True
+        # Whether the primary and secondary workers may do the same job at the same
+        # time, rather than in turn:
+        self._parallel_workers = False
+        # Whether programming the device in manual mode leaves the instructions of the
+        # last shot in the hardware:
+        self._manual_programming_keeps_buffered = False
+        # The front panel values the last shot left the device with, set when it
+        # transitions to manual mode:
+        self._values_after_shot = None
         
         # Call the initialise GUI function
         self.initialise_GUI() 
@@ -86,6 +102,45 @@ class DeviceTab(Tab):
     
     def supports_remote_value_check(self,support):
         self._can_check_remote_values = bool(support)
+
+    def supports_parallel_workers(self,support):
+        """Call with True if the device's workers do not depend on the order in which
+        they program the device, transition to buffered or manual mode, abort, or
+        check remote values, so that they may do these at the same time"""
+        self._parallel_workers = bool(support)
+
+    def supports_keeping_buffered_during_manual(self,support):
+        """Call with True if programming the device in manual mode does not overwrite
+        the instructions the hardware holds for the last shot, so that the next shot may
+        still be considered unchanged afterwards"""
+        self._manual_programming_keeps_buffered = bool(support)
+
+    def _workers_support_protocol(self,version):
+        # Whether all the workers use at least the given version of the protocol between
+        # tabs and workers. Workers from older versions of BLACS, such as on remote
+        # computers, use version 1 and lack the worker methods added since:
+        workers = [self._primary_worker] + self._secondary_workers
+        return all(self.worker_protocol(worker) >= version for worker in workers)
+
+    def _queue_work_in_workers(self,worker_function,*args,worker_kwargs=None,stop=None):
+        # Have the primary and then each secondary worker do a job, or all at once if
+        # supported, and return a list of their results. In turn, stops after the
+        # results so far satisfy stop(), if given. worker_kwargs, if given, returns the
+        # keyword arguments to send to each worker. Called from within states with
+        # yield from:
+        workers = [self._primary_worker] + self._secondary_workers
+        def job(worker):
+            kwargs = worker_kwargs(worker) if worker_kwargs is not None else {}
+            return self.queue_work(worker,worker_function,*args,**kwargs)
+        if self._parallel_workers and len(workers) > 1:
+            results = yield([job(worker) for worker in workers])
+            return results
+        results = []
+        for worker in workers:
+            results.append((yield(job(worker))))
+            if stop is not None and stop(results):
+                break
+        return results
     
     ############################################################
     # What do the properties dictionaries need to look like?   #
@@ -395,14 +450,25 @@ class DeviceTab(Tab):
     @define_state(MODE_MANUAL,True,delete_stale_states=True)
     def program_device(self):
         self._last_programmed_values = self.get_front_panel_values()
+        if (
+            not self._manual_programming_keeps_buffered
+            and self._last_programmed_digest is not None
+            and self._last_programmed_values != self._values_after_shot
+        ):
+            # The hardware may no longer hold the last shot's instructions. This is not
+            # the case if the values are those the shot left the device with, such as
+            # when programming after a shot. Programming at startup, before any shot,
+            # keeps the state saved before a restart, as the workers' tokens show
+            # whether the hardware still holds it:
+            self.invalidate_programmed_state()
         
         # get rid of any "remote values changed" dialog
         self._changed_widget.hide()
         
-        results = yield(self.queue_work(self._primary_worker,'program_manual',self._last_programmed_values))
-        for worker in self._secondary_workers:
-            if results:
-                returned_results = yield(self.queue_work(worker,'program_manual',self._last_programmed_values))
+        all_results = yield from self._queue_work_in_workers('program_manual',self._last_programmed_values,stop=lambda results: not results[0])
+        results = all_results[0]
+        if results:
+            for returned_results in all_results[1:]:
                 results.update(returned_results)
         
         # If the worker process returns something, we assume it wants us to coerce the front panel values
@@ -424,10 +490,10 @@ class DeviceTab(Tab):
     
     @define_state(MODE_MANUAL,True)
     def check_remote_values(self):
-        self._last_remote_values = yield(self.queue_work(self._primary_worker,'check_remote_values'))
-        for worker in self._secondary_workers:
-            if self._last_remote_values:
-                returned_results = yield(self.queue_work(worker,'check_remote_values'))
+        all_results = yield from self._queue_work_in_workers('check_remote_values',stop=lambda results: not results[0])
+        self._last_remote_values = all_results[0]
+        if self._last_remote_values:
+            for returned_results in all_results[1:]:
                 self._last_remote_values.update(returned_results)
         
         # compare to current front panel values and prompt the user if they don't match
@@ -562,6 +628,9 @@ class DeviceTab(Tab):
             else:
                 # we only need to program the device if one or more channels is using the front panel value
                 needs_programming = True
+        # Values set without programming are not otherwise autosaved, but these were
+        # chosen by the user:
+        changes.mark(FRONT_PANEL)
                 
         if needs_programming:
             self.program_device()
@@ -576,33 +645,97 @@ class DeviceTab(Tab):
     def start_run(self,notify_queue):
         raise NotImplementedError('The device %s has not implemented a start method and so cannot be used to trigger the experiment to begin. Please implement the start method or use a different pseudoclock as the master pseudoclock'%self.device_name)
     
+    def prepare_buffered(self,h5_file,device_digest=None):
+        """Have the workers prepare the device's instructions for a shot further down
+        the queue, if they support it, in a separate thread whilst the shot in progress
+        runs"""
+        if not self._supports_prepare_buffered or not self._workers_support_protocol(2):
+            return
+        if device_digest is not None and device_digest == self._last_programmed_digest:
+            # The workers will be told the shot is unchanged, there is nothing to do:
+            return
+        self._prepare_buffered_in_workers(path_to_agnostic(h5_file))
+
+    def cancel_prepared_buffers(self,h5_files):
+        """Have the workers discard any instructions prepared for the given shots, or
+        not prepare them if they have not yet, as they are no longer coming up in the
+        queue"""
+        if not self._supports_prepare_buffered or not self._workers_support_protocol(2):
+            return
+        self._cancel_prepared_buffers_in_workers([path_to_agnostic(h5_file) for h5_file in h5_files])
+
+    # The workers only queue the shot to be prepared in a separate thread, so this is
+    # quick enough to be done whilst a shot is running. It is queued before the shot's
+    # transition to buffered, in which the workers wait for it if it is in progress:
+    @define_state(MODE_MANUAL|MODE_BUFFERED,True)
+    def _prepare_buffered_in_workers(self,h5_file):
+        # Each result is None if the worker raised an exception, in which case the shot
+        # is prepared in transition_to_buffered as usual:
+        results = yield from self._queue_work_in_workers('_prepare_buffered',h5_file)
+        if all(result is False for result in results):
+            self._supports_prepare_buffered = False
+
+    @define_state(MODE_MANUAL|MODE_BUFFERED,True)
+    def _cancel_prepared_buffers_in_workers(self,h5_files):
+        yield from self._queue_work_in_workers('_cancel_prepared_buffers',h5_files)
+
     @define_state(MODE_MANUAL,True)
-    def transition_to_buffered(self,h5_file,notify_queue): 
+    def transition_to_buffered(self,h5_file,notify_queue,device_digest=None,device_group=None): 
         # Get rid of any "remote values changed" dialog
         self._changed_widget.hide()
     
         self.mode = MODE_TRANSITION_TO_BUFFERED
         
         h5_file = path_to_agnostic(h5_file)
+        # If given, device_digest is the digest of this device's group in the shot
+        # file. Tell the workers if it is the same as in the last shot we programmed,
+        # so that they may skip reprogramming tables:
+        unchanged = device_digest is not None and device_digest == self._last_programmed_digest
+        if device_digest is not None and self._unconfirmed_programmed_state is not None:
+            # The first shot since a restart. If it is the same as the last shot
+            # programmed before the restart, and the workers confirm the hardware still
+            # holds it, it is unchanged too:
+            state = self._unconfirmed_programmed_state
+            self._unconfirmed_programmed_state = None
+            if not unchanged and state.get('digest') == device_digest:
+                unchanged = yield from self._confirm_programmed_state(state.get('tokens', {}))
+                if unchanged:
+                    self._programmed_state_tokens = dict(state['tokens'])
+        # Unknown until the workers succeed:
+        self._last_programmed_digest = None
         # transition_to_buffered returns the final values of the run, to update the GUI with at the end of the run:
-        transitioned_called = [self._primary_worker]
         front_panel_values = self.get_front_panel_values()
-        self._final_values = yield(self.queue_work(self._primary_worker,'_transition_to_buffered',self.device_name,h5_file,front_panel_values,self._force_full_buffered_reprogram))
-        if self._final_values is not None:
-            for worker in self._secondary_workers:
-                transitioned_called.append(worker)
-                extra_final_values = yield(self.queue_work(worker,'_transition_to_buffered',self.device_name,h5_file,front_panel_values,self.force_full_buffered_reprogram))
-                if extra_final_values is not None:
-                    self._final_values.update(extra_final_values)
-                else:
-                    self._final_values = None
-                    break
+        # device_group, if given, is the device's group in the shot file, read by the
+        # queue manager. Only sent to the workers that accept it. Neither it nor
+        # unchanged is sent to workers from older versions of BLACS:
+        def transition_kwargs(worker):
+            kwargs = {}
+            if self.worker_protocol(worker) >= 2:
+                kwargs['unchanged'] = unchanged
+            if device_group is not None and self.worker_accepts(worker,'device_group'):
+                kwargs['device_group'] = device_group
+            return kwargs
+        all_final_values = yield from self._queue_work_in_workers(
+            '_transition_to_buffered',self.device_name,h5_file,front_panel_values,self._force_full_buffered_reprogram,
+            worker_kwargs=transition_kwargs,stop=lambda results: results[-1] is None,
+        )
+        # The workers that were called, which must be aborted if any failed:
+        transitioned_called = ([self._primary_worker] + self._secondary_workers)[:len(all_final_values)]
+        if any(final_values is None for final_values in all_final_values):
+            self._final_values = None
+        else:
+            self._final_values = all_final_values[0]
+            for extra_final_values in all_final_values[1:]:
+                self._final_values.update(extra_final_values)
         
         # If we get None back, then the worker process did not finish properly
         if self._final_values is None:
             notify_queue.put([self.device_name,'fail'])
             self.abort_transition_to_buffered(transitioned_called)
         else:
+            self._last_programmed_digest = device_digest
+            if device_digest is not None and not unchanged:
+                yield from self._update_programmed_state_tokens()
             if self._supports_smart_programming:
                 self.force_full_buffered_reprogram = False
                 self._ui.button_clear_smart_programming.setEnabled(True)
@@ -610,17 +743,53 @@ class DeviceTab(Tab):
             self.mode = MODE_BUFFERED
             notify_queue.put([self.device_name,'success'])
        
+    def _confirm_programmed_state(self, tokens):
+        # Ask each worker whether its hardware still holds what it held when it
+        # reported the given token. Called from within states:
+        if not self._workers_support_protocol(2):
+            return False
+        for worker in [self._primary_worker] + self._secondary_workers:
+            if worker not in tokens:
+                return False
+            confirmed = yield(self.queue_work(worker,'_confirm_programmed_state',tokens[worker]))
+            if not confirmed:
+                return False
+        return True
+
+    def _update_programmed_state_tokens(self):
+        # Get tokens from the workers identifying what their hardware was just
+        # programmed with, to be saved for confirming after a restart. Called from
+        # within states:
+        self._programmed_state_tokens = {}
+        if not self._supports_programmed_state_tokens or not self._workers_support_protocol(2):
+            return
+        tokens = {}
+        for worker in [self._primary_worker] + self._secondary_workers:
+            token = yield(self.queue_work(worker,'_programmed_state_token'))
+            if token is None:
+                if worker == self._primary_worker:
+                    # The device does not report tokens, don't ask again:
+                    self._supports_programmed_state_tokens = False
+                return
+            tokens[worker] = token
+        self._programmed_state_tokens = tokens
+        changes.mark(TABS)
+
     @define_state(MODE_TRANSITION_TO_BUFFERED,False)
     def abort_transition_to_buffered(self,workers=None):
+        # The hardware may not hold the tables of the shot that was being programmed:
+        self.invalidate_programmed_state()
         if workers is None:
             workers = [self._primary_worker]
             workers.extend(self._secondary_workers)
-        success = True
-        for worker in workers:
-            abort_success = yield(self.queue_work(worker,'abort_transition_to_buffered'))
-            if not abort_success:
-                success = False
+        if self._parallel_workers and len(workers) > 1:
+            abort_successes = yield([self.queue_work(worker,'abort_transition_to_buffered') for worker in workers])
+        else:
+            abort_successes = []
+            for worker in workers:
+                abort_successes.append((yield(self.queue_work(worker,'abort_transition_to_buffered'))))
                 # don't break here, so that as much of the device is returned to normal
+        success = all(abort_successes)
                 
         if success:
             self.mode = MODE_MANUAL
@@ -630,12 +799,10 @@ class DeviceTab(Tab):
         
     @define_state(MODE_BUFFERED,False)
     def abort_buffered(self,notify_queue):
-        success = yield(self.queue_work(self._primary_worker,'abort_buffered'))
-        for worker in self._secondary_workers:
-            abort_success = yield(self.queue_work(worker,'abort_buffered'))
-            if not abort_success:
-                success = False
-                # don't break here, so that as much of the device is returned to normal
+        self.invalidate_programmed_state()
+        # don't stop at the first failure, so that as much of the device is returned to
+        # normal:
+        success = all((yield from self._queue_work_in_workers('abort_buffered')))
         
         if success:
             notify_queue.put([self.device_name,'success'])
@@ -649,12 +816,9 @@ class DeviceTab(Tab):
     def transition_to_manual(self,notify_queue,program=False):
         self.mode = MODE_TRANSITION_TO_MANUAL
         
-        success = yield(self.queue_work(self._primary_worker,'transition_to_manual'))
-        for worker in self._secondary_workers:
-            transition_success = yield(self.queue_work(worker,'transition_to_manual'))
-            if not transition_success:
-                success = False
-                # don't break here, so that as much of the device is returned to normal
+        # don't stop at the first failure, so that as much of the device is returned to
+        # normal:
+        success = all((yield from self._queue_work_in_workers('transition_to_manual')))
         
         # Update the GUI with the final values of the run:
         for channel, value in self._final_values.items():
@@ -666,8 +830,7 @@ class DeviceTab(Tab):
                 self._image[channel].set_value(value,program=False)
             elif channel in self._DDS:
                 self._DDS[channel].set_value(value,program=False)
-        
-        
+        self._values_after_shot = self.get_front_panel_values()
             
         if success:
             notify_queue.put([self.device_name,'success'])
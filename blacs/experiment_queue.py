@@ -18,7 +18,12 @@ import time
 import datetime
 import sys
 import shutil
-from collections import defaultdict
+import hashlib
+import inspect
+from collections import defaultdict, deque, Counter, OrderedDict
+from itertools import islice
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tempfile import gettempdir
 from binascii import hexlify
 
@@ -32,13 +37,17 @@ process_tree = ProcessTree.instance()
 import labscript_utils.h5_lock, h5py
 
 from qtutils import *
+from qtutils.invoke_in_main import get_inmain_result
 
 from labscript_utils.qtwidgets.elide_label import elide_label
 from labscript_utils.connections import ConnectionTable
-import labscript_utils.properties
 
 from blacs.tab_base_classes import MODE_MANUAL, MODE_TRANSITION_TO_BUFFERED, MODE_TRANSITION_TO_MANUAL, MODE_BUFFERED  
 import blacs.plugins as plugins
+from blacs.shot_manifest import ShotManifest, get_manifest, store_manifest, discard_manifest
+from blacs.shot_broker import ShotBroker
+from blacs.autosave import changes, QUEUE
+from blacs.queue_journal import QueueJournal, file_stat
 
 
 def tempfilename(prefix='BLACS-temp-', suffix='.h5'):
@@ -49,11 +58,60 @@ def tempfilename(prefix='BLACS-temp-', suffix='.h5'):
 
 FILEPATH_COLUMN = 0
 
+# Names used for events posted to the queue manager that do not come from a device.
+# These are not valid python variable names (they have a space in them!) and so will
+# never be a labscript device name:
+QUEUE_MANAGER = 'Queue Manager'
+MASTER_PSEUDOCLOCK = 'Master pseudoclock'
+
+# Before the queue manager waited on an EventQueue, it polled for some events: new files
+# and unpausing ('wakeup') were noticed within 1s, and aborts and restarts during a run
+# within 0.5s. The longest each of these could wait, in seconds, for comparison with
+# their measured latencies:
+POLLED_EVENT_LATENCIES = {'wakeup': 1.0, 'abort': 0.5, 'restart': 0.5}
+
+
+class EventQueue(queue.Queue):
+    """A Queue of [source, message] events on which the queue manager waits for all
+    the things it responds to: devices finishing transitions, the end of the run,
+    aborts, restarts, new files and unpausing. Records how long each event waited
+    in the queue before being received, as (message, latency) pairs, so that the
+    latency with which the queue manager responds to events can be measured. If
+    given, latencies is the list to record them in, which may be shared by
+    successive queues."""
+    def __init__(self, latencies=None):
+        queue.Queue.__init__(self)
+        self.latencies = latencies if latencies is not None else []
+
+    def _put(self, item):
+        queue.Queue._put(self, (time.perf_counter(), item))
+
+    def _get(self):
+        put_time, item = queue.Queue._get(self)
+        self.latencies.append((item[1], time.perf_counter() - put_time))
+        return item
+
+
+class EventForwarder(object):
+    """Queue-like object that forwards items put to it to an EventQueue as
+    [source, item] events. Passed to code that notifies by putting a bare
+    message, such as a master pseudoclock putting 'done' at the end of the run"""
+    def __init__(self, target, source):
+        self.target = target
+        self.source = source
+
+    def put(self, item, *args, **kwargs):
+        self.target.put([self.source, item])
+
+
 class QueueTreeview(QTreeView):
     def __init__(self,*args,**kwargs):
         QTreeView.__init__(self,*args,**kwargs)
         self.header().setStretchLastSection(True)
         self.setAutoScroll(False)
+        # All rows are one line of text. This lets the view lay out very long queues
+        # without querying the size of every row:
+        self.setUniformRowHeights(True)
         self.add_to_queue = None
         self.delete_selection = None
         self._logger = logging.getLogger('BLACS.QueueManager') 
@@ -83,19 +141,323 @@ class QueueTreeview(QTreeView):
             event.setDropAction(Qt.CopyAction)
             event.accept()
             
+            paths = []
             for url in event.mimeData().urls():
                 path = str(url.toLocalFile())
                 if path.endswith('.h5') or path.endswith('.hdf5'):
                     self._logger.info('Acceptable file dropped. Path is %s'%path)
-                    if self.add_to_queue:
-                        self.add_to_queue(str(path))
-                    else:
-                        self._logger.info('Dropped file not added to queue because there is no access to the neccessary add_to_queue method')
+                    paths.append(path)
                 else:
                     self._logger.info('Invalid file dropped. Path was %s'%path)
+            if not paths:
+                return
+            if self.add_to_queue:
+                self.add_to_queue(paths)
+            else:
+                self._logger.info('Dropped file not added to queue because there is no access to the neccessary add_to_queue method')
         else:
             event.ignore()
 
+
+class QueueModel(QAbstractListModel):
+    """Model of the files in the queue, stored as a deque of paths rather than an
+    item per file. A count of each path is kept alongside for constant time
+    membership checks. Reads are thread-safe, modifications must be made in the
+    main thread as they notify attached views, except for take_first(), so that the
+    queue manager can take files without waiting on the main thread. If a
+    QueueJournal is set as the journal attribute, modifications are recorded to it."""
+    # Above this many separate ranges of rows to remove, reset the model instead
+    # of notifying views of each range:
+    MAX_REMOVE_RANGES = 32
+
+    def __init__(self, parent=None):
+        QAbstractListModel.__init__(self, parent)
+        self._lock = threading.RLock()
+        self._paths = deque()
+        self._counts = Counter()
+        # Paths taken by take_first() that the main thread is yet to remove from the
+        # rows seen by views. They are not seen by first(), head(), len() or `in`:
+        self._taken = Counter()
+        self.journal = None
+
+    def _record(self, *record):
+        # Must be called with the lock held, so that records are in the same order
+        # as the modifications they describe:
+        if self.journal is not None:
+            self.journal.record(*record)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.ToolTipRole):
+            return None
+        with self._lock:
+            try:
+                return self._paths[index.row()]
+            except IndexError:
+                return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole and section == FILEPATH_COLUMN:
+            return 'Filepath'
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemNeverHasChildren
+
+    def __contains__(self, path):
+        with self._lock:
+            return self._counts[path] > self._taken[path]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._paths) - sum(self._taken.values())
+
+    def _untaken(self):
+        # The paths in the queue, in order, skipping the first occurrences of those
+        # taken by take_first(). Must be called with the lock held:
+        if not self._taken:
+            yield from self._paths
+            return
+        taken = self._taken.copy()
+        for path in self._paths:
+            if taken[path]:
+                taken[path] -= 1
+            else:
+                yield path
+
+    def paths(self):
+        """Return a list of the paths in the queue, in order, as seen by views"""
+        with self._lock:
+            return list(self._paths)
+
+    def head(self, n):
+        """Return a list of the first n paths in the queue"""
+        with self._lock:
+            return list(islice(self._untaken(), n))
+
+    def first(self):
+        """Return the path at the top of the queue, or None if it is empty"""
+        with self._lock:
+            return next(self._untaken(), None)
+
+    def append_paths(self, paths, stats=None):
+        """Append paths to the queue. stats, if given, are the file_stat() of each
+        file when it was validated, for recording in the journal"""
+        paths = list(paths)
+        if not paths:
+            return
+        if stats is None:
+            stats = [None] * len(paths)
+        row = len(self._paths)
+        self.beginInsertRows(QModelIndex(), row, row + len(paths) - 1)
+        with self._lock:
+            self._paths.extend(paths)
+            self._counts.update(paths)
+            self._record('append', paths, list(stats))
+        self.endInsertRows()
+
+    def prepend_path(self, path, stat=None):
+        self.beginInsertRows(QModelIndex(), 0, 0)
+        with self._lock:
+            self._paths.appendleft(path)
+            self._counts[path] += 1
+            self._record('prepend', path, stat)
+        self.endInsertRows()
+
+    def take_first(self, path=None):
+        """Take the path at the top of the queue, or only take it if it is path, if
+        given. Return the path taken, or None if none was. May be called from any
+        thread without waiting on the main thread. The path is no longer seen by
+        first(), head(), len() or `in` from then on, and is removed from the rows
+        seen by views once the main thread gets to it."""
+        with self._lock:
+            first = next(self._untaken(), None)
+            if first is None or (path is not None and first != path):
+                return None
+            self._taken[first] += 1
+        inmain_later(self._remove_taken, first)
+        return first
+
+    def _remove_taken(self, path):
+        # Remove a path taken by take_first() from the rows seen by views. It is
+        # normally still the first row, unless the user has since moved rows:
+        with self._lock:
+            self._taken[path] -= 1
+            if not self._taken[path]:
+                del self._taken[path]
+            try:
+                row = self._paths.index(path)
+            except ValueError:
+                # Removed by the user in the meantime:
+                return
+        if row > 0:
+            self.removeRows(row, 1)
+            return
+        self.beginRemoveRows(QModelIndex(), 0, 0)
+        with self._lock:
+            self._remove_count(self._paths.popleft())
+            self._record('pop')
+        self.endRemoveRows()
+
+    def clear(self):
+        self.beginResetModel()
+        with self._lock:
+            self._paths.clear()
+            self._counts.clear()
+            self._record('clear')
+        self.endResetModel()
+
+    def _remove_count(self, path):
+        self._counts[path] -= 1
+        if not self._counts[path]:
+            del self._counts[path]
+
+    def removeRows(self, row, count, parent=QModelIndex()):
+        if parent.isValid() or count < 1 or row < 0 or row + count > len(self._paths):
+            return False
+        self.beginRemoveRows(parent, row, row + count - 1)
+        with self._lock:
+            self._paths.rotate(-row)
+            for _ in range(count):
+                self._remove_count(self._paths.popleft())
+            self._paths.rotate(row)
+            self._record('remove', row, count)
+        self.endRemoveRows()
+        return True
+
+    def remove_row_list(self, rows):
+        """Remove the given rows, as few contiguous ranges as possible"""
+        ranges = contiguous_ranges(rows)
+        if len(ranges) > self.MAX_REMOVE_RANGES:
+            rows = set(rows)
+            self.beginResetModel()
+            with self._lock:
+                kept = deque()
+                for i, path in enumerate(self._paths):
+                    if i in rows:
+                        self._remove_count(path)
+                    else:
+                        kept.append(path)
+                self._paths = kept
+                self._record('remove_rows', sorted(rows))
+            self.endResetModel()
+            return
+        # Remove from the bottom up so that rows above are not shifted:
+        for start, count in reversed(ranges):
+            self.removeRows(start, count)
+
+    def moveRows(self, source_parent, source_row, count, destination_parent, destination_child):
+        """Move count rows starting at source_row to before the row that is at
+        destination_child prior to the move"""
+        if source_parent.isValid() or destination_parent.isValid() or count < 1:
+            return False
+        if source_row <= destination_child <= source_row + count:
+            # Not moving anywhere:
+            return False
+        last_row = source_row + count - 1
+        if not self.beginMoveRows(source_parent, source_row, last_row, destination_parent, destination_child):
+            return False
+        with self._lock:
+            paths = list(self._paths)
+            moved = paths[source_row:source_row + count]
+            del paths[source_row:source_row + count]
+            row = destination_child
+            if row > source_row:
+                row -= count
+            paths[row:row] = moved
+            self._paths = deque(paths)
+            self._record('move', source_row, count, destination_child)
+        self.endMoveRows()
+        return True
+
+
+def contiguous_ranges(rows):
+    """Return a sorted list of (start, count) for the contiguous ranges in a
+    collection of row numbers"""
+    ranges = []
+    for row in sorted(set(rows)):
+        if ranges and ranges[-1][0] + ranges[-1][1] == row:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([row, 1])
+    return [tuple(r) for r in ranges]
+
+
+def connection_table_digest(h5_file):
+    """Return a hash of the connection table of an open shot file, for identifying
+    connection tables that are identical without parsing them"""
+    dataset = h5_file['connection table']
+    raw_table = dataset[:]
+    digest = hashlib.sha256()
+    digest.update(str(raw_table.dtype.descr).encode('utf8'))
+    if raw_table.dtype.hasobject:
+        # Variable length fields are objects, whose bytes are not their contents:
+        digest.update(repr(raw_table.tolist()).encode('utf8'))
+    else:
+        digest.update(raw_table.tobytes())
+    digest.update(repr(dataset.attrs.get('master_pseudoclock')).encode('utf8'))
+    return digest.hexdigest()
+
+
+class ConnectionTableCache(object):
+    """LRU cache of the results of comparing shot connection tables to the lab
+    connection table, keyed by connection_table_digest(). Thread-safe."""
+    def __init__(self, connection_table, maxsize=32):
+        self.connection_table = connection_table
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compare(self, digest, h5_filepath):
+        """Return the result of comparing the lab connection table to that of the
+        given shot file, which has the given digest. The shot file's connection
+        table is only parsed if the result is not cached."""
+        with self._lock:
+            if digest in self._results:
+                self.hits += 1
+                self._results.move_to_end(digest)
+                return self._results[digest]
+            self.misses += 1
+        new_conn = ConnectionTable(h5_filepath, logging_prefix='BLACS')
+        result = self.connection_table.compare_to(new_conn)
+        with self._lock:
+            self._results[digest] = result
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        return result
+
+
+class PipelinedShot(object):
+    """State of a shot whose devices are being transitioned to buffered mode while
+    the previous shot is still transitioning to manual mode"""
+    def __init__(self, path, devices_in_use, start_order, stop_order):
+        self.path = path
+        self.devices_in_use = devices_in_use
+        self.start_groups = defaultdict(set)
+        self.stop_groups = defaultdict(set)
+        for name in devices_in_use:
+            self.start_groups[start_order[name]].add(name)
+            self.stop_groups[stop_order[name]].add(name)
+        # Devices in the current start group not yet told to transition:
+        self.pending = set()
+        # Devices told to transition to buffered that have not yet responded:
+        self.transition_list = {}
+        # All devices told to transition to buffered:
+        self.started = set()
+        self.error_condition = False
+        # Whether the user clicked abort whilst the previous shot was transitioning to
+        # manual mode:
+        self.aborted = False
+
+
 class QueueManager(object):
     
     REPEAT_ALL = 0
@@ -104,23 +466,97 @@ class QueueManager(object):
     ICON_REPEAT = ':qtutils/fugue/arrow-repeat'
     ICON_REPEAT_LAST = ':qtutils/fugue/arrow-repeat-once'
 
+    # Show a progress dialog when adding at least this many files via the GUI:
+    SUBMISSION_PROGRESS_MIN_FILES = 50
+    # Minimum time between progress updates while validating files, in seconds:
+    SUBMISSION_PROGRESS_INTERVAL = 0.1
+
     def __init__(self, BLACS, ui):
         self._ui = ui
         self.BLACS = BLACS
         self.last_opened_shots_folder = BLACS.exp_config.get('paths', 'experiment_shot_storage')
+        # State shared between the GUI and the manager thread. This is read by the
+        # manager thread without waiting on the Qt mainloop, and the GUI is updated
+        # to reflect it asynchronously:
+        self._state_lock = threading.Lock()
         self._manager_running = True
         self._manager_paused = False
         self._manager_repeat = False
         self._manager_repeat_mode = self.REPEAT_ALL
+        self._status = ("Idle", None)
         self.master_pseudoclock = self.BLACS.connection_table.master_pseudoclock
-        
-        self._logger = logging.getLogger('BLACS.QueueManager')   
+
+        # Opt-in pipelined mode, in which devices that have finished transitioning to
+        # manual mode for one shot begin transitioning to buffered for the next:
+        self.pipelined = BLACS.exp_config.getboolean(
+            'BLACS/queue', 'pipelined_shots', fallback=False
+        )
+        # Devices and start/stop orders of the next shot in the queue, read during
+        # the current shot when in pipelined mode:
+        self._prefetched_shot = None
+        # Reads the groups of devices in shot files to send to their workers:
+        self.shot_broker = ShotBroker()
+        # How many shots at the top of the queue devices are asked to prepare their
+        # instructions for whilst a shot runs, and the names of the devices last asked
+        # to prepare each shot:
+        self.prepare_ahead = BLACS.exp_config.getint(
+            'BLACS/queue', 'prepare_ahead', fallback=1
+        )
+        self._prepare_requested = {}
+
+        # Threads used to validate shot files submitted in a batch:
+        self.validation_threads = BLACS.exp_config.getint(
+            'BLACS/queue', 'validation_threads', fallback=4
+        )
+        self._rep_lock = threading.Lock()
+        self.connection_table_cache = ConnectionTableCache(self.BLACS.connection_table)
+        # Whether to store each distinct front panel once, outside of shot files, with
+        # shot files referring to it by hash:
+        self.deduplicate_front_panel = BLACS.exp_config.getboolean(
+            'BLACS/front_panel', 'deduplicate_shots', fallback=False
+        )
+        # Journal of changes to the queue, from which it is rebuilt on startup rather
+        # than from the list of files saved on exit:
+        self.journal = None
+        if BLACS.exp_config.getboolean('BLACS/queue', 'journal', fallback=True):
+            self.journal = QueueJournal(
+                os.path.splitext(BLACS.settings_path)[0] + '_queue_journal.jsonl'
+            )
+        # The stats of files restored to the queue from the journal that have not been
+        # checked since, by path. These are checked in the background after startup,
+        # and any not found to be unchanged are validated before they are run:
+        self._restored_stats = {}
+        self._restored_stats_lock = threading.Lock()
+        # Writes front panel values to shot files whilst they run:
+        self._shot_writer = ThreadPoolExecutor(
+            max_workers=1, initializer=h5py._errors.silence_errors
+        )
+
+        # The queue on which the manager thread waits for events. Replaced with a
+        # fresh queue at the start of each shot so that stale events are discarded.
+        # The latencies of events received on all of them are recorded in the same
+        # list, so that those that woke the manager whilst it was idle are included:
+        self._event_latencies = []
+        self.current_queue = EventQueue(self._event_latencies)
+        # (message, latency) of the events handled up to the end of the most recently
+        # completed shot since the one before it, latencies in seconds:
+        self.last_shot_event_latencies = []
+
+        self._logger = logging.getLogger('BLACS.QueueManager')
         
         # Create listview model
-        self._model = QStandardItemModel()
-        self._create_headers()
+        self._model = QueueModel()
         self._ui.treeview.setModel(self._model)
-        self._ui.treeview.add_to_queue = self.process_request
+        if self.journal is None:
+            # Save the queue at the next autosave whenever its contents change:
+            for signal in [
+                self._model.rowsInserted,
+                self._model.rowsRemoved,
+                self._model.rowsMoved,
+                self._model.modelReset,
+            ]:
+                signal.connect(lambda *args: changes.mark(QUEUE))
+        self._ui.treeview.add_to_queue = self.submit_files
         self._ui.treeview.delete_selection = self._delete_selected_items
         
         # set up buttons
@@ -160,21 +596,17 @@ class QueueManager(object):
         self.manager.daemon=True
         self.manager.start()
 
-    def _create_headers(self):
-        self._model.setHorizontalHeaderItem(FILEPATH_COLUMN, QStandardItem('Filepath'))
-        
     def get_save_data(self):
-        # get list of files in the queue
-        file_list = []
-        for i in range(self._model.rowCount()):
-            file_list.append(self._model.item(i).text())
         # get button states
-        return {'manager_paused':self.manager_paused,
+        data = {'manager_paused':self.manager_paused,
                 'manager_repeat':self.manager_repeat,
                 'manager_repeat_mode':self.manager_repeat_mode,
-                'files_queued':file_list,
                 'last_opened_shots_folder': self.last_opened_shots_folder
                }
+        if self.journal is None:
+            # get list of files in the queue. Otherwise it is in the journal:
+            data['files_queued'] = self._model.paths()
+        return data
     
     def restore_save_data(self,data):
         if 'manager_paused' in data:
@@ -183,43 +615,74 @@ class QueueManager(object):
             self.manager_repeat = data['manager_repeat']
         if 'manager_repeat_mode' in data:
             self.manager_repeat_mode = data['manager_repeat_mode']
+        if self.journal is not None and self._model.journal is None:
+            # Starting up. Rebuild the queue from the journal if there is one, and
+            # record changes from here on:
+            try:
+                file_list, stats = self.journal.replay()
+            except Exception:
+                # Start with an empty queue rather than not at all:
+                self._logger.exception('Could not read the queue journal')
+                file_list, stats = None, None
+            if file_list is not None:
+                # The files were validated when they were added to the queue, so are
+                # not validated again now, but checked for changes afterwards:
+                self._logger.info('Restoring %d files to the queue from the journal' % len(file_list))
+                with self._restored_stats_lock:
+                    self._restored_stats = {path: stats.get(path) for path in file_list}
+                self._model.append_paths(file_list, [stats.get(path) for path in file_list])
+                QTimer.singleShot(0, lambda: inthread(self._check_restored_files))
+                # Ignore any list of files saved by a version of BLACS prior to the
+                # journal, or with it disabled:
+                data = {k: v for k, v in data.items() if k != 'files_queued'}
+            self.journal.open(self._model.paths(), stats)
+            self._model.journal = self.journal
         if 'files_queued' in data:
             file_list = list(data['files_queued'])
             self._model.clear()
-            self._create_headers()
-            for file in file_list:
-                self.process_request(str(file))
+            self.submit_files([str(file) for file in file_list])
         if 'last_opened_shots_folder' in data:
             self.last_opened_shots_folder = data['last_opened_shots_folder']
         
     @property
-    @inmain_decorator(True)
     def manager_running(self):
-        return self._manager_running
+        with self._state_lock:
+            return self._manager_running
         
     @manager_running.setter
-    @inmain_decorator(True)
     def manager_running(self,value):
         value = bool(value)
-        self._manager_running = value
+        with self._state_lock:
+            self._manager_running = value
+        if not value:
+            self._wake_manager()
         
     def _toggle_pause(self,checked):    
         self.manager_paused = checked
 
     def _toggle_clear(self):
         self._model.clear()
-        self._create_headers()
 
     @property
-    @inmain_decorator(True)
     def manager_paused(self):
-        return self._manager_paused
+        with self._state_lock:
+            return self._manager_paused
     
     @manager_paused.setter
-    @inmain_decorator(True)
     def manager_paused(self,value):
         value = bool(value)
-        self._manager_paused = value
+        with self._state_lock:
+            self._manager_paused = value
+        changes.mark(QUEUE)
+        self._update_pause_button()
+        if not value:
+            self._wake_manager()
+
+    @inmain_decorator(wait_for_return=False)
+    def _update_pause_button(self):
+        # Read the state when this runs rather than when it was requested, in case it
+        # has been changed by the user in the meantime:
+        value = self.manager_paused
         if value != self._ui.queue_pause_button.isChecked():
             self._ui.queue_pause_button.setChecked(value)
     
@@ -227,32 +690,41 @@ class QueueManager(object):
         self.manager_repeat = checked
         
     @property
-    @inmain_decorator(True)
     def manager_repeat(self):
-        return self._manager_repeat
+        with self._state_lock:
+            return self._manager_repeat
 
     @manager_repeat.setter
-    @inmain_decorator(True)
     def manager_repeat(self,value):
         value = bool(value)
-        self._manager_repeat = value
-        if value != self._ui.queue_repeat_button.isChecked():
-            self._ui.queue_repeat_button.setChecked(value)
+        with self._state_lock:
+            self._manager_repeat = value
+        changes.mark(QUEUE)
+        self._update_repeat_button()
 
     @property
-    @inmain_decorator(True)
     def manager_repeat_mode(self):
-        return self._manager_repeat_mode
+        with self._state_lock:
+            return self._manager_repeat_mode
 
     @manager_repeat_mode.setter
-    @inmain_decorator(True)
     def manager_repeat_mode(self, value):
         assert value in [self.REPEAT_LAST, self.REPEAT_ALL]
-        self._manager_repeat_mode = value
+        with self._state_lock:
+            self._manager_repeat_mode = value
+        changes.mark(QUEUE)
+        self._update_repeat_button()
+
+    @inmain_decorator(wait_for_return=False)
+    def _update_repeat_button(self):
         button = self._ui.queue_repeat_button
-        if value == self.REPEAT_ALL:
+        value = self.manager_repeat
+        if value != button.isChecked():
+            button.setChecked(value)
+        mode = self.manager_repeat_mode
+        if mode == self.REPEAT_ALL:
             button.setIcon(QIcon(self.ICON_REPEAT))
-        elif value == self.REPEAT_LAST:
+        elif mode == self.REPEAT_LAST:
             button.setIcon(QIcon(self.ICON_REPEAT_LAST))
 
     def on_add_shots_triggered(self):
@@ -271,142 +743,269 @@ class QueueManager(object):
         # Save the containing folder for use next time we open the dialog box:
         self.last_opened_shots_folder = os.path.dirname(shot_files[0])
         # Queue the files to be opened:
-        for filepath in shot_files:
-            if filepath.endswith('.h5'):
-                self.process_request(str(filepath))
+        self.submit_files([filepath for filepath in shot_files if filepath.endswith('.h5')])
 
     def _delete_selected_items(self):
-        index_list = self._ui.treeview.selectedIndexes()
-        while index_list:
-            self._model.takeRow(index_list[0].row())
-            index_list = self._ui.treeview.selectedIndexes()
-    
-    def _move_up(self):        
-        # Get the selection model from the treeview
-        selection_model = self._ui.treeview.selectionModel()    
-        # Create a list of select row indices
-        selected_row_list = [index.row() for index in sorted(selection_model.selectedRows())]
-        # For each row selected
-        for i,row in enumerate(selected_row_list):
-            # only move the row if it is not element 0, and the row above it is not selected
-            # (note that while a row above may have been initially selected, it should by now, be one row higher
-            # since we start moving elements of the list upwards starting from the lowest index)
-            if row > 0 and (row-1) not in selected_row_list:
-                # Remove the selected row
-                items = self._model.takeRow(row)
-                # Add the selected row into a position one above
-                self._model.insertRow(row-1,items)
-                # Since it is now a newly inserted row, select it again
-                selection_model.select(self._model.indexFromItem(items[0]),QItemSelectionModel.SelectCurrent)
-                # reupdate the list of selected indices to reflect this change
-                selected_row_list[i] -= 1
+        rows = [index.row() for index in self._ui.treeview.selectionModel().selectedRows()]
+        self._model.remove_row_list(rows)
+
+    def _selected_ranges(self):
+        # The contiguous ranges of selected rows, as (start, count) tuples
+        selection_model = self._ui.treeview.selectionModel()
+        return contiguous_ranges(index.row() for index in selection_model.selectedRows())
+
+    def _move_up(self):
+        # Move each block of selected rows up by one, unless it is already at the top.
+        # Selection follows the moved rows:
+        for start, count in self._selected_ranges():
+            if start > 0:
+                self._model.moveRows(QModelIndex(), start, count, QModelIndex(), start - 1)
        
     def _move_down(self):
-        # Get the selection model from the treeview
-        selection_model = self._ui.treeview.selectionModel()    
-        # Create a list of select row indices
-        selected_row_list = [index.row() for index in reversed(sorted(selection_model.selectedRows()))]
-        # For each row selected
-        for i,row in enumerate(selected_row_list):
-            # only move the row if it is not the last element, and the row above it is not selected
-            # (note that while a row below may have been initially selected, it should by now, be one row lower
-            # since we start moving elements of the list upwards starting from the highest index)
-            if row < self._model.rowCount()-1 and (row+1) not in selected_row_list:
-                # Remove the selected row
-                items = self._model.takeRow(row)
-                # Add the selected row into a position one above
-                self._model.insertRow(row+1,items)
-                # Since it is now a newly inserted row, select it again
-                selection_model.select(self._model.indexFromItem(items[0]),QItemSelectionModel.SelectCurrent)
-                # reupdate the list of selected indices to reflect this change
-                selected_row_list[i] += 1
+        # Move each block of selected rows down by one, unless it is already at the
+        # bottom. Start from the lowest block so that moved blocks don't merge:
+        n_rows = self._model.rowCount()
+        for start, count in reversed(self._selected_ranges()):
+            if start + count < n_rows:
+                self._model.moveRows(QModelIndex(), start, count, QModelIndex(), start + count + 1)
         
     def _move_top(self):
-        # Get the selection model from the treeview
-        selection_model = self._ui.treeview.selectionModel()    
-        # Create a list of select row indices
-        selected_row_list = [index.row() for index in sorted(selection_model.selectedRows())]
-        # For each row selected
-        for i,row in enumerate(selected_row_list):
-            # only move the row while it is not element 0, and the row above it is not selected
-            # (note that while a row above may have been initially selected, it should by now, be one row higher
-            # since we start moving elements of the list upwards starting from the lowest index)
-            while row > 0 and (row-1) not in selected_row_list:
-                # Remove the selected row
-                items = self._model.takeRow(row)
-                # Add the selected row into a position one above
-                self._model.insertRow(row-1,items)
-                # Since it is now a newly inserted row, select it again
-                selection_model.select(self._model.indexFromItem(items[0]),QItemSelectionModel.SelectCurrent)
-                # reupdate the list of selected indices to reflect this change
-                selected_row_list[i] -= 1
-                row -= 1
+        # Move all selected rows to the top, retaining their order. Moving a block
+        # above the ones below it does not change their row numbers:
+        n_placed = 0
+        for start, count in self._selected_ranges():
+            self._model.moveRows(QModelIndex(), start, count, QModelIndex(), n_placed)
+            n_placed += count
               
     def _move_bottom(self):
-        selection_model = self._ui.treeview.selectionModel()    
-        # Create a list of select row indices
-        selected_row_list = [index.row() for index in reversed(sorted(selection_model.selectedRows()))]
-        # For each row selected
-        for i,row in enumerate(selected_row_list):
-            # only move the row while it is not the last element, and the row above it is not selected
-            # (note that while a row below may have been initially selected, it should by now, be one row lower
-            # since we start moving elements of the list upwards starting from the highest index)
-            while row < self._model.rowCount()-1 and (row+1) not in selected_row_list:
-                # Remove the selected row
-                items = self._model.takeRow(row)
-                # Add the selected row into a position one above
-                self._model.insertRow(row+1,items)
-                # Since it is now a newly inserted row, select it again
-                selection_model.select(self._model.indexFromItem(items[0]),QItemSelectionModel.SelectCurrent)
-                # reupdate the list of selected indices to reflect this change
-                selected_row_list[i] += 1
-                row += 1
+        # Move all selected rows to the bottom, retaining their order:
+        n_rows = self._model.rowCount()
+        n_placed = 0
+        for start, count in reversed(self._selected_ranges()):
+            self._model.moveRows(QModelIndex(), start, count, QModelIndex(), n_rows - n_placed)
+            n_placed += count
     
-    @inmain_decorator(True)
-    def append(self, h5files):
-        for file in h5files:
-            item = QStandardItem(file)
-            item.setToolTip(file)
-            self._model.appendRow(item)
+    # Neither waits for the main thread, so that the queue manager is not held up
+    # by the GUI. As the main thread makes modifications in the order requested,
+    # and then wakes the manager, the manager sees them in order:
+    @inmain_decorator(wait_for_return=False)
+    def append(self, h5files, stats=None):
+        self._model.append_paths(h5files, stats)
+        self._wake_manager()
     
-    @inmain_decorator(True)
+    @inmain_decorator(wait_for_return=False)
     def prepend(self,h5file):
         if not self.is_in_queue(h5file):
-            self._model.insertRow(0,QStandardItem(h5file))
+            self._model.prepend_path(h5file)
+        self._wake_manager()
+
+    def _wake_manager(self):
+        """Notify the manager thread that there may be a new file to run, or that it
+        has been unpaused or stopped"""
+        self.current_queue.put([QUEUE_MANAGER, 'wakeup'])
     
     def process_request(self,h5_filepath):
-        # check connection table
+        new_h5_filepath, message, stat = self._validate_and_stat(h5_filepath, self.is_in_queue(h5_filepath))
+        if new_h5_filepath is None:
+            return message
+        self.append([new_h5_filepath], [stat])
+        return self._queue_state_message(message)
+
+    def submit_files(self, h5_filepaths):
+        """Validate and queue shot files added via the GUI, in a thread so as not to
+        block the GUI. For large numbers of files, a progress dialog is shown from
+        which the submission can be cancelled."""
+        h5_filepaths = list(h5_filepaths)
+        if not h5_filepaths:
+            return
+        cancel = threading.Event()
+        dialog = None
+        if len(h5_filepaths) >= self.SUBMISSION_PROGRESS_MIN_FILES:
+            dialog = QProgressDialog(
+                'Adding %d shots to the queue...' % len(h5_filepaths),
+                'Cancel',
+                0,
+                len(h5_filepaths),
+                self._ui,
+            )
+            dialog.setWindowTitle('BLACS')
+            dialog.setMinimumDuration(500)
+            dialog.canceled.connect(cancel.set)
+        inthread(self._submit_files, h5_filepaths, dialog, cancel)
+
+    def _submit_files(self, h5_filepaths, dialog, cancel):
+        def progress(n_done, n_total):
+            if dialog is not None:
+                inmain_later(dialog.setValue, n_done)
+        try:
+            messages = self.process_requests(h5_filepaths, progress=progress, cancel=cancel)
+        finally:
+            if dialog is not None:
+                inmain_later(dialog.close)
+        for h5_filepath, message in zip(h5_filepaths, messages):
+            self._logger.info('%s: %s' % (h5_filepath, message.strip()))
+
+    def process_requests(self, h5_filepaths, progress=None, cancel=None):
+        """Validate many shot files concurrently and add those that are accepted
+        to the queue in a single update, in the order given. Returns a list of
+        messages, one per file. May be called from any thread, only the final
+        update of the queue is done in the main thread.
+
+        If given, progress(n_done, n_total) is called periodically from this thread
+        as files are validated. If the threading.Event cancel is set, files not yet
+        being validated are skipped. Files already validated are still queued."""
+        h5_filepaths = [str(path) for path in h5_filepaths]
+        # A file submitted more than once is re-run, as for a file already in the
+        # queue. Work this out up front so that it doesn't depend on which thread
+        # validates which file first:
+        in_queue = []
+        seen = set()
+        for path in h5_filepaths:
+            in_queue.append(path in seen or self.is_in_queue(path))
+            seen.add(path)
+        results = [None] * len(h5_filepaths)
+        n_done = 0
+        last_progress_time = 0
+        cancelled = False
+        with ThreadPoolExecutor(max_workers=self.validation_threads) as executor:
+            futures = {
+                executor.submit(self._validate_and_stat, path, queued): i
+                for i, (path, queued) in enumerate(zip(h5_filepaths, in_queue))
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                if future.cancelled():
+                    results[i] = (None, "Submission cancelled\n", None)
+                else:
+                    try:
+                        results[i] = future.result()
+                    except Exception as e:
+                        self._logger.exception('Error validating %s' % h5_filepaths[i])
+                        results[i] = (None, "Error validating shot file: %s\n" % str(e), None)
+                n_done += 1
+                if cancel is not None and cancel.is_set() and not cancelled:
+                    cancelled = True
+                    for other_future in futures:
+                        other_future.cancel()
+                if progress is not None and (
+                    n_done == len(futures)
+                    or time.time() - last_progress_time > self.SUBMISSION_PROGRESS_INTERVAL
+                ):
+                    last_progress_time = time.time()
+                    progress(n_done, len(futures))
+        self._logger.debug(
+            'Connection table cache: %d hits, %d misses'
+            % (self.connection_table_cache.hits, self.connection_table_cache.misses)
+        )
+        accepted = [(path, stat) for path, _, stat in results if path is not None]
+        self.append([path for path, _ in accepted], [stat for _, stat in accepted])
+        return [
+            message if path is None else self._queue_state_message(message)
+            for path, message, _ in results
+        ]
+
+    def _queue_state_message(self, message):
+        # Amend the message for an accepted file with the state of the queue
+        if self.manager_paused:
+            message += "Warning: Queue is currently paused\n"
+        if not self.manager_running:
+            message = "Error: Queue is not running\n"
+        return message
+
+    def _validate_and_stat(self, h5_filepath, in_queue):
+        """Call _validate_request(), and return the path to be queued and message
+        it returns, and the file_stat() of the file to be queued, for the journal"""
+        new_h5_filepath, message = self._validate_request(h5_filepath, in_queue)
+        stat = None
+        if new_h5_filepath is not None:
+            try:
+                stat = file_stat(new_h5_filepath)
+            except OSError:
+                pass
+        return new_h5_filepath, message, stat
+
+    def _check_restored_files(self):
+        """Check, in the background, which of the files restored to the queue from
+        the journal are unchanged since they were validated. Those that are are run
+        without being validated again"""
+        with self._restored_stats_lock:
+            restored_stats = list(self._restored_stats.items())
+        n_changed = 0
+        for path, stat in restored_stats:
+            try:
+                unchanged = stat is not None and file_stat(path) == stat
+            except OSError:
+                unchanged = False
+            if unchanged:
+                with self._restored_stats_lock:
+                    self._restored_stats.pop(path, None)
+            else:
+                n_changed += 1
+        if n_changed:
+            self._logger.info(
+                '%d files restored to the queue are missing or have changed, and will be validated before being run'
+                % n_changed
+            )
+
+    def _check_restored_file(self, path):
+        """Validate a file taken from the queue to be run, if it was restored from the
+        journal and has not been found to be unchanged since. Return the path to run,
+        which is a fresh copy if the file has been run already, or None if it cannot
+        be run."""
+        with self._restored_stats_lock:
+            if path not in self._restored_stats:
+                return path
+            stat = self._restored_stats.pop(path)
+        try:
+            if stat is not None and file_stat(path) == stat:
+                return path
+        except OSError:
+            pass
+        new_path, message = self._validate_request(path, in_queue=False)
+        if new_path is None:
+            self._logger.warning('Not running %s, restored to the queue at startup: %s' % (path, message.strip()))
+        elif new_path != path:
+            self._logger.info('%s: %s' % (path, message.strip()))
+        return new_path
+
+    def _validate_request(self, h5_filepath, in_queue):
+        """Check a shot file is compatible with the lab connection table, and make a
+        fresh copy of it if it has been run already or is already in the queue.
+        Returns the path to be queued, or None if the file should not be queued,
+        and a message for the submitter. Does not require the main thread."""
+        # check connection table, comparing it to the lab connection table only if
+        # one with the same contents has not been compared already:
         try:
-            new_conn = ConnectionTable(h5_filepath, logging_prefix='BLACS')
+            with h5py.File(h5_filepath, 'r') as h5_file:
+                digest = connection_table_digest(h5_file)
+                # Has this run file been run already?
+                rerun = 'data' in h5_file['/']
+                try:
+                    # Read what is needed to run the shot whilst the file is open:
+                    manifest = ShotManifest(h5_filepath, h5_file)
+                except Exception:
+                    # Any error will be raised when the shot is run:
+                    manifest = None
+            result,error = self.connection_table_cache.compare(digest, h5_filepath)
         except Exception:
-            return "H5 file not accessible to Control PC\n"
-        result,error = inmain(self.BLACS.connection_table.compare_to,new_conn)
+            return None, "H5 file not accessible to Control PC\n"
         if result:
-            # Has this run file been run already?
-            with h5py.File(h5_filepath, 'r') as h5_file:
-                if 'data' in h5_file['/']:
-                    rerun = True
-                else:
-                    rerun = False
-            if rerun or self.is_in_queue(h5_filepath):
+            if rerun or in_queue:
                 self._logger.debug('Run file has already been run! Creating a fresh copy to rerun')
-                new_h5_filepath, repeat_number = self.new_rep_name(h5_filepath)
-                # Keep counting up until we get a filename that isn't in the filesystem:
-                while os.path.exists(new_h5_filepath):
-                    new_h5_filepath, repeat_number = self.new_rep_name(new_h5_filepath)
-                success = self.clean_h5_file(h5_filepath, new_h5_filepath, repeat_number=repeat_number)
+                # Only one thread at a time may pick a new filename and create it:
+                with self._rep_lock:
+                    new_h5_filepath, repeat_number = self.new_rep_name(h5_filepath)
+                    # Keep counting up until we get a filename that isn't in the filesystem:
+                    while os.path.exists(new_h5_filepath):
+                        new_h5_filepath, repeat_number = self.new_rep_name(new_h5_filepath)
+                    success = self.clean_h5_file(h5_filepath, new_h5_filepath, repeat_number=repeat_number)
                 if not success:
-                   return 'Cannot create a re run of this experiment. Is it a valid run file?'
-                self.append([new_h5_filepath])
-                message = "Experiment added successfully: experiment to be re-run\n"
+                   return None, 'Cannot create a re run of this experiment. Is it a valid run file?'
+                return new_h5_filepath, "Experiment added successfully: experiment to be re-run\n"
             else:
-                self.append([h5_filepath])
-                message = "Experiment added successfully\n"
-            if self.manager_paused:
-                message += "Warning: Queue is currently paused\n"
-            if not self.manager_running:
-                message = "Error: Queue is not running\n"
-            return message
+                if manifest is not None:
+                    store_manifest(manifest)
+                return h5_filepath, "Experiment added successfully\n"
         else:
             # TODO: Parse and display the contents of "error" in a more human readable format for analysis of what is wrong!
             message =  ("Connection table of your file is not a subset of the experimental control apparatus.\n"
@@ -418,7 +1017,7 @@ class QueueManager(object):
                        "\n"
                        "Please verify your experiment script matches the current experiment configuration, and try again\n"
                        "The error was %s\n"%error)
-            return message
+            return None, message
             
     def new_rep_name(self, h5_filepath):
         basename, ext = os.path.splitext(h5_filepath)
@@ -461,41 +1060,328 @@ class QueueManager(object):
             
         return True
     
-    @inmain_decorator(wait_for_return=True)    
-    def is_in_queue(self,path):                
-        item = self._model.findItems(path,column=FILEPATH_COLUMN)
-        if item:
-            return True
-        else:
-            return False
+    def is_in_queue(self,path):
+        return path in self._model
 
-    @inmain_decorator(wait_for_return=True)
     def set_status(self, queue_status, shot_filepath=None):
-        self._ui.queue_status.setText(str(queue_status))
+        with self._state_lock:
+            self._status = (str(queue_status), shot_filepath)
+        self._update_status_labels()
+
+    @inmain_decorator(wait_for_return=False)
+    def _update_status_labels(self):
+        # Show the most recent status, any earlier ones not yet displayed are skipped:
+        queue_status, shot_filepath = self._status
+        self._ui.queue_status.setText(queue_status)
         if shot_filepath is not None:
             self._ui.running_shot_name.setText('<b>%s</b>'% str(os.path.basename(shot_filepath)))
         else:
             self._ui.running_shot_name.setText('')
         
-    @inmain_decorator(wait_for_return=True)
     def get_status(self):
-        return self._ui.queue_status.text()
+        with self._state_lock:
+            return self._status[0]
+
+    @inmain_decorator(wait_for_return=False)
+    def _enable_abort_button(self, abort_function):
+        self._ui.queue_abort_button.clicked.connect(abort_function)
+        self._ui.queue_abort_button.setEnabled(True)
+
+    @inmain_decorator(wait_for_return=False)
+    def _disable_abort_button(self, abort_function):
+        self._ui.queue_abort_button.clicked.disconnect(abort_function)
+        self._ui.queue_abort_button.setEnabled(False)
             
-    @inmain_decorator(wait_for_return=True)
     def get_next_file(self):
-        return str(self._model.takeRow(0)[0].text())
-    
-    @inmain_decorator(wait_for_return=True)    
+        """Take the file at the top of the queue. Raises IndexError if the queue is
+        empty"""
+        path = self._model.take_first()
+        if path is None:
+            raise IndexError('queue is empty')
+        return str(path)
+
+    def peek_next_file(self):
+        """Return the path of the file at the top of the queue without removing it,
+        or None if the queue is empty"""
+        return self._model.first()
+
+    def take_file_if_next(self, path):
+        """Take the file at the top of the queue if it is path. Return whether it
+        was taken"""
+        return self._model.take_first(path) is not None
+
+    def read_shot_devices(self, path):
+        """Return the devices in use in a shot file, and their start_order and
+        stop_order properties"""
+        manifest = get_manifest(path)
+        devices_in_use = {name: self.BLACS.tablist[name] for name in manifest.device_names}
+        return devices_in_use, dict(manifest.start_order), dict(manifest.stop_order)
+
+    def _prefetch_next_shot(self):
+        """Read the devices of the next shot in the queue so that it is ready to be
+        pipelined once the current shot ends"""
+        try:
+            path = self.peek_next_file()
+            if path is None:
+                return
+            if self._prefetched_shot is not None and self._prefetched_shot[0] == path:
+                return
+            self._prefetched_shot = (path,) + self.read_shot_devices(path)
+            # And the groups of its devices for their workers:
+            self.shot_broker.read(path, self._device_group_names(path))
+        except Exception:
+            # The shot will be read again, and any error raised, when it is run:
+            self._prefetched_shot = None
+            self._logger.debug('Could not prefetch next shot', exc_info=True)
+
+    def _prepare_upcoming_shots(self):
+        """Ask the devices of the next shots in the queue to prepare their
+        instructions whilst the current shot runs, so that less work remains to be
+        done when they transition to buffered"""
+        if self.prepare_ahead <= 0:
+            return
+        # The shots actually asked to be prepared, so that those skipped now are tried
+        # again next time:
+        requested = {}
+        for path in self._model.head(self.prepare_ahead):
+            if path in self._prepare_requested:
+                requested[path] = self._prepare_requested[path]
+                continue
+            with self._restored_stats_lock:
+                if path in self._restored_stats:
+                    # Not yet checked, it may no longer be valid:
+                    continue
+            try:
+                manifest = get_manifest(path)
+            except Exception:
+                # Any error will be raised when the shot is run:
+                self._logger.debug('Could not read %s to prepare it' % path, exc_info=True)
+                continue
+            requested[path] = []
+            for name in manifest.device_names:
+                tab = self.BLACS.tablist.get(name)
+                if tab is not None and hasattr(tab, 'prepare_buffered'):
+                    inmain_later(
+                        tab.prepare_buffered, path, manifest.device_digests.get(name)
+                    )
+                    requested[path].append(name)
+        # Shots no longer coming up have either been run, in which case their
+        # instructions were used, or been removed from the queue. Either way, anything
+        # prepared for them is of no further use:
+        cancelled = defaultdict(list)
+        for path, names in self._prepare_requested.items():
+            if path not in requested:
+                for name in names:
+                    cancelled[name].append(path)
+        for name, paths in cancelled.items():
+            tab = self.BLACS.tablist.get(name)
+            if tab is not None and hasattr(tab, 'cancel_prepared_buffers'):
+                inmain_later(tab.cancel_prepared_buffers, paths)
+        self._prepare_requested = requested
+
+    def _start_pipelined_shot(self):
+        """Take the next file off the queue and return a PipelinedShot for it, ready
+        to have its devices transitioned to buffered as they become free. Return
+        None if there is no next shot or it cannot be pipelined."""
+        if self.manager_paused:
+            return None
+        path = self.peek_next_file()
+        if path is None:
+            return None
+        with self._restored_stats_lock:
+            if path in self._restored_stats:
+                # Not yet checked, leave it to be validated and run in the usual way:
+                return None
+        try:
+            if self._prefetched_shot is not None and self._prefetched_shot[0] == path:
+                _, devices_in_use, start_order, stop_order = self._prefetched_shot
+            else:
+                devices_in_use, start_order, stop_order = self.read_shot_devices(path)
+        except Exception:
+            # Leave it in the queue to be run, and fail, in the usual way:
+            self._logger.debug('Could not read next shot for pipelining', exc_info=True)
+            return None
+        finally:
+            self._prefetched_shot = None
+        if not self.take_file_if_next(path):
+            # The queue changed underneath us, don't pipeline:
+            return None
+        for callback in plugins.get_callbacks('pre_transition_to_buffered'):
+            try:
+                callback(path)
+            except Exception:
+                self._logger.exception("Plugin callback raised an exception")
+        return PipelinedShot(path, devices_in_use, start_order, stop_order)
+
+    def _advance_pipelined_shot(self, shot, busy, restart_function):
+        """Transition to buffered as many devices of the pipelined shot as allowed.
+        Devices in busy are still in use by the current shot, and a start group may
+        only begin once all devices in earlier groups are in buffered mode."""
+        while not (shot.error_condition or shot.aborted):
+            if not shot.pending and not shot.transition_list:
+                if not shot.start_groups:
+                    return
+                shot.pending = shot.start_groups.pop(min(shot.start_groups))
+            for name in sorted(shot.pending - busy):
+                shot.pending.discard(name)
+                shot.started.add(name)
+                try:
+                    success = self.transition_device_to_buffered(
+                        name, shot.transition_list, shot.path, restart_function
+                    )
+                except Exception:
+                    self._logger.exception(
+                        'Exception while transitioning %s to buffered mode.' % name
+                    )
+                    success = False
+                if not success:
+                    self._logger.error('%s has an error condition, aborting run' % name)
+                    shot.error_condition = True
+                    return
+            if shot.pending or shot.transition_list:
+                # Waiting on busy devices or on devices still transitioning:
+                return
+
+    def _pipelined_shot_response(self, shot, name, result):
+        """Process a message from a device transitioning to buffered for the
+        pipelined shot"""
+        if result in ('fail', 'restart'):
+            self._logger.info('%s reported %s during pipelined transition to buffered' % (name, result))
+            shot.error_condition = True
+        elif self.get_device_error_state(name, shot.transition_list):
+            self._logger.error('%s has an error condition, aborting run' % name)
+            shot.error_condition = True
+        else:
+            self._logger.debug('%s finished transitioning to buffered mode' % name)
+        del shot.transition_list[name]
+
+    def _abort_pipelined_shot(self, shot, restart_function):
+        """Return the devices of a pipelined shot to manual mode and, unless the user
+        aborted it, put the shot back at the top of the queue"""
+        for name in shot.started:
+            tab = shot.devices_in_use[name]
+            inmain_later(tab.abort_buffered, self.current_queue)
+            tab.disconnect_restart_receiver(restart_function)
+        if not shot.aborted:
+            self.prepend(shot.path)
+        # As for any other shot that pre_transition_to_buffered was called for:
+        for callback in plugins.get_callbacks('science_over'):
+            try:
+                callback(shot.path)
+            except Exception:
+                self._logger.exception("Plugin callback raised an exception")
+
+    def _write_front_panel_snapshot(self, path, front_panel_data, run_time):
+        """Save the front panel values, once they have been read in the main thread,
+        to the shot file, create its data group, and stamp it with the run time. Run
+        in a background thread whilst the shot runs."""
+        states,tab_positions,window_data,plugin_data = get_inmain_result(front_panel_data)
+        with h5py.File(path,'r+') as hdf5_file:
+            self.BLACS.front_panel_settings.store_front_panel_in_h5(
+                hdf5_file,states,tab_positions,window_data,plugin_data,save_conn_table=False, save_queue_data=False, shot_file=True,
+                deduplicate=self.deduplicate_front_panel,
+            )
+
+            data_group = hdf5_file['/'].create_group('data')
+            # stamp with the run time of the experiment
+            hdf5_file.attrs['run time'] = run_time.strftime('%Y%m%dT%H%M%S.%f')
+
+    def _remove_front_panel_snapshot(self, path, snapshot):
+        """Wait for _write_front_panel_snapshot() to finish and remove what it wrote
+        to the shot file, for a shot that did not complete"""
+        try:
+            snapshot.result()
+        except Exception:
+            # Whatever was written will be removed:
+            self._logger.exception('Error saving front panel to %s' % path)
+        with h5py.File(path, 'r+') as hdf5_file:
+            for name in ['front_panel', 'data']:
+                if name in hdf5_file:
+                    del hdf5_file[name]
+            if 'run time' in hdf5_file.attrs:
+                del hdf5_file.attrs['run time']
+
     def transition_device_to_buffered(self, name, transition_list, h5file, restart_receiver):
         tab = self.BLACS.tablist[name]
         if self.get_device_error_state(name,self.BLACS.tablist):
             return False
         tab.connect_restart_receiver(restart_receiver)
-        tab.transition_to_buffered(h5file,self.current_queue)
+        kwargs = {}
+        if self._tab_accepts(tab, 'device_digest'):
+            # So that the tab can tell its workers if the device's instructions are
+            # the same as in the last shot it ran:
+            try:
+                kwargs['device_digest'] = get_manifest(h5file).device_digests.get(name)
+            except Exception:
+                self._logger.debug('Could not get digest of %s in %s' % (name, h5file), exc_info=True)
+        if self._wants_device_group(name):
+            # Read the groups of all devices in the shot that want them whilst the
+            # file is open:
+            try:
+                kwargs['device_group'] = self.shot_broker.get(
+                    h5file, name, self._device_group_names(h5file)
+                )
+            except Exception:
+                # The workers will read the shot file themselves:
+                self._logger.debug('Could not read group of %s in %s' % (name, h5file), exc_info=True)
+        # Queued in the main thread without waiting for it. The tab will notify
+        # self.current_queue when done:
+        inmain_later(tab.transition_to_buffered, h5file, self.current_queue, **kwargs)
         transition_list[name] = tab
         return True
     
-    @inmain_decorator(wait_for_return=True)
+    @staticmethod
+    def _tab_accepts(tab, parameter):
+        # Tabs that override transition_to_buffered() may not accept our optional
+        # keyword arguments:
+        try:
+            parameters = inspect.signature(tab.transition_to_buffered).parameters
+        except (TypeError, ValueError):
+            return False
+        return parameter in parameters
+
+    def _wants_device_group(self, name):
+        """Whether the workers of a device want its group in the shot file read for
+        them, rather than reading the shot file themselves"""
+        tab = self.BLACS.tablist.get(name)
+        return (
+            tab is not None
+            and self._tab_accepts(tab, 'device_group')
+            and tab.workers_accept('device_group')
+        )
+
+    def _device_group_names(self, path):
+        """The devices in a shot whose groups are to be read for their workers"""
+        return [name for name in get_manifest(path).device_names if self._wants_device_group(name)]
+
+    def _log_event_latencies(self, logger):
+        """Log the latencies of the events handled for the last shot, and of those
+        among them that were previously polled for, compared with polling"""
+        if not self.last_shot_event_latencies:
+            return
+        latencies = [latency for _, latency in self.last_shot_event_latencies]
+        logger.debug(
+            'Handled %d events, max latency %.3fms, total %.3fms'
+            % (len(latencies), 1e3 * max(latencies), 1e3 * sum(latencies))
+        )
+        polled = [
+            (latency, POLLED_EVENT_LATENCIES[message])
+            for message, latency in self.last_shot_event_latencies
+            if message in POLLED_EVENT_LATENCIES
+        ]
+        if polled:
+            # Polling would have taken half the polling interval on average:
+            logger.debug(
+                '%d events previously polled for took %.3fms in total, '
+                'compared with %.0fms on average and up to %.0fms when polling'
+                % (
+                    len(polled),
+                    1e3 * sum(latency for latency, _ in polled),
+                    1e3 * sum(interval for _, interval in polled) / 2,
+                    1e3 * sum(interval for _, interval in polled),
+                )
+            )
+
     def get_device_error_state(self,name,device_list):
         return device_list[name].error_message
        
@@ -512,55 +1398,74 @@ class QueueManager(object):
         # imported. So we'll silence them in this thread too:
         h5py._errors.silence_errors()
         
-        # This name stores the queue currently being used to
+        # self.current_queue stores the queue currently being used to
         # communicate with tabs, so that abort signals can be put
         # to it when those tabs never respond and are restarted by
-        # the user.
-        self.current_queue = queue.Queue()
+        # the user. It is the only thing this thread blocks on: all
+        # events, including new files and unpausing, are posted to it.
 
         #TODO: put in general configuration
         timeout_limit = 300 #seconds
+        # How often to check for devices in an error state whilst waiting for events:
+        error_check_interval = 2 #seconds
         self.set_status("Idle")
-        
-        while self.manager_running:
-            # If the pause button is pushed in, sleep
-            if self.manager_paused:
-                if self.get_status() == "Idle":
-                    logger.info('Paused')
-                    self.set_status("Queue paused") 
-                time.sleep(1)
-                continue
-            
-            # Get the top file
+
+        # Function to be run when abort button is clicked
+        def abort_function():
             try:
-                path = self.get_next_file()
-                self.set_status('Preparing shot...', path)
-                logger.info('Got a file: %s'%path)
+                self.current_queue.put([QUEUE_MANAGER, 'abort'])
             except Exception:
-                # If no files, sleep for 1s,
-                self.set_status("Idle")
-                time.sleep(1)
-                continue
+                logger.exception('Could not send abort message to the queue manager')
+
+        def restart_function(device_name):
+            try:
+                self.current_queue.put([device_name, 'restart'])
+            except Exception:
+                logger.exception('Could not send restart message to the queue manager for device %s'%device_name)
+
+        # In pipelined mode, the next shot whose devices began transitioning to
+        # buffered whilst the previous shot was transitioning to manual:
+        pipelined_shot = None
+
+        while self.manager_running:
+            if pipelined_shot is not None:
+                # Carry on with the shot already in progress, keeping the same
+                # current_queue on which its devices are reporting:
+                path = pipelined_shot.path
+                self.set_status('Preparing shot...', path)
+                logger.info('Continuing pipelined file: %s'%path)
+            else:
+                # A fresh queue for this shot. This is done before checking for a
+                # file to run, so that a wakeup posted after the check is not
+                # missed:
+                self.current_queue = EventQueue(self._event_latencies)
+
+                # If the pause button is pushed in, wait until it is released:
+                if self.manager_paused:
+                    if self.get_status() == "Idle":
+                        logger.info('Paused')
+                        self.set_status("Queue paused") 
+                    self.current_queue.get()
+                    continue
             
+                # Get the top file
+                try:
+                    path = self.get_next_file()
+                    self.set_status('Preparing shot...', path)
+                    logger.info('Got a file: %s'%path)
+                except Exception:
+                    # If no files, wait until one is added:
+                    self.set_status("Idle")
+                    self.current_queue.get()
+                    continue
+                # Files restored from the journal at startup may need validating:
+                path = self._check_restored_file(path)
+                if path is None:
+                    continue
+
             devices_in_use = {}
             transition_list = {}   
-            self.current_queue = queue.Queue()
 
-            # Function to be run when abort button is clicked
-            def abort_function():
-                try:
-                    # Set device name to "Queue Manager" which will never be a labscript device name
-                    # as it is not a valid python variable name (has a space in it!)
-                    self.current_queue.put(['Queue Manager', 'abort'])
-                except Exception:
-                    logger.exception('Could not send abort message to the queue manager')
-        
-            def restart_function(device_name):
-                try:
-                    self.current_queue.put([device_name, 'restart'])
-                except Exception:
-                    logger.exception('Could not send restart message to the queue manager for device %s'%device_name)
-        
             ##########################################################################################################################################
             #                                                       transition to buffered                                                           #
             ########################################################################################################################################## 
@@ -572,41 +1477,45 @@ class QueueManager(object):
                 error_condition = False
                 abort = False
                 restarted = False
+                # Writing of the front panel to the shot file, once the run has begun:
+                snapshot = None
                 self.set_status("Transitioning to buffered...", path)
                 
                 # Enable abort button, and link in current_queue:
-                inmain(self._ui.queue_abort_button.clicked.connect,abort_function)
-                inmain(self._ui.queue_abort_button.setEnabled,True)
-                                
-                ##########################################################################################################################################
-                #                                                        Plugin callbacks                                                                #
-                ########################################################################################################################################## 
-                for callback in plugins.get_callbacks('pre_transition_to_buffered'):
-                    try:
-                        callback(path)
-                    except Exception:
-                        logger.exception("Plugin callback raised an exception")
+                self._enable_abort_button(abort_function)
 
-                start_time = time.time()
-                
-                with h5py.File(path, 'r') as hdf5_file:
-                    devices_in_use = {}
-                    start_order = {}
-                    stop_order = {}
-                    for name in  hdf5_file['devices']:
-                        device_properties = labscript_utils.properties.get(
-                            hdf5_file, name, 'device_properties'
-                        )
-                        devices_in_use[name] = self.BLACS.tablist[name]
-                        start_order[name] = device_properties.get('start_order', None)
-                        stop_order[name] = device_properties.get('stop_order', None)
-
-                # Sort the devices into groups based on their start_order and stop_order
-                start_groups = defaultdict(set)
-                stop_groups = defaultdict(set)
-                for name in devices_in_use:
-                    start_groups[start_order[name]].add(name)
-                    stop_groups[stop_order[name]].add(name)
+                if pipelined_shot is not None:
+                    # Plugin callbacks were already run and some devices are
+                    # already transitioning, or have transitioned, to buffered. The
+                    # time taken to program is counted from now, not including the
+                    # previous shot's transition to manual:
+                    start_time = time.time()
+                    devices_in_use = pipelined_shot.devices_in_use
+                    start_groups = pipelined_shot.start_groups
+                    stop_groups = pipelined_shot.stop_groups
+                    transition_list = pipelined_shot.transition_list
+                    error_condition = pipelined_shot.error_condition
+                    pipelined_shot = None
+                else:
+                    ##########################################################################################################################################
+                    #                                                        Plugin callbacks                                                                #
+                    ########################################################################################################################################## 
+                    for callback in plugins.get_callbacks('pre_transition_to_buffered'):
+                        try:
+                            callback(path)
+                        except Exception:
+                            logger.exception("Plugin callback raised an exception")
+
+                    start_time = time.time()
+                    
+                    devices_in_use, start_order, stop_order = self.read_shot_devices(path)
+
+                    # Sort the devices into groups based on their start_order and stop_order
+                    start_groups = defaultdict(set)
+                    stop_groups = defaultdict(set)
+                    for name in devices_in_use:
+                        start_groups[start_order[name]].add(name)
+                        stop_groups[stop_order[name]].add(name)
 
                 while (transition_list or start_groups) and not error_condition:
                     if not transition_list:
@@ -629,14 +1538,17 @@ class QueueManager(object):
                     try:
                         # Wait for a device to transtition_to_buffered:
                         logger.debug('Waiting for the following devices to finish transitioning to buffered mode: %s'%str(transition_list))
-                        device_name, result = self.current_queue.get(timeout=2)
+                        device_name, result = self.current_queue.get(timeout=error_check_interval)
                         
                         #Handle abort button signal
-                        if device_name == 'Queue Manager' and result == 'abort':
+                        if device_name == QUEUE_MANAGER and result == 'abort':
                             # we should abort the run
                             logger.info('abort signal received from GUI')
                             abort = True
                             break
+                        elif device_name == QUEUE_MANAGER:
+                            # Not relevant whilst a shot is in progress:
+                            continue
                             
                         if result == 'fail':
                             logger.info('abort signal received during transition to buffered of %s' % device_name)
@@ -657,8 +1569,8 @@ class QueueManager(object):
 
                         del transition_list[device_name]
                     except queue.Empty:
-                        # It's been 2 seconds without a device finishing
-                        # transitioning to buffered. Is there an error?
+                        # It's been error_check_interval seconds without a device
+                        # finishing transitioning to buffered. Is there an error?
                         for name in transition_list:
                             if self.get_device_error_state(name,transition_list):
                                 error_condition = True
@@ -691,21 +1603,20 @@ class QueueManager(object):
                         
                     # Abort the run for all devices in use:
                     # need to recreate the queue here because we don't want to hear from devices that are still transitioning to buffered mode
-                    self.current_queue = queue.Queue()
+                    self.current_queue = EventQueue(self._event_latencies)
                     for tab in devices_in_use.values():                        
                         # We call abort buffered here, because if each tab is either in mode=BUFFERED or transition_to_buffered failed in which case
                         # it should have called abort_transition_to_buffered itself and returned to manual mode
                         # Since abort buffered will only run in mode=BUFFERED, and the state is not queued indefinitely (aka it is deleted if we are not in mode=BUFFERED)
                         # this is the correct method call to make for either case
-                        tab.abort_buffered(self.current_queue)
+                        inmain_later(tab.abort_buffered, self.current_queue)
                         # We don't need to check the results of this function call because it will either be successful, or raise a visible error in the tab.
                         
                         # disconnect restart signal from tabs
-                        inmain(tab.disconnect_restart_receiver,restart_function)
+                        tab.disconnect_restart_receiver(restart_function)
                         
                     # disconnect abort button and disable
-                    inmain(self._ui.queue_abort_button.clicked.disconnect,abort_function)
-                    inmain(self._ui.queue_abort_button.setEnabled,False)
+                    self._disable_abort_button(abort_function)
                     
                     # Start a new iteration
                     continue
@@ -716,14 +1627,17 @@ class QueueManager(object):
                 #                                                             SCIENCE!                                                                   #
                 ##########################################################################################################################################
             
-                # Get front panel data, but don't save it to the h5 file until the experiment ends:
-                states,tab_positions,window_data,plugin_data = self.BLACS.front_panel_settings.get_save_data()
+                # Get front panel data. This is requested from the main thread without
+                # waiting for it, and written to the shot file in a background thread
+                # whilst the experiment runs:
+                front_panel_data = inmain_later(self.BLACS.front_panel_settings.get_save_data)
                 self.set_status("Running (program time: %.3fs)..."%(time.time() - start_time), path)
                     
-                # A Queue for event-based notification of when the experiment has finished.
-                experiment_finished_queue = queue.Queue()
                 logger.debug('About to start the master pseudoclock')
                 run_time = datetime.datetime.now()
+                snapshot = self._shot_writer.submit(
+                    self._write_front_panel_snapshot, path, front_panel_data, run_time
+                )
 
                 ##########################################################################################################################################
                 #                                                        Plugin callbacks                                                                #
@@ -735,7 +1649,16 @@ class QueueManager(object):
                         logger.exception("Plugin callback raised an exception")
 
                 #TODO: fix potential race condition if BLACS is closing when this line executes?
-                self.BLACS.tablist[self.master_pseudoclock].start_run(experiment_finished_queue)
+                inmain_later(
+                    self.BLACS.tablist[self.master_pseudoclock].start_run,
+                    EventForwarder(self.current_queue, MASTER_PSEUDOCLOCK),
+                )
+
+                if self.pipelined:
+                    # Read the next shot whilst this one runs, so it is ready to
+                    # be started as soon as devices are free:
+                    self._prefetch_next_shot()
+                self._prepare_upcoming_shots()
                 
                                                 
                 # Wait for notification of the end of run:
@@ -744,33 +1667,36 @@ class QueueManager(object):
                 done = False
                 while not (abort or restarted or done):
                     try:
-                        done = experiment_finished_queue.get(timeout=0.5) == 'done'
-                    except queue.Empty:
-                        pass
-                    try:
-                        # Poll self.current_queue for abort signal from button or device restart
-                        device_name, result = self.current_queue.get_nowait()
-                        if (device_name == 'Queue Manager' and result == 'abort'):
+                        # Wait for the end of the run, an abort signal from the
+                        # button, or a device restart:
+                        device_name, result = self.current_queue.get(timeout=error_check_interval)
+                        if device_name == MASTER_PSEUDOCLOCK:
+                            done = result == 'done'
+                        elif device_name == QUEUE_MANAGER and result == 'abort':
                             abort = True
-                        if result == 'restart':
+                        elif result == 'restart':
                             restarted = True
+                    except queue.Empty:
+                        pass
+                    if not done:
                         # Check for error states in tabs
                         for device_name, tab in devices_in_use.items():
                             if self.get_device_error_state(device_name,devices_in_use):
                                 restarted = True
-                    except queue.Empty:
-                        pass
                         
                 if abort or restarted:
                     for devicename, tab in devices_in_use.items():
                         if tab.mode == MODE_BUFFERED:
-                            tab.abort_buffered(self.current_queue)
+                            inmain_later(tab.abort_buffered, self.current_queue)
                         # disconnect restart signal from tabs 
-                        inmain(tab.disconnect_restart_receiver,restart_function)
+                        tab.disconnect_restart_receiver(restart_function)
+                    # Undo writing the front panel to the shot file, so that it can be
+                    # run again:
+                    self._remove_front_panel_snapshot(path, snapshot)
+                    snapshot = None
                                             
                 # Disable abort button
-                inmain(self._ui.queue_abort_button.clicked.disconnect,abort_function)
-                inmain(self._ui.queue_abort_button.setEnabled,False)
+                self._disable_abort_button(abort_function)
                 
                 if restarted:                    
                     self.manager_paused = True
@@ -793,9 +1719,11 @@ class QueueManager(object):
                 zprocess.raise_exception_in_thread(sys.exc_info())
                 # clean up the h5 file
                 self.manager_paused = True
+                if snapshot is not None:
+                    # Don't clean the file whilst the front panel is being written to it:
+                    concurrent.futures.wait([snapshot])
                 # is this a repeat?
-                with h5py.File(path, 'r') as h5_file:
-                    repeat_number = h5_file.attrs.get('run repeat', 0)
+                repeat_number = get_manifest(path).run_repeat
                 # clean the h5 file:
                 temp_path = tempfilename()
                 self.clean_h5_file(path, temp_path, repeat_number=repeat_number)
@@ -812,17 +1740,16 @@ class QueueManager(object):
                 self.prepend(path)
                 
                 # Need to put devices back in manual mode
-                self.current_queue = queue.Queue()
+                self.current_queue = EventQueue(self._event_latencies)
                 for devicename, tab in devices_in_use.items():
                     if tab.mode == MODE_BUFFERED or tab.mode == MODE_TRANSITION_TO_BUFFERED:
-                        tab.abort_buffered(self.current_queue)
+                        inmain_later(tab.abort_buffered, self.current_queue)
                     # disconnect restart signal from tabs 
-                    inmain(tab.disconnect_restart_receiver,restart_function)
+                    tab.disconnect_restart_receiver(restart_function)
                 self.set_status("Error in queue manager\nQueue paused")
 
                 # disconnect and disable abort button
-                inmain(self._ui.queue_abort_button.clicked.disconnect,abort_function)
-                inmain(self._ui.queue_abort_button.setEnabled,False)
+                self._disable_abort_button(abort_function)
                 
                 # Start a new iteration
                 continue
@@ -846,15 +1773,24 @@ class QueueManager(object):
             ##########################################################################################################################################
             # start new try/except block here                   
             try:
-                with h5py.File(path,'r+') as hdf5_file:
-                    self.BLACS.front_panel_settings.store_front_panel_in_h5(hdf5_file,states,tab_positions,window_data,plugin_data,save_conn_table=False, save_queue_data=False)
-
-                    data_group = hdf5_file['/'].create_group('data')
-                    # stamp with the run time of the experiment
-                    hdf5_file.attrs['run time'] = run_time.strftime('%Y%m%dT%H%M%S.%f')
+                # The front panel and data group must be in the file before devices
+                # save their data to it. This was almost certainly done during the run,
+                # re-raise any exception from doing so:
+                snapshot.result()
         
                 error_condition = False
                 response_list = {}
+                # Devices that have not yet finished transitioning to manual mode:
+                busy = set(devices_in_use)
+                if self.pipelined:
+                    # Begin the next shot, starting with devices not in use in this
+                    # one. Others follow as they finish transitioning to manual:
+                    pipelined_shot = self._start_pipelined_shot()
+                    if pipelined_shot is not None:
+                        logger.info('Pipelining next shot: %s' % pipelined_shot.path)
+                        # The next shot may be aborted whilst this one finishes:
+                        self._enable_abort_button(abort_function)
+                        self._advance_pipelined_shot(pipelined_shot, busy, restart_function)
                 # Keep transitioning tabs to manual mode and waiting on them until they
                 # are all done or have all errored/restarted/failed. If one fails, we
                 # still have to transition the rest to manual mode:
@@ -864,7 +1800,7 @@ class QueueManager(object):
                     for name in stop_groups.pop(min(stop_groups)):
                         tab = devices_in_use[name]
                         try:
-                            tab.transition_to_manual(self.current_queue)
+                            inmain_later(tab.transition_to_manual, self.current_queue)
                             transition_list[name] = tab
                         except Exception:
                             logger.exception('Exception while transitioning %s to manual mode.'%(name))
@@ -873,14 +1809,39 @@ class QueueManager(object):
                     while transition_list:
                         logger.info('Waiting for the following devices to finish transitioning to manual mode: %s'%str(transition_list))
                         try:
-                            name, result = self.current_queue.get(2)
-                            if name == 'Queue Manager' and result == 'abort':
-                                # Ignore any abort signals left in the queue, it is too
-                                # late to abort in any case:
+                            name, result = self.current_queue.get(timeout=error_check_interval)
+                            if name == QUEUE_MANAGER:
+                                if result == 'abort' and pipelined_shot is not None:
+                                    # It is too late to abort this shot, but not the
+                                    # next one:
+                                    logger.info('abort signal received for pipelined shot')
+                                    pipelined_shot.aborted = True
+                                # Otherwise ignore any abort signals left in the
+                                # queue, it is too late to abort in any case:
+                                continue
+                            if name not in transition_list:
+                                if pipelined_shot is not None and name in pipelined_shot.transition_list:
+                                    # A device reporting on the next shot:
+                                    self._pipelined_shot_response(pipelined_shot, name, result)
+                                    self._advance_pipelined_shot(pipelined_shot, busy, restart_function)
+                                elif (
+                                    pipelined_shot is not None
+                                    and name in pipelined_shot.started
+                                    and result in ('fail', 'restart')
+                                ):
+                                    # A device already in buffered mode for the next
+                                    # shot is no longer ready to run it:
+                                    logger.info('%s reported %s after pipelined transition to buffered' % (name, result))
+                                    pipelined_shot.error_condition = True
+                                else:
+                                    # Nothing we are waiting on, for example a device
+                                    # in a later stop group restarting, whose
+                                    # transition to manual will report the error:
+                                    logger.debug('Ignoring %s from %s, not waiting on it' % (result, name))
                                 continue
                         except queue.Empty:
-                            # 2 seconds without a device transitioning to manual mode.
-                            # Is there an error:
+                            # error_check_interval seconds without a device transitioning
+                            # to manual mode. Is there an error:
                             for name in transition_list.copy():
                                 if self.get_device_error_state(name, transition_list):
                                     error_condition = True
@@ -902,11 +1863,19 @@ class QueueManager(object):
                         # Once device has transitioned_to_manual, disconnect restart
                         # signal:
                         tab = devices_in_use[name]
-                        inmain(tab.disconnect_restart_receiver, restart_function)
+                        tab.disconnect_restart_receiver(restart_function)
                         del transition_list[name]
+                        if pipelined_shot is not None and not error_condition:
+                            # The device is free for the next shot:
+                            busy.discard(name)
+                            self._advance_pipelined_shot(pipelined_shot, busy, restart_function)
                     
                 if error_condition:                
                     self.set_status("Error in transtion to manual\nQueue Paused")
+                elif pipelined_shot is not None and not pipelined_shot.aborted:
+                    # All devices are free, start the rest of the next shot's current
+                    # start group:
+                    self._advance_pipelined_shot(pipelined_shot, set(), restart_function)
                                        
             except Exception:
                 error_condition = True
@@ -916,12 +1885,20 @@ class QueueManager(object):
                 # Raise the error in a thread for visibility
                 zprocess.raise_exception_in_thread(sys.exc_info())
                 
+            if pipelined_shot is not None:
+                # Enabled again if the shot continues:
+                self._disable_abort_button(abort_function)
+                if error_condition or pipelined_shot.aborted:
+                    # Abort the next shot. Unless the user aborted it, it will be put
+                    # back in the queue behind this one:
+                    self._abort_pipelined_shot(pipelined_shot, restart_function)
+                    pipelined_shot = None
+
             if error_condition:                
                 # clean up the h5 file
                 self.manager_paused = True
                 # is this a repeat?
-                with h5py.File(path, 'r') as h5_file:
-                    repeat_number = h5_file.attrs.get('run repeat', 0)
+                repeat_number = get_manifest(path).run_repeat
                 # clean the h5 file:
                 temp_path = tempfilename()
                 self.clean_h5_file(path, temp_path, repeat_number=repeat_number)
@@ -966,6 +1943,8 @@ class QueueManager(object):
                     callback(path)
                 except Exception:
                     logger.exception("Plugin callback raised an exception")
+            # Plugins are done with the shot's manifest:
+            discard_manifest(path)
 
             ##########################################################################################################################################
             #                                                        Repeat Experiment?                                                              #
@@ -982,14 +1961,20 @@ class QueueManager(object):
 
             if repeat_shot:
                 if ((self.manager_repeat_mode == self.REPEAT_ALL) or
-                    (self.manager_repeat_mode == self.REPEAT_LAST and inmain(self._model.rowCount) == 0)):
+                    (self.manager_repeat_mode == self.REPEAT_LAST and len(self._model) == 0
+                     and pipelined_shot is None)):
                     # Resubmit job to the bottom of the queue:
                     try:
                         message = self.process_request(path)
                     except Exception:
                         # TODO: make this error popup for the user
                         self._logger.exception('Failed to copy h5_file (%s) for repeat run'%s)
-                    logger.info(message)      
+                    logger.info(message)
+
+            # Record how long events for this shot waited before being handled:
+            self.last_shot_event_latencies = self._event_latencies[:]
+            del self._event_latencies[:]
+            self._log_event_latencies(logger)
 
             self.set_status("Idle")
         logger.info('Stopping')
@@ -12,6 +12,8 @@
 #####################################################################
 import os
 import logging
+import threading
+import hashlib
 
 from qtutils.qt.QtCore import *
 from qtutils.qt.QtGui import *
@@ -23,6 +25,9 @@ import labscript_utils.h5_lock, h5py
 from qtutils import *
 
 from labscript_utils.connections import ConnectionTable
+from labscript_utils.shared_drive import path_to_agnostic, path_to_local
+
+from blacs import saved_data
 
 logger = logging.getLogger('BLACS.FrontPanelSettings')
 
@@ -34,6 +39,7 @@ class FrontPanelSettings(object):
     def __init__(self,settings_path,connection_table):
         self.settings_path = settings_path
         self.connection_table = connection_table
+        self._store = None
         with h5py.File(settings_path,'a') as h5file:
             pass
 
@@ -83,42 +89,44 @@ class FrontPanelSettings(object):
             ct_match,error = self.connection_table.compare_to(saved_ct)
 
             with h5py.File(self.settings_path,'r') as hdf5_file:
-                # Get Tab Data
-                dataset = hdf5_file['/front_panel'].get('_notebook_data',[])
+                front_panel_array, tab_array, tab_attrs = read_front_panel_tables(hdf5_file['/front_panel'])
 
-                for row in dataset:
+                # Get Tab Data
+                for row in tab_array:
                     tab_name = _ensure_str(row['tab_name'])
                     tab_data.setdefault(tab_name,{})
                     try:
-                        tab_data[tab_name] = {'notebook':row['notebook'], 'page':row['page'], 'visible':row['visible'], 'data':eval(_ensure_str(row['data']))}
+                        tab_data[tab_name] = {'notebook':row['notebook'], 'page':row['page'], 'visible':row['visible'], 'data':saved_data.loads(_ensure_str(row['data']))}
                     except Exception:
                         logger.info("Could not load tab data for %s"%tab_name)
 
                 #now get dataset attributes
-                tab_data['BLACS settings'] = dict(dataset.attrs)
+                tab_data['BLACS settings'] = tab_attrs
 
                 # Get the front panel values
-                if 'front_panel' in hdf5_file["/front_panel"]:
-                    dataset = hdf5_file["/front_panel"].get('front_panel', [])
-                    for row in dataset:
-                        result = self.check_row(row,ct_match,self.connection_table,saved_ct)
-                        columns = ['name', 'device_name', 'channel', 'base_value', 'locked', 'base_step_size', 'current_units']
-                        data_dict = {}
-                        for i in range(len(row)):
-                            if isinstance(row[i], bytes) or isinstance(row[i], str):
-                                data_dict[columns[i]] = _ensure_str(row[i])
-                            else:
-                                data_dict[columns[i]] = row[i]
-                        settings,question,error = self.handle_return_code(data_dict,result,settings,question,error)
+                if front_panel_array is not None:
+                    rows = front_panel_rows(front_panel_array)
+                    if ct_match:
+                        # Every channel is restored as is:
+                        for row in rows:
+                            settings.setdefault(row['device_name'],{})[row['channel']] = row
+                    else:
+                        blacs_index = ConnectionTableIndex(self.connection_table)
+                        saved_index = ConnectionTableIndex(saved_ct)
+                        for row in rows:
+                            result = self.check_row((row['name'],row['device_name'],row['channel']),ct_match,blacs_index,saved_index)
+                            settings,question,error = self.handle_return_code(row,result,settings,question,error)
 
                 # Else Legacy restore from GTK save data!
                 else:
                     # open Datasets
                     type_list = ["AO", "DO", "DDS"]
+                    blacs_index = ConnectionTableIndex(self.connection_table)
+                    saved_index = ConnectionTableIndex(saved_ct)
                     for key in type_list:
                         dataset = hdf5_file["/front_panel"].get(key, [])
                         for row in dataset:
-                            result = self.check_row(row,ct_match,self.connection_table,saved_ct)
+                            result = self.check_row(row,ct_match,blacs_index,saved_index)
                             columns = ['name', 'device_name', 'channel', 'base_value', 'locked', 'base_step_size', 'current_units']
                             data_dict = {}
                             for i in range(len(row)):
@@ -336,79 +344,409 @@ class FrontPanelSettings(object):
                 # save connection table, save front panel
                 self.store_front_panel_in_h5(hdf5_file,states,tab_positions,window_data,plugin_data,save_conn_table=True)
 
-    @inmain_decorator(wait_for_return=True)
-    def store_front_panel_in_h5(self, hdf5_file,tab_data,notebook_data,window_data,plugin_data,save_conn_table=False,save_queue_data=True):
+    def store_front_panel_in_h5(self, hdf5_file,tab_data,notebook_data,window_data,plugin_data,save_conn_table=False,save_queue_data=True,deduplicate=False,shot_file=False):
         if save_conn_table:
             if 'connection table' in hdf5_file:
                 del hdf5_file['connection table']
             hdf5_file.create_dataset('connection table', data=self.connection_table.raw_table)
 
         data_group = hdf5_file['/'].create_group('front_panel')
-
-        front_panel_list = []
-        other_data_list = []
-        front_panel_dtype = [('name','a256'),('device_name','a256'),('channel','a256'),('base_value',float),('locked',bool),('base_step_size',float),('current_units','a256')]
-        max_od_length = 2 # empty dictionary
-
-        # Iterate over each device within a class
-        for device_name, device_state in tab_data.items():
-            logger.debug("saving front panel for device:" + device_name)
-            # Insert front panel data into dataset
-            for hardware_name, data in device_state["front_panel"].items():
-                if data != {}:
-                    if isinstance(data['base_value'], (str, bytes)):
-                        logger.warning('Could not save data for channel %s on device %s because support for output values that are strings is not yet supported.'%(hardware_name, device_name))
-                        # TODO: Implement saving of Image output type
-                    elif float(data['base_value']) == data['base_value']:
-                        front_panel_list.append((data['name'],
-                                                 device_name,
-                                                 hardware_name,
-                                                 data['base_value'],
-                                                 data['locked'],
-                                                 data['base_step_size'] if 'base_step_size' in data else 0,
-                                                 data['current_units'] if 'current_units' in data else ''
-                                                )
-                                               )
-                    else:
-                        logger.warning('Could not save data for channel %s on device %s because the output value (in base units) was not a string or could not be coerced to a float without loss of precision'%(hardware_name, device_name))
-
-            # Save "other data"
-            od = repr(device_state["save_data"])
-            other_data_list.append(od)
-            max_od_length = len(od) if len(od) > max_od_length else max_od_length
-
-        # Create datasets
-        if front_panel_list:
-            front_panel_array = numpy.empty(len(front_panel_list),dtype=front_panel_dtype)
-            for i, row in enumerate(front_panel_list):
-                front_panel_array[i] = row
-            data_group.create_dataset('front_panel',data=front_panel_array)
-
-        # Save tab data
-        i = 0
-        tab_data = numpy.empty(len(notebook_data),dtype=[('tab_name','a256'),('notebook','a2'),('page',int),('visible',bool),('data','a'+str(max_od_length))])
-        for device_name,data in notebook_data.items():
-            tab_data[i] = (device_name,data["notebook"],data["page"],data["visible"],other_data_list[i])
-            i += 1
-
-        # Save BLACS Main GUI Info
-        dataset = data_group.create_dataset("_notebook_data",data=tab_data)
-        dataset.attrs["window_width"] = window_data["_main_window"]["width"]
-        dataset.attrs["window_height"] = window_data["_main_window"]["height"]
-        dataset.attrs["window_xpos"] = window_data["_main_window"]["xpos"]
-        dataset.attrs["window_ypos"] = window_data["_main_window"]["ypos"]
-        dataset.attrs["window_maximized"] = window_data["_main_window"]["maximized"]
-        dataset.attrs["window_frame_height"] = window_data["_main_window"]["frame_height"]
-        dataset.attrs["window_frame_width"] = window_data["_main_window"]["frame_width"]
-        dataset.attrs['plugin_data'] = repr(plugin_data)
-        dataset.attrs['analysis_data'] = repr(window_data["_main_window"]["_analysis"])
-        if save_queue_data:
-            dataset.attrs['queue_data'] = repr(window_data["_main_window"]["_queue"])
-        for pane_name,pane_position in window_data.items():
-            if pane_name != "_main_window":
-                dataset.attrs[pane_name] = pane_position
-
-        # Save analysis server settings:
-        #dataset = data_group.create_group("analysis_server")
-        #dataset.attrs['send_for_analysis'] = self.blacs.analysis_submission.toggle_analysis.get_active()
-        #dataset.attrs['server'] = self.blacs.analysis_submission.analysis_host.get_text()
+        tables = build_front_panel_tables(tab_data,notebook_data,window_data,plugin_data,save_queue_data,shot_file)
+        if deduplicate:
+            self.store.store_deduplicated(data_group, *tables)
+        else:
+            write_front_panel_tables(data_group, *tables)
+
+    def update_settings_file(self, tables, previous_tables=None):
+        """Write tables returned by build_front_panel_tables() to the settings file.
+        If previous_tables, the tables last written to it, are given, only the tables
+        and attributes that differ from them are rewritten. Otherwise the connection
+        table and front panel are replaced, as when saving on exit. Unlike
+        save_front_panel_to_h5(), this does not need to run in the main thread."""
+        with h5py.File(self.settings_path,'r+') as hdf5_file:
+            if previous_tables is None or 'front_panel' not in hdf5_file:
+                if 'front_panel' in hdf5_file:
+                    del hdf5_file['front_panel']
+                if 'connection table' in hdf5_file:
+                    del hdf5_file['connection table']
+                hdf5_file.create_dataset('connection table', data=self.connection_table.raw_table)
+                write_front_panel_tables(hdf5_file.create_group('front_panel'), *tables)
+            else:
+                update_front_panel_tables(hdf5_file['front_panel'], previous_tables, tables)
+
+    @property
+    def store(self):
+        """The FrontPanelStore in which front panels of shots are saved when
+        deduplicating them, created when first needed"""
+        if self._store is None:
+            exp_config = self.blacs.exp_config
+            path = exp_config.get(
+                'BLACS/front_panel',
+                'store_path',
+                fallback=os.path.splitext(self.settings_path)[0] + '_front_panel_store.h5',
+            )
+            max_megabytes = exp_config.getfloat(
+                'BLACS/front_panel', 'store_max_megabytes', fallback=100
+            )
+            self._store = FrontPanelStore(path, max_bytes=int(max_megabytes * 1e6))
+        return self._store
+
+
+# The version of the layout written by write_front_panel_tables(). In version 1,
+# which has no format_version attribute, string columns are 256 characters wide and
+# datasets are not compressed. Version 2 narrows string columns to their longest
+# value and compresses datasets. The dtypes of the tables are otherwise unchanged:
+FRONT_PANEL_FORMAT_VERSION = 2
+
+# Tab save data only saved to the settings file, and not to shot files. The programmed
+# state changes with every shot, so would otherwise stop shot files sharing front panel
+# tables in the store:
+SETTINGS_FILE_ONLY_SAVE_DATA = ('_programmed_state',)
+
+# The dtype of the table of front panel values:
+front_panel_dtype = [('name','a256'),('device_name','a256'),('channel','a256'),('base_value',float),('locked',bool),('base_step_size',float),('current_units','a256')]
+
+
+def front_panel_rows(front_panel_array):
+    """Return the rows of a front panel table as dictionaries of Python values, keyed
+    by column name. Each column is converted as a whole, rather than element by
+    element."""
+    columns = []
+    for name in front_panel_array.dtype.names:
+        values = front_panel_array[name].tolist()
+        if front_panel_array.dtype[name].kind in 'SU':
+            values = [_ensure_str(value) for value in values]
+        columns.append(values)
+    names = front_panel_array.dtype.names
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+class ConnectionTableIndex(object):
+    """Lookups of connections by name and by (parent name, parent port), built once
+    from a ConnectionTable. Provides the find_by_name() and find_child() methods of a
+    ConnectionTable, with the same results, but without searching the table on each
+    call."""
+    def __init__(self, connection_table):
+        self.by_name = {}
+        self.by_port = {}
+        # Connections reachable from the top level devices, as searched by
+        # ConnectionTable.find_by_name():
+        stack = list(connection_table.toplevel_children.items())[::-1]
+        while stack:
+            name, connection = stack.pop()
+            self.by_name.setdefault(name, connection)
+            stack.extend(list(connection.child_list.items())[::-1])
+        for connection in connection_table.table.values():
+            key = (connection.parent_name, connection.parent_port)
+            self.by_port.setdefault(key, connection)
+
+    def find_by_name(self, name):
+        return self.by_name.get(_ensure_str(name))
+
+    def find_child(self, parent_name, parent_port):
+        return self.by_port.get((parent_name, parent_port))
+
+
+def build_front_panel_tables(tab_data,notebook_data,window_data,plugin_data,save_queue_data=True,shot_file=False):
+    """Return the table of front panel values (or None if there are none), the table
+    of tab data, and the attributes of the tab data table, for saving to a h5 file
+    with write_front_panel_tables(). If shot_file, the tab, plugin and analysis data
+    are saved as their repr(), as by previous versions of BLACS, for programs that read
+    them from shot files with eval(), and without SETTINGS_FILE_ONLY_SAVE_DATA.
+    Otherwise they are saved with saved_data.dumps()"""
+    dumps = repr if shot_file else saved_data.dumps
+    front_panel_list = []
+    other_data_list = []
+    max_od_length = 2 # empty dictionary
+
+    # Iterate over each device within a class
+    for device_name, device_state in tab_data.items():
+        logger.debug("saving front panel for device:" + device_name)
+        # Insert front panel data into dataset
+        for hardware_name, data in device_state["front_panel"].items():
+            if data != {}:
+                if isinstance(data['base_value'], (str, bytes)):
+                    logger.warning('Could not save data for channel %s on device %s because support for output values that are strings is not yet supported.'%(hardware_name, device_name))
+                    # TODO: Implement saving of Image output type
+                elif float(data['base_value']) == data['base_value']:
+                    front_panel_list.append((data['name'],
+                                             device_name,
+                                             hardware_name,
+                                             data['base_value'],
+                                             data['locked'],
+                                             data['base_step_size'] if 'base_step_size' in data else 0,
+                                             data['current_units'] if 'current_units' in data else ''
+                                            )
+                                           )
+                else:
+                    logger.warning('Could not save data for channel %s on device %s because the output value (in base units) was not a string or could not be coerced to a float without loss of precision'%(hardware_name, device_name))
+
+        # Save "other data"
+        save_data = device_state["save_data"]
+        if shot_file:
+            save_data = {
+                key: value
+                for key, value in save_data.items()
+                if key not in SETTINGS_FILE_ONLY_SAVE_DATA
+            }
+        od = dumps(save_data)
+        other_data_list.append(od)
+        max_od_length = len(od) if len(od) > max_od_length else max_od_length
+
+    front_panel_array = None
+    if front_panel_list:
+        front_panel_array = numpy.empty(len(front_panel_list),dtype=front_panel_dtype)
+        for i, row in enumerate(front_panel_list):
+            front_panel_array[i] = row
+
+    # Tab data
+    i = 0
+    tab_array = numpy.empty(len(notebook_data),dtype=[('tab_name','a256'),('notebook','a2'),('page',int),('visible',bool),('data','a'+str(max_od_length))])
+    for device_name,data in notebook_data.items():
+        tab_array[i] = (device_name,data["notebook"],data["page"],data["visible"],other_data_list[i])
+        i += 1
+
+    # BLACS Main GUI Info
+    attrs = {}
+    attrs["window_width"] = window_data["_main_window"]["width"]
+    attrs["window_height"] = window_data["_main_window"]["height"]
+    attrs["window_xpos"] = window_data["_main_window"]["xpos"]
+    attrs["window_ypos"] = window_data["_main_window"]["ypos"]
+    attrs["window_maximized"] = window_data["_main_window"]["maximized"]
+    attrs["window_frame_height"] = window_data["_main_window"]["frame_height"]
+    attrs["window_frame_width"] = window_data["_main_window"]["frame_width"]
+    attrs['plugin_data'] = dumps(plugin_data)
+    attrs['analysis_data'] = dumps(window_data["_main_window"]["_analysis"])
+    if save_queue_data:
+        attrs['queue_data'] = dumps(window_data["_main_window"]["_queue"])
+    for pane_name,pane_position in window_data.items():
+        if pane_name != "_main_window":
+            attrs[pane_name] = pane_position
+
+    return front_panel_array, tab_array, attrs
+
+
+def compact_array(array):
+    """Return a copy of a structured array with its string columns narrowed to the
+    length of the longest string in them"""
+    dtype = []
+    for name in array.dtype.names:
+        column_dtype = array.dtype[name]
+        if column_dtype.kind == 'S':
+            width = int(numpy.char.str_len(array[name]).max()) if len(array) else 0
+            column_dtype = numpy.dtype('S%d' % max(width, 1))
+        dtype.append((name, column_dtype))
+    return array.astype(dtype)
+
+
+def create_compact_dataset(group, name, array):
+    """Create a dataset from a structured array, with string columns narrowed by
+    compact_array() and, unless it is empty, gzip compression"""
+    array = compact_array(array)
+    if not len(array):
+        return group.create_dataset(name, data=array)
+    return group.create_dataset(
+        name, data=array, chunks=True, compression='gzip', shuffle=True
+    )
+
+
+def write_front_panel_tables(data_group, front_panel_array, tab_array, attrs):
+    """Write the tables returned by build_front_panel_tables() to a h5 group"""
+    data_group.attrs['format_version'] = FRONT_PANEL_FORMAT_VERSION
+    if front_panel_array is not None:
+        create_compact_dataset(data_group, 'front_panel', front_panel_array)
+    dataset = create_compact_dataset(data_group, "_notebook_data", tab_array)
+    for name, value in attrs.items():
+        dataset.attrs[name] = value
+
+    # Save analysis server settings:
+    #dataset = data_group.create_group("analysis_server")
+    #dataset.attrs['send_for_analysis'] = self.blacs.analysis_submission.toggle_analysis.get_active()
+    #dataset.attrs['server'] = self.blacs.analysis_submission.analysis_host.get_text()
+
+
+def _tables_equal(array, other):
+    if array is None or other is None:
+        return array is other
+    return array.dtype == other.dtype and numpy.array_equal(array, other)
+
+
+def update_front_panel_tables(data_group, previous_tables, tables):
+    """Update a h5 group written by write_front_panel_tables() with previous_tables,
+    so that it contains tables instead. Only the datasets and attributes that
+    differ are rewritten."""
+    front_panel_array, tab_array, attrs = tables
+    previous_front_panel_array, previous_tab_array, previous_attrs = previous_tables
+    if not _tables_equal(front_panel_array, previous_front_panel_array):
+        if 'front_panel' in data_group:
+            del data_group['front_panel']
+        if front_panel_array is not None:
+            create_compact_dataset(data_group, 'front_panel', front_panel_array)
+    if not _tables_equal(tab_array, previous_tab_array):
+        # The attributes belong to the dataset, so are all rewritten with it:
+        if '_notebook_data' in data_group:
+            del data_group['_notebook_data']
+        dataset = create_compact_dataset(data_group, '_notebook_data', tab_array)
+        for name, value in attrs.items():
+            dataset.attrs[name] = value
+        return
+    dataset = data_group['_notebook_data']
+    for name, value in attrs.items():
+        if name not in previous_attrs or previous_attrs[name] != value:
+            dataset.attrs[name] = value
+    for name in previous_attrs:
+        if name not in attrs and name in dataset.attrs:
+            del dataset.attrs[name]
+
+
+def read_front_panel_tables(data_group):
+    """Return the table of front panel values (or None if there is none), the table of
+    tab data and its attributes from a front_panel group in a h5 file, whether it was
+    written with write_front_panel_tables() or FrontPanelStore.store_deduplicated().
+    In the latter case the FrontPanelStore file is opened to rebuild the tables.
+
+    Tables of either format version are read. The table of front panel values is
+    returned with the string column widths of front_panel_dtype."""
+    version = data_group.attrs.get('format_version', 1)
+    if version > FRONT_PANEL_FORMAT_VERSION:
+        msg = "Front panel saved in format version %d, which is newer than this version of BLACS supports"
+        raise ValueError(msg % version)
+    if 'snapshot' in data_group.attrs:
+        # Recorded relative to the shared drive if the store is on it:
+        store_path = path_to_local(_ensure_str(data_group.attrs['snapshot_store']))
+        with h5py.File(store_path, 'r') as hdf5_file:
+            snapshot = hdf5_file['snapshots'][_ensure_str(data_group.attrs['snapshot'])]
+            front_panel_array, tab_array, attrs = read_front_panel_tables(snapshot)
+        if 'front_panel_changes' in data_group:
+            front_panel_array = apply_front_panel_changes(
+                front_panel_array, data_group['front_panel_changes'][:]
+            )
+        return front_panel_array, tab_array, attrs
+    front_panel_array = None
+    if 'front_panel' in data_group:
+        front_panel_array = data_group['front_panel'][:].astype(front_panel_dtype)
+    dataset = data_group.get('_notebook_data')
+    if dataset is None:
+        # Settings files may have no tab data:
+        return front_panel_array, [], {}
+    return front_panel_array, dataset[:], dict(dataset.attrs)
+
+
+def apply_front_panel_changes(front_panel_array, changes):
+    """Return a copy of a table of front panel values with rows replaced by those
+    in changes with the same device_name and channel"""
+    front_panel_array = front_panel_array.astype(front_panel_dtype)
+    changes = changes.astype(front_panel_dtype)
+    rows = {
+        (row['device_name'], row['channel']): i for i, row in enumerate(front_panel_array)
+    }
+    for change in changes:
+        front_panel_array[rows[change['device_name'], change['channel']]] = change
+    return front_panel_array
+
+
+class FrontPanelStore(object):
+    """A h5 file storing front panels, as written by write_front_panel_tables(), each
+    once only, keyed by a hash of their contents. Shot files then only need to
+    contain the hash, and any channels that differ from the stored front panel.
+
+    Stored front panels are never removed, as shot files refer to them. Instead, once
+    the file reaches max_bytes in size, a new one is started alongside it, with the
+    next number appended to its name, so that no file grows without limit and old ones
+    can be archived or deleted along with the shots that refer to them."""
+
+    # Store a new front panel rather than the changes to the last one if more than
+    # this fraction of channels have changed:
+    MAX_CHANGED_FRACTION = 0.1
+
+    def __init__(self, path, max_bytes=None):
+        self.base_path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Carry on with the newest file:
+        self._number = 0
+        while os.path.exists(self._numbered_path(self._number + 1)):
+            self._number += 1
+        self.path = self._numbered_path(self._number)
+        # The digest and tables of the front panel most recently stored:
+        self._base = None
+
+    def _numbered_path(self, number):
+        if number == 0:
+            return self.base_path
+        stem, ext = os.path.splitext(self.base_path)
+        return '%s_%d%s' % (stem, number, ext)
+
+    def _rotate_if_full(self):
+        # Start a new file if the current one has reached max_bytes:
+        if self.max_bytes is None or not os.path.exists(self.path):
+            return
+        if os.path.getsize(self.path) >= self.max_bytes:
+            self._number += 1
+            self.path = self._numbered_path(self._number)
+            # Shots must refer to front panels in the file they are in:
+            self._base = None
+
+    @staticmethod
+    def digest(front_panel_array, tab_array, attrs):
+        digest = hashlib.sha256()
+        for array in [front_panel_array, tab_array]:
+            if array is not None:
+                digest.update(str(array.dtype.descr).encode('utf8'))
+                digest.update(array.tobytes())
+        digest.update(repr(sorted(attrs.items())).encode('utf8'))
+        return digest.hexdigest()
+
+    def get(self, digest):
+        with self._lock:
+            if self._base is not None and self._base[0] == digest:
+                return self._base[1:]
+            with h5py.File(self.path, 'r') as hdf5_file:
+                return read_front_panel_tables(hdf5_file['snapshots'][digest])
+
+    def store_deduplicated(self, data_group, front_panel_array, tab_array, attrs):
+        """Save front panel tables to the store if not already present, and record
+        in data_group the hash by which to look them up. If they only differ from
+        the most recently saved tables by a few channels, record only the hash of
+        those tables and the channels that differ"""
+        with self._lock:
+            changes = self._changes_from_base(front_panel_array, tab_array, attrs)
+            if changes is None:
+                self._rotate_if_full()
+                digest = self.digest(front_panel_array, tab_array, attrs)
+                with h5py.File(self.path, 'a') as hdf5_file:
+                    snapshots = hdf5_file.require_group('snapshots')
+                    if digest not in snapshots:
+                        write_front_panel_tables(
+                            snapshots.create_group(digest), front_panel_array, tab_array, attrs
+                        )
+                self._base = (digest, front_panel_array, tab_array, attrs)
+            data_group.attrs['snapshot'] = self._base[0]
+            # Relative to the shared drive if the store is on it, so that the shot can
+            # be read on other computers:
+            data_group.attrs['snapshot_store'] = path_to_agnostic(self.path)
+            if changes is not None and len(changes):
+                create_compact_dataset(data_group, 'front_panel_changes', changes)
+
+    def _changes_from_base(self, front_panel_array, tab_array, attrs):
+        # Return the rows of front_panel_array that differ from the most recently
+        # stored front panel, or None if it should be stored as a new one instead.
+        if self._base is None:
+            return None
+        _, base_front_panel_array, base_tab_array, base_attrs = self._base
+        if front_panel_array is None or base_front_panel_array is None:
+            return None
+        if (
+            attrs != base_attrs
+            or tab_array.dtype != base_tab_array.dtype
+            or tab_array.tobytes() != base_tab_array.tobytes()
+            or front_panel_array.shape != base_front_panel_array.shape
+        ):
+            return None
+        for column in ['device_name', 'channel']:
+            if not numpy.array_equal(front_panel_array[column], base_front_panel_array[column]):
+                return None
+        changed = front_panel_array != base_front_panel_array
+        if changed.sum() > self.MAX_CHANGED_FRACTION * len(front_panel_array):
+            return None
+        return front_panel_array[changed]
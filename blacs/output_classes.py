@@ -25,6 +25,8 @@ from labscript_utils.qtwidgets.ddsoutput import DDSOutput
 from labscript_utils.qtwidgets.imageoutput import ImageOutput
 from labscript_utils.unitconversions import get_unit_conversion_class
 
+from blacs.autosave import changes, FRONT_PANEL
+
 
 class AO(object):
     def __init__(self, hardware_name, connection_name, device_name, program_function, settings, calib_class, calib_params, default_units, min, max, step, decimals):
@@ -327,6 +329,7 @@ class AO(object):
         # Store the current units
         self._current_units = unit  
         self._settings['current_units'] = unit    
+        changes.mark(FRONT_PANEL)
         
         # Check to see if the upper/lower bound has switched
         if property_value_list[1] > property_value_list[2]:
@@ -371,6 +374,9 @@ class AO(object):
         self._settings['base_value'] = self._current_value
             
         if program:
+            # Values set without programming, such as the final values of a shot, are
+            # not changes made by the user, so do not need autosaving:
+            changes.mark(FRONT_PANEL)
             self._logger.debug('program device called')
             self._program_device()
             
@@ -399,6 +405,7 @@ class AO(object):
         
         #self._current_step_size = self._step_size
         self._settings['base_step_size'] = self._step_size
+        changes.mark(FRONT_PANEL)
         
         # now convert to current units
         self._current_step_size = self.get_step_size(self._current_units)        
@@ -424,6 +431,7 @@ class AO(object):
     def _update_lock(self, locked):    
         self._locked = locked        
         self._settings['locked'] = locked
+        changes.mark(FRONT_PANEL)
         
         # Lock all widgets if they are not already locked
         for widget in self._widgets:
@@ -526,6 +534,7 @@ class DO(object):
         
         # update the settings dictionary if it exists, to maintain continuity on tab restarts
         self._settings['locked'] = locked
+        changes.mark(FRONT_PANEL)
             
     def set_value(self,state,program=True):
         # conversion to integer, then bool means we can safely pass in
@@ -539,6 +548,9 @@ class DO(object):
         self._settings['base_value'] = state
         
         if program:            
+            # Values set without programming, such as the final values of a shot, are
+            # not changes made by the user, so do not need autosaving:
+            changes.mark(FRONT_PANEL)
             self._logger.debug('program device called')
             self._program_device()
             
@@ -648,6 +660,7 @@ class Image(object):
         
         # update the settings dictionary if it exists, to maintain continuity on tab restarts
         self._settings['locked'] = locked
+        changes.mark(FRONT_PANEL)
         
     def set_value(self, value, program = True):
         value = str(value)  
@@ -659,6 +672,9 @@ class Image(object):
         self._settings['base_value'] = value
         
         if program:            
+            # Values set without programming, such as the final values of a shot, are
+            # not changes made by the user, so do not need autosaving:
+            changes.mark(FRONT_PANEL)
             self._logger.debug('program device called')
             self._program_device()
             
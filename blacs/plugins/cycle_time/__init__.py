@@ -18,14 +18,11 @@ import os
 
 from qtutils import UiLoader, inmain, inmain_decorator
 
-import labscript_utils.h5_lock
-import h5py
-
 from qtutils.qt.QtGui import QIcon
 from qtutils.qt.QtCore import QSize
 
 from blacs.plugins import PLUGINS_DIR, callback
-from labscript_utils.properties import get_attribute
+from blacs.shot_manifest import get_manifest
 
 name = "cycle_time"
 module = "cycle_time" # should be folder name
@@ -68,16 +65,14 @@ class Plugin(object):
         self.target_cycle_time = self.next_target_cycle_time
         self.delay_after_programming = self.next_delay_after_programming
 
-        with h5py.File(h5_filepath, 'r') as f:
-            try:
-                group = f['shot_properties']
-            except KeyError:
-                # Nothing for us to do
-                return
-            self.next_target_cycle_time = get_attribute(group, 'target_cycle_time')
-            self.next_delay_after_programming = get_attribute(
-                group, 'cycle_time_delay_after_programming'
-            )
+        shot_properties = get_manifest(h5_filepath).shot_properties
+        if shot_properties is None:
+            # Nothing for us to do
+            return
+        self.next_target_cycle_time = shot_properties['target_cycle_time']
+        self.next_delay_after_programming = shot_properties[
+            'cycle_time_delay_after_programming'
+        ]
 
         if not self.delay_after_programming:
             self.do_delay(h5_filepath)
@@ -31,6 +31,7 @@ from labscript_utils.connections import ConnectionTable
 from zprocess import TimeoutError
 from labscript_utils.ls_zprocess import Event
 from blacs.plugins import PLUGINS_DIR, callback
+from blacs.shot_manifest import get_manifest
 
 name = "Progress Bar"
 module = "progress_bar" # should be folder name
@@ -258,19 +259,10 @@ class Plugin(object):
         """Called from the mainloop when starting a shot"""
         self.h5_filepath = h5_filepath
         # Get the stop time, any waits and any markers from the shot:
-        with h5py.File(h5_filepath, 'r') as f:
-            props = properties.get(f, self.master_pseudoclock, 'device_properties')
-            self.stop_time = props['stop_time']
-            try:
-                self.markers = f['time_markers'][:]
-                self.markers.sort(order='time')
-            except KeyError:
-                self.markers = None
-            try:
-                self.waits = f['waits'][:]
-                self.waits.sort(order='time')
-            except KeyError:
-                self.waits = None
+        manifest = get_manifest(h5_filepath)
+        self.stop_time = manifest.stop_time
+        self.markers = manifest.time_markers
+        self.waits = manifest.waits
         self.shot_start_time = time.time()
         self.time_spent_waiting = 0
         self.next_marker_index = 0
@@ -0,0 +1,260 @@
+#####################################################################
+#                                                                   #
+# /queue_journal.py                                                 #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""An append-only journal of changes to the contents of the queue, from which the
+queue is rebuilt when BLACS starts.
+
+The journal is a text file with one JSON array per line. The first line is a
+snapshot of the queue, and each following line is a change to it:
+
+    ["snapshot", [path, ...], [stat, ...]]
+    ["append", [path, ...], [stat, ...]]
+    ["prepend", path, stat]
+    ["pop"]
+    ["clear"]
+    ["remove", row, count]
+    ["remove_rows", [row, ...]]
+    ["move", source_row, count, destination_row]
+
+where rows are as in QueueModel, and each stat is the [size, mtime] of a file, as
+returned by file_stat(), when it was validated, or null if not known. Files whose
+size and modification time are unchanged when the journal is replayed need not be
+validated again. Once enough changes have been recorded, the journal
+is compacted, in a thread, by replacing it with a single snapshot."""
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger('BLACS.queue_journal')
+
+
+def file_stat(path):
+    """Return the size and modification time of a file, for detecting whether it has
+    changed since it was validated"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def apply_record(paths, stats, record):
+    """Apply a record read from the journal to a list of paths, and update the dict
+    stats of their file stats"""
+    # Arguments are unpacked before anything is modified, so that a malformed record
+    # raises an exception without being partly applied:
+    op, args = record[0], record[1:]
+    if op == 'snapshot':
+        new_paths, new_stats = args
+        paths[:] = new_paths
+        stats.clear()
+        stats.update(zip(new_paths, new_stats))
+    elif op == 'append':
+        new_paths, new_stats = args
+        paths.extend(new_paths)
+        stats.update(zip(new_paths, new_stats))
+    elif op == 'prepend':
+        path, stat = args
+        paths.insert(0, path)
+        stats[path] = stat
+    elif op == 'pop':
+        del paths[0]
+    elif op == 'clear':
+        del paths[:]
+    elif op == 'remove':
+        row, count = args
+        del paths[row:row + count]
+    elif op == 'remove_rows':
+        rows = set(args[0])
+        paths[:] = [path for i, path in enumerate(paths) if i not in rows]
+    elif op == 'move':
+        source_row, count, destination_row = args
+        moved = paths[source_row:source_row + count]
+        del paths[source_row:source_row + count]
+        if destination_row > source_row:
+            destination_row -= count
+        paths[destination_row:destination_row] = moved
+    else:
+        raise ValueError('Unknown queue journal record %r' % (op,))
+
+
+class QueueJournal(object):
+    """Records changes to the queue, as they are made, to a journal file. Records are
+    flushed to the operating system as they are written, so that they are not lost if
+    BLACS crashes, and fsynced from a thread at most every SYNC_INTERVAL seconds, so
+    that they are also not lost if the computer crashes, without waiting on the disk
+    for each change. The same thread compacts the journal, from the journal's own copy
+    of the contents of the queue."""
+    # Rewrite the journal as a single snapshot after this many records:
+    COMPACT_AFTER = 1000
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._n_records = 0
+        # The contents of the queue and the stats of the files in it, as recorded, for
+        # writing snapshots:
+        self._paths = []
+        self._stats = {}
+        # Whilst a snapshot is being written, the lines recorded since it was taken, to
+        # be written after it:
+        self._lines_since_snapshot = None
+        self._compact_requested = False
+        self._lock = threading.Lock()
+        self._unsynced = threading.Event()
+        self._sync_thread = None
+
+    def replay(self):
+        """Return the list of paths in the queue as recorded in the journal and a dict
+        of their stats, or None, None if there is no journal. Replay stops at the first
+        record that cannot be read or applied, as those after it cannot be trusted."""
+        if not os.path.exists(self.path):
+            return None, None
+        paths = []
+        stats = {}
+        with open(self.path, 'r', encoding='utf8', errors='replace') as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record may be incomplete if BLACS crashed whilst
+                    # writing it. Records after a bad one cannot be trusted anyway:
+                    logger.warning('Queue journal truncated at line %d' % (i + 1))
+                    break
+                try:
+                    apply_record(paths, stats, record)
+                except Exception:
+                    logger.exception(
+                        'Invalid queue journal record at line %d, ignoring it and the '
+                        'rest of the journal' % (i + 1)
+                    )
+                    break
+        return paths, stats
+
+    def open(self, paths, stats=None):
+        """Start the journal afresh with a snapshot of paths, the current contents of
+        the queue, and a dict of their stats, and begin recording changes to it"""
+        with self._lock:
+            self._paths = list(paths)
+            self._stats = {path: (stats or {}).get(path) for path in self._paths}
+            temp_path = self._write_snapshot(self._paths, self._stats)
+            self._replace(temp_path, [])
+        if self._sync_thread is None:
+            self._sync_thread = threading.Thread(target=self._sync_loop, name='queue journal')
+            self._sync_thread.daemon = True
+            self._sync_thread.start()
+
+    def _write_snapshot(self, paths, stats):
+        # Write a snapshot to a temporary file, to replace the journal with, so that
+        # there is a complete journal on disk at all times. Return its path:
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf8') as f:
+            record = ['snapshot', paths, [stats.get(path) for path in paths]]
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        return temp_path
+
+    def _replace(self, temp_path, lines):
+        # Replace the journal with a snapshot and the lines recorded since it was
+        # taken. Must be called with the lock held:
+        if self._file is not None:
+            self._file.close()
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, 'a', encoding='utf8')
+        self._file.writelines(lines)
+        self._file.flush()
+        self._n_records = len(lines)
+        if lines:
+            self._unsynced.set()
+
+    def record(self, *record):
+        """Write a record to the journal, and have the journal compacted in a thread if
+        enough records have been written since it was last compacted"""
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self._file.flush()
+            apply_record(self._paths, self._stats, record)
+            if self._lines_since_snapshot is not None:
+                self._lines_since_snapshot.append(line)
+            self._n_records += 1
+            if self._n_records >= self.COMPACT_AFTER:
+                self._compact_requested = True
+            self._unsynced.set()
+
+    def _compact(self):
+        # Replace the journal with a snapshot of the queue. The snapshot is written
+        # without holding the lock, so that changes to the queue are not held up.
+        # Records written meanwhile are added after it:
+        with self._lock:
+            self._compact_requested = False
+            if self._file is None:
+                return
+            paths = list(self._paths)
+            # Forget the stats of files no longer in the queue:
+            self._stats = {path: self._stats.get(path) for path in paths}
+            stats = dict(self._stats)
+            self._lines_since_snapshot = []
+        try:
+            temp_path = self._write_snapshot(paths, stats)
+        except OSError:
+            logger.exception('Could not compact queue journal')
+            with self._lock:
+                self._lines_since_snapshot = None
+            return
+        with self._lock:
+            lines = self._lines_since_snapshot
+            self._lines_since_snapshot = None
+            if self._file is None:
+                # Closed meanwhile:
+                os.unlink(temp_path)
+                return
+            self._replace(temp_path, lines)
+
+    def _sync_loop(self):
+        while True:
+            self._unsynced.wait()
+            self._unsynced.clear()
+            with self._lock:
+                if self._file is None:
+                    return
+                compact = self._compact_requested
+                if not compact:
+                    # A descriptor of our own, so that the file can be closed or
+                    # replaced whilst we sync it without holding the lock:
+                    fd = os.dup(self._file.fileno())
+            if compact:
+                self._compact()
+            else:
+                try:
+                    os.fsync(fd)
+                except OSError:
+                    logger.exception('Could not sync queue journal')
+                finally:
+                    os.close(fd)
+            # Limit how often we sync:
+            time.sleep(self.SYNC_INTERVAL)
+
+    def close(self):
+        """Sync and close the journal. Further changes are not recorded."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+        # Let the sync thread exit:
+        self._unsynced.set()
@@ -0,0 +1,147 @@
+#####################################################################
+#                                                                   #
+# /saved_data.py                                                    #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Serialisation of the data that tabs, plugins, the queue and analysis submission
+save with the front panel.
+
+This data used to be saved as its repr() and restored with eval(), which is slow for
+large queues and fails if objects that cannot be rebuilt from their repr (such as Qt
+objects) find their way into the data. It is now saved as JSON, prefixed with a
+format version so that it can be told apart from data in the old format, which is
+still read for the sake of existing settings and shot files. Shot files are still
+written in the old format, as programs other than BLACS read it from them with eval().
+
+Python and numpy types that JSON does not support natively (tuples, sets, bytes,
+dictionaries with non-string keys, numpy scalars and arrays) are saved as tagged
+JSON objects and restored as the same type."""
+import ast
+import json
+import base64
+import logging
+
+import numpy
+
+logger = logging.getLogger('BLACS.saved_data')
+
+# Incremented if the format changes in a way that older versions of BLACS cannot
+# read:
+FORMAT_VERSION = 1
+FORMAT_PREFIX = 'blacs-json-%d:' % FORMAT_VERSION
+
+_TAGS = {'__tuple__', '__set__', '__dict__', '__bytes__', '__ndarray__', '__repr__'}
+
+
+def _encode(obj):
+    # Exact type checks first, as they are by far the most common and this is called
+    # on every item of potentially very long lists:
+    cls = type(obj)
+    if cls is str or cls is int or cls is float or cls is bool or obj is None:
+        return obj
+    if cls is list:
+        if all(type(item) is str for item in obj):
+            # Such as the paths of queued shot files, no need to copy it:
+            return obj
+        return [_encode(item) for item in obj]
+    if cls is dict:
+        if all(type(key) is str for key in obj) and _TAGS.isdisjoint(obj):
+            return {key: _encode(value) for key, value in obj.items()}
+        return {'__dict__': [[_encode(key), _encode(value)] for key, value in obj.items()]}
+    if isinstance(obj, tuple):
+        return {'__tuple__': [_encode(item) for item in obj]}
+    if isinstance(obj, (set, frozenset)):
+        return {'__set__': [_encode(item) for item in obj]}
+    if isinstance(obj, bytes):
+        return {'__bytes__': base64.b64encode(obj).decode('ascii')}
+    if isinstance(obj, numpy.ndarray):
+        if obj.dtype.hasobject:
+            return {'__ndarray__': {'dtype': 'object', 'data': _encode(obj.tolist())}}
+        obj = numpy.ascontiguousarray(obj)
+        return {
+            '__ndarray__': {
+                'dtype': obj.dtype.descr if obj.dtype.names else obj.dtype.str,
+                'shape': list(obj.shape),
+                'data': base64.b64encode(obj.tobytes()).decode('ascii'),
+            }
+        }
+    if isinstance(obj, numpy.generic):
+        return _encode(obj.item())
+    # Subclasses of builtin types:
+    if isinstance(obj, str):
+        return str(obj)
+    if isinstance(obj, int):
+        return int(obj)
+    if isinstance(obj, float):
+        return float(obj)
+    if isinstance(obj, dict):
+        return _encode(dict(obj))
+    if isinstance(obj, list):
+        return _encode(list(obj))
+    # Something we don't know how to save. Keep its repr so that it is not silently
+    # lost, it will be restored if it is a literal:
+    logger.warning('Saving object of type %s as its repr()' % cls.__name__)
+    return {'__repr__': repr(obj)}
+
+
+def _decode_tagged(obj):
+    if len(obj) != 1:
+        return obj
+    tag, value = next(iter(obj.items()))
+    if tag not in _TAGS:
+        return obj
+    if tag == '__tuple__':
+        return tuple(value)
+    if tag == '__set__':
+        return set(value)
+    if tag == '__dict__':
+        return {key: item for key, item in value}
+    if tag == '__bytes__':
+        return base64.b64decode(value)
+    if tag == '__ndarray__':
+        if value['dtype'] == 'object':
+            return numpy.array(value['data'], dtype=object)
+        dtype = value['dtype']
+        if isinstance(dtype, list):
+            # Structured dtype, its descr has been converted to lists by JSON:
+            dtype = [tuple(field) for field in dtype]
+        data = base64.b64decode(value['data'])
+        return numpy.frombuffer(data, dtype=numpy.dtype(dtype)).reshape(value['shape']).copy()
+    # '__repr__':
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        logger.warning('Could not restore saved object %s' % value)
+        return None
+
+
+def dumps(obj):
+    """Return a string of the saved data obj, in the current format."""
+    return FORMAT_PREFIX + json.dumps(_encode(obj), separators=(',', ':'))
+
+
+def loads(s):
+    """Restore saved data from a string returned by dumps(), or from the repr()
+    format used by older versions of BLACS."""
+    if isinstance(s, bytes):
+        s = s.decode('utf8')
+    if s.startswith(FORMAT_PREFIX):
+        return json.loads(s[len(FORMAT_PREFIX):], object_hook=_decode_tagged)
+    if s.startswith('blacs-json-'):
+        raise ValueError('Saved data is in a newer format than this version of BLACS can read')
+    # Data saved by an older version of BLACS. Most of it is made of literals, which
+    # we can read without evaluating arbitrary code:
+    try:
+        return ast.literal_eval(s)
+    except (ValueError, SyntaxError):
+        pass
+    # Otherwise fall back to how it was read previously. This may raise a NameError
+    # if the data contains objects that cannot be rebuilt from their repr:
+    return eval(s, {'array': numpy.array, 'nan': numpy.nan, 'inf': numpy.inf})
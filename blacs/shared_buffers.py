@@ -0,0 +1,138 @@
+#####################################################################
+#                                                                   #
+# /shared_buffers.py                                                #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Shared memory for transferring large buffers, such as numpy arrays, between tabs and
+their local worker processes.
+
+share() copies buffers once into a shared memory mapping, and open_shared() returns
+views of them in the other process without copying them again. The receiver's mapping
+is freed once nothing refers to it any more. The sender must keep the handle returned
+by share() until the receiver has opened the mapping, and then pass it to release().
+Mappings a process created that were never opened can be freed with release_unopened()
+once it has exited. Shared memory is supported on Windows and on platforms with
+/dev/shm."""
+import os
+import sys
+import mmap
+import uuid
+
+# Buffers are aligned to this many bytes within the mapping:
+_ALIGNMENT = 64
+_SHM_DIR = '/dev/shm'
+# Names of mappings begin with this, formatted with the pid of the process creating
+# them:
+_NAME_PREFIX = 'blacs-%d-'
+
+
+def shared_memory_supported():
+    return sys.platform == 'win32' or os.path.isdir(_SHM_DIR)
+
+
+def _create_mapping(name, size):
+    # Return a writable mapping of the given size that the other process can open by
+    # name, and an object to keep until it has done so:
+    if sys.platform == 'win32':
+        mapping = mmap.mmap(-1, size, tagname=name)
+        return mapping, mapping
+    path = os.path.join(_SHM_DIR, name)
+    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+    try:
+        # Reserve the memory now, as running out of it when writing to the mapping
+        # would crash the process:
+        os.posix_fallocate(fd, 0, size)
+        mapping = mmap.mmap(fd, size)
+    except BaseException:
+        os.unlink(path)
+        raise
+    finally:
+        os.close(fd)
+    return mapping, path
+
+
+def share(buffers):
+    """Copy buffers, a list of objects supporting the buffer protocol, into a new
+    shared memory mapping. Return its name, size, the (offset, nbytes) region of each
+    buffer within it, and a handle to pass to release() once the other process has
+    opened it. Raises OSError if the mapping cannot be created."""
+    regions = []
+    size = 0
+    for buffer in buffers:
+        nbytes = memoryview(buffer).nbytes
+        regions.append((size, nbytes))
+        size += -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+    name = _NAME_PREFIX % os.getpid() + uuid.uuid4().hex
+    mapping, handle = _create_mapping(name, size)
+    try:
+        view = memoryview(mapping)
+        for buffer, (offset, nbytes) in zip(buffers, regions):
+            view[offset:offset + nbytes] = memoryview(buffer).cast('B')
+        view.release()
+    except BaseException:
+        mapping.close()
+        release(handle)
+        raise
+    if handle is not mapping:
+        # The other process opens it by name:
+        mapping.close()
+    return name, size, regions, handle
+
+
+def open_shared(name, size, regions):
+    """Open a mapping created by share() in another process and return writable views
+    of the buffers at the given regions within it. The views keep the mapping open for
+    as long as they, or objects made from them, exist."""
+    if sys.platform == 'win32':
+        mapping = mmap.mmap(-1, size, tagname=name)
+    else:
+        path = os.path.join(_SHM_DIR, name)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            mapping = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+            # Nobody else needs it, the memory is freed once our mapping is:
+            os.unlink(path)
+    view = memoryview(mapping)
+    return [view[offset:offset + nbytes] for offset, nbytes in regions]
+
+
+def release(handle):
+    """Free the sender's end of a mapping created by share()"""
+    if isinstance(handle, mmap.mmap):
+        handle.close()
+    else:
+        # The path of a file in /dev/shm, which the receiver will already have
+        # removed unless it failed to open it:
+        try:
+            os.unlink(handle)
+        except FileNotFoundError:
+            pass
+
+
+def release_unopened(pid):
+    """Free any mappings created by share() in the process with the given pid that the
+    other process never opened, such as those it was sending when it was terminated.
+    Only call this once the process has exited. On Windows, mappings are freed along
+    with the last process to have them open, so there is nothing to do."""
+    if sys.platform == 'win32':
+        return
+    prefix = _NAME_PREFIX % pid
+    try:
+        names = os.listdir(_SHM_DIR)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith(prefix):
+            try:
+                os.unlink(os.path.join(_SHM_DIR, name))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,128 @@
+#####################################################################
+#                                                                   #
+# /shot_broker.py                                                   #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Reading of the groups of devices in shot files on behalf of their workers.
+
+Rather than each worker opening the shot file in its transition_to_buffered()
+method, which for many devices means many opens and lock acquisitions of the same file,
+often over a network share, BLACS opens it once and sends each device's group to the
+workers that ask for it, in memory. Remote workers then do not need access to the
+shared drive to read their instructions."""
+import threading
+from collections import OrderedDict
+
+import labscript_utils.h5_lock, h5py
+
+
+class DeviceGroup(object):
+    """An in-memory copy of a group in a shot file, such as /devices/<device name>.
+    Datasets are read into numpy arrays. Supports the read-only parts of the
+    h5py.Group interface most used by workers: indexing by name or path, membership
+    tests, iteration, keys(), items() and attrs. The attributes of datasets, if
+    any, are in dataset_attrs, by dataset name."""
+    def __init__(self, name, attrs, members, dataset_attrs):
+        self.name = name
+        self.attrs = attrs
+        self._members = members
+        self.dataset_attrs = dataset_attrs
+
+    @classmethod
+    def read(cls, group):
+        """Return a DeviceGroup of the contents of an h5py group"""
+        members = {}
+        dataset_attrs = {}
+        for name, item in group.items():
+            if isinstance(item, h5py.Group):
+                members[name] = cls.read(item)
+            else:
+                members[name] = item[()]
+                if item.attrs:
+                    dataset_attrs[name] = dict(item.attrs)
+        return cls(group.name, dict(group.attrs), members, dataset_attrs)
+
+    def __getitem__(self, path):
+        item = self
+        for name in path.strip('/').split('/'):
+            if not isinstance(item, DeviceGroup):
+                raise KeyError(path)
+            item = item._members[name]
+        return item
+
+    def get(self, path, default=None):
+        try:
+            return self[path]
+        except KeyError:
+            return default
+
+    def __contains__(self, path):
+        try:
+            self[path]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def keys(self):
+        return self._members.keys()
+
+    def items(self):
+        return self._members.items()
+
+    def __repr__(self):
+        return '<DeviceGroup %s (%d members)>' % (self.name, len(self._members))
+
+
+class ShotBroker(object):
+    """Reads the groups of devices in shot files, opening each file once for all the
+    devices whose workers want their group. The groups of the last max_shots shot
+    files read are kept, as the next shot may be read whilst the current one is
+    still being started."""
+    def __init__(self, max_shots=2):
+        self.max_shots = max_shots
+        self._shots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path, device_names):
+        """Read the groups of the given devices from a shot file, if they have not
+        already been read"""
+        with self._lock:
+            groups = self._shots.get(path)
+            missing = [name for name in device_names if groups is None or name not in groups]
+            if not missing:
+                return
+            if groups is None:
+                groups = {}
+            with h5py.File(path, 'r') as f:
+                for name in missing:
+                    groups[name] = DeviceGroup.read(f['devices'][name])
+            self._shots[path] = groups
+            self._shots.move_to_end(path)
+            while len(self._shots) > self.max_shots:
+                self._shots.popitem(last=False)
+
+    def get(self, path, device_name, device_names):
+        """Return the DeviceGroup of a device in a shot file. If the file has not yet
+        been read, read the groups of all of device_names from it, which should be
+        all the devices in the shot that will be asked for their group"""
+        self.read(path, set(device_names) | {device_name})
+        with self._lock:
+            return self._shots[path][device_name]
+
+    def discard(self, path):
+        """Forget the groups read from a shot file"""
+        with self._lock:
+            self._shots.pop(path, None)
@@ -0,0 +1,153 @@
+#####################################################################
+#                                                                   #
+# /shot_manifest.py                                                 #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+import hashlib
+import threading
+from collections import OrderedDict
+
+import labscript_utils.h5_lock, h5py
+import labscript_utils.properties
+
+
+class ShotManifest(object):
+    """The metadata of a shot file needed to run it: its devices and their start and
+    stop orders, digests of their groups, its stop time, time markers, waits, shot
+    properties and repeat number. Read once, when the shot is submitted, and then shared by the queue
+    manager and plugins via get_manifest(), so that they do not each reopen the
+    file."""
+    def __init__(self, path, h5_file):
+        self.path = path
+        self.device_names = []
+        self.start_order = {}
+        self.stop_order = {}
+        # Digests of the contents of each device's group, for telling whether the
+        # device has the same instructions as in the previous shot:
+        self.device_digests = {}
+        self.master_pseudoclock = None
+        self.stop_time = None
+        for name in h5_file['devices']:
+            device_properties = labscript_utils.properties.get(
+                h5_file, name, 'device_properties'
+            )
+            self.device_names.append(name)
+            self.start_order[name] = device_properties.get('start_order', None)
+            self.stop_order[name] = device_properties.get('stop_order', None)
+            self.device_digests[name] = device_group_digest(h5_file['devices'][name])
+        master_pseudoclock = h5_file['connection table'].attrs.get('master_pseudoclock')
+        if master_pseudoclock is not None:
+            if isinstance(master_pseudoclock, bytes):
+                master_pseudoclock = master_pseudoclock.decode()
+            self.master_pseudoclock = str(master_pseudoclock)
+            device_properties = labscript_utils.properties.get(
+                h5_file, self.master_pseudoclock, 'device_properties'
+            )
+            self.stop_time = device_properties.get('stop_time', None)
+        # Markers and waits sorted by time, or None if the shot has none:
+        self.time_markers = self._read_sorted(h5_file, 'time_markers')
+        self.waits = self._read_sorted(h5_file, 'waits')
+        if 'shot_properties' in h5_file:
+            self.shot_properties = labscript_utils.properties.get_attributes(
+                h5_file['shot_properties']
+            )
+        else:
+            self.shot_properties = None
+        self.run_repeat = h5_file.attrs.get('run repeat', 0)
+
+    @staticmethod
+    def _read_sorted(h5_file, name):
+        if name not in h5_file:
+            return None
+        data = h5_file[name][:]
+        data.sort(order='time')
+        return data
+
+
+def _update_digest_with_attrs(digest, attrs):
+    for name in sorted(attrs):
+        value = attrs[name]
+        digest.update(name.encode('utf8'))
+        dtype = getattr(value, 'dtype', None)
+        if dtype is not None and not dtype.hasobject:
+            digest.update(str(dtype).encode('utf8'))
+            digest.update(value.tobytes())
+        else:
+            digest.update(repr(value).encode('utf8'))
+
+
+def device_group_digest(group):
+    """Return a hash of the contents of a device's group in a shot file: the names,
+    dtypes, shapes and data of its datasets, and the attributes of it and everything
+    in it. Shots whose digests for a device are equal contain the same instructions
+    for that device."""
+    digest = hashlib.sha256()
+    _update_digest_with_attrs(digest, group.attrs)
+
+    names = []
+    group.visit(names.append)
+    # In a consistent order, regardless of the order in which they were created:
+    for name in sorted(names):
+        obj = group[name]
+        digest.update(name.encode('utf8'))
+        if isinstance(obj, h5py.Dataset):
+            digest.update(str(obj.dtype.descr if obj.dtype.names else obj.dtype.str).encode('utf8'))
+            digest.update(repr(obj.shape).encode('utf8'))
+            data = obj[()]
+            if getattr(data, 'dtype', None) is not None and not data.dtype.hasobject:
+                digest.update(data.tobytes())
+            else:
+                # Variable length fields are objects, whose bytes are not their contents:
+                digest.update(repr(data.tolist() if hasattr(data, 'tolist') else data).encode('utf8'))
+        _update_digest_with_attrs(digest, obj.attrs)
+    return digest.hexdigest()
+
+
+# Manifests of recently submitted shots, most recently used last:
+_manifests = OrderedDict()
+_manifests_lock = threading.Lock()
+# Maximum number of manifests to keep. Those of shots further down a long queue are
+# read again when the shot is run:
+MAX_MANIFESTS = 256
+
+
+def get_manifest(path, h5_file=None):
+    """Return the ShotManifest of the shot file at path, reading it if it has not
+    been read already. If the file is already open, it may be passed in as
+    h5_file."""
+    with _manifests_lock:
+        try:
+            _manifests.move_to_end(path)
+            return _manifests[path]
+        except KeyError:
+            pass
+    if h5_file is not None:
+        manifest = ShotManifest(path, h5_file)
+    else:
+        with h5py.File(path, 'r') as h5_file:
+            manifest = ShotManifest(path, h5_file)
+    store_manifest(manifest)
+    return manifest
+
+
+def store_manifest(manifest):
+    """Cache a ShotManifest for later calls to get_manifest()"""
+    with _manifests_lock:
+        _manifests[manifest.path] = manifest
+        _manifests.move_to_end(manifest.path)
+        while len(_manifests) > MAX_MANIFESTS:
+            _manifests.popitem(last=False)
+
+
+def discard_manifest(path):
+    """Forget the ShotManifest of the shot file at path, for example because the
+    file has been modified"""
+    with _manifests_lock:
+        _manifests.pop(path, None)
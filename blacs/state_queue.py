@@ -0,0 +1,241 @@
+#####################################################################
+#                                                                   #
+# /state_queue.py                                                   #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""The queue of states waiting to be run by a tab's mainloop.
+
+States are put in the queue by the methods decorated with
+blacs.tab_base_classes.define_state, from any thread, and got by the tab's mainloop
+in the order of their priority and then the order they were put in the queue, skipping
+states not allowed in the tab's current mode. A state passed over in this way is
+deleted, unless it is to be queued indefinitely. A state that deletes stale states
+is replaced by the latest of any further calls of the same state immediately following
+it in the queue.
+
+The queue is protected by a lock rather than by running in the Qt main thread, and
+keeps a heap of the states for each combination of allowed modes, so that finding the
+next state does not mean looking through the states not allowed in the current mode. States are
+also kept in a linked list for each priority, in the order they were put, so that the
+states following a state can be found, and any state removed, in constant time."""
+import logging
+import threading
+from bisect import bisect_right, insort
+from heapq import heappush, heappop, heapify
+from itertools import count
+
+# How many states to put between discarding removed states from the heaps:
+COMPACTION_INTERVAL = 1024
+
+# The indices of the fields of an entry in the queue. The first six are those of the
+# entries listed by StateQueue.list_of_states, followed by whether the entry is still in
+# the queue, and the neighbouring entries of the same priority:
+PRIORITY, UNIQUE_ID, ALLOWED_STATES, QUEUE_STATE_INDEFINITELY, DELETE_STALE_STATES, DATA = range(6)
+QUEUED, PREVIOUS, NEXT = range(6, 9)
+
+
+class StateQueue(object):
+    """A queue of states for a tab. get() blocks until start() has been called, so that
+    the states put whilst the tab is being set up, such as Tab._initialise_worker, are
+    all in the queue, in order, before the first of them is got."""
+    def __init__(self, device_name):
+        self.logger = logging.getLogger('BLACS.%s.state_queue' % (device_name))
+        self.logging_enabled = False
+        if self.logging_enabled:
+            self.logger.debug("started")
+
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._started = False
+        # Unique ids increase monotonically, so that sorting by (priority, unique id)
+        # sorts first by priority and then by order added:
+        self._ids = count(1)
+        self._length = 0
+        # The first and last entries of each priority's linked list, and the
+        # priorities that have entries, sorted:
+        self._firsts = {}
+        self._lasts = {}
+        self._priorities = []
+        # Heaps of the entries for each combination of allowed states, and of the
+        # entries not to be queued indefinitely. Entries compare by priority and then
+        # unique id. Entries that have since been removed are discarded when they reach
+        # the top of a heap:
+        self._heaps = {}
+        self._transient = []
+        # The heaps of the entries allowed in each mode, as requested by get():
+        self._heaps_by_state = {}
+        self.last_requested_state = None
+
+    @property
+    def list_of_states(self):
+        """The entries in the queue, in the order they will be considered"""
+        with self._lock:
+            states = []
+            for priority in self._priorities:
+                entry = self._firsts[priority]
+                while entry is not None:
+                    states.append(entry[:QUEUED])
+                    entry = entry[NEXT]
+            return states
+
+    def log_current_states(self):
+        if self.logging_enabled:
+            self.logger.debug('Current items in the state queue: %s' % str(self.list_of_states))
+
+    def start(self):
+        """Allow get() to return states"""
+        with self._condition:
+            self._started = True
+            self._condition.notify_all()
+
+    def _compact_heaps(self):
+        # Don't let removed entries pile up in heaps of modes that the tab is not often in:
+        for heap in list(self._heaps.values()) + [self._transient]:
+            if len(heap) > 2 * self._length + 64:
+                heap[:] = [entry for entry in heap if entry[QUEUED]]
+                heapify(heap)
+
+    def put(self, allowed_states, queue_state_indefinitely, delete_stale_states, data, priority=0):
+        """Add a state to the queue. Lower number for priority indicates the state will
+        be executed before any states with higher numbers for their priority. May be
+        called from any thread."""
+        with self._lock:
+            unique_id = next(self._ids)
+            entry = [
+                priority,
+                unique_id,
+                allowed_states,
+                queue_state_indefinitely,
+                delete_stale_states,
+                data,
+                True,
+                None,
+                None,
+            ]
+            self._length += 1
+            last = self._lasts.get(priority)
+            if last is None:
+                self._firsts[priority] = entry
+                insort(self._priorities, priority)
+            else:
+                last[NEXT] = entry
+                entry[PREVIOUS] = last
+            self._lasts[priority] = entry
+            try:
+                heappush(self._heaps[allowed_states], entry)
+            except KeyError:
+                self._heaps[allowed_states] = [entry]
+                self._heaps_by_state.clear()
+            if not queue_state_indefinitely:
+                heappush(self._transient, entry)
+            if not unique_id % COMPACTION_INTERVAL:
+                self._compact_heaps()
+            # if this state is one the get command is waiting for, notify it!
+            if self.last_requested_state is not None and allowed_states & self.last_requested_state:
+                self._condition.notify()
+
+        if self.logging_enabled:
+            if not isinstance(data[0], str):
+                self.logger.debug('New state queued up. Allowed modes: %d, queue state indefinitely: %s, delete stale states: %s, function: %s' % (allowed_states, str(queue_state_indefinitely), str(delete_stale_states), data[0].__name__))
+            self.log_current_states()
+
+    def _remove(self, entry):
+        entry[QUEUED] = False
+        self._length -= 1
+        priority, previous, next_entry = entry[PRIORITY], entry[PREVIOUS], entry[NEXT]
+        if previous is not None:
+            previous[NEXT] = next_entry
+        if next_entry is not None:
+            next_entry[PREVIOUS] = previous
+        if previous is None:
+            if next_entry is None:
+                del self._firsts[priority]
+                del self._lasts[priority]
+                self._priorities.remove(priority)
+            else:
+                self._firsts[priority] = next_entry
+        elif next_entry is None:
+            self._lasts[priority] = previous
+
+    def _following(self, entry):
+        # The entry after the given one in the order they will be considered, or None:
+        if entry[NEXT] is not None:
+            return entry[NEXT]
+        i = bisect_right(self._priorities, entry[PRIORITY])
+        if i < len(self._priorities):
+            return self._firsts[self._priorities[i]]
+        return None
+
+    def check_for_next_item(self, state):
+        """Remove and return the data of the first state allowed in the given mode, or
+        None if there is none. The lock must be held."""
+        try:
+            heaps = self._heaps_by_state[state]
+        except KeyError:
+            heaps = [heap for allowed_states, heap in self._heaps.items() if allowed_states & state]
+            self._heaps_by_state[state] = heaps
+        match = None
+        for heap in heaps:
+            # Discard removed entries from the top of the heap:
+            while heap and not heap[0][QUEUED]:
+                heappop(heap)
+            if heap and (match is None or heap[0] < match):
+                match = heap[0]
+
+        # Delete the states we have passed over that are not to be queued indefinitely.
+        # As match is the first allowed state, none of them are allowed:
+        while self._transient and (match is None or self._transient[0] < match):
+            passed_over = heappop(self._transient)
+            if passed_over[QUEUED]:
+                if self.logging_enabled:
+                    self.logger.debug('deleting state that should not be queued indefinitely')
+                self._remove(passed_over)
+
+        if match is None:
+            return None
+
+        if self.logging_enabled:
+            self.logger.debug('requested state found in queue')
+        data = match[DATA]
+        if match[DELETE_STALE_STATES]:
+            # Delete stale states: if the next state is the same state function, use that
+            # one, or whichever is the latest entry without encountering a different
+            # state function, and delete the rest:
+            state_function = data[0]
+            next_entry = self._following(match)
+            while next_entry is not None and next_entry[DATA][0] == state_function:
+                if self.logging_enabled:
+                    self.logger.debug('deleting stale state')
+                data = next_entry[DATA]
+                self._remove(next_entry)
+                next_entry = self._following(match)
+        self._remove(match)
+        return data
+
+    # Only one thread, the tab's mainloop, should ever get from the queue.
+    #
+    # This method will block until a item found in the queue is found to be allowed during the specified 'state'.
+    def get(self, state):
+        with self._condition:
+            if self.last_requested_state:
+                raise Exception('You have multiple threads trying to get from this queue at the same time. I won\'t allow it!')
+            self.last_requested_state = state
+            try:
+                while True:
+                    if self.logging_enabled:
+                        self.logger.debug('requesting next item in queue with mode %d' % state)
+                    if self._started:
+                        data = self.check_for_next_item(state)
+                        if data is not None:
+                            return data
+                    # we didn't find anything useful, so we'll wait until a useful state is added!
+                    self._condition.wait()
+            finally:
+                self.last_requested_state = None
@@ -15,14 +15,15 @@ import time
 import sys
 import threading
 import traceback
+import inspect
 import logging
 import warnings
-import queue
 import pickle
+import queue
 from html import escape
 import os
 from types import GeneratorType
-from bisect import insort
+from collections import OrderedDict
 
 from qtutils.qt.QtCore import *
 from qtutils.qt.QtGui import *
@@ -36,6 +37,10 @@ from labscript_utils.qtwidgets.elide_label import elide_label
 from labscript_utils.ls_zprocess import ProcessTree, RemoteProcessClient
 from labscript_utils.shared_drive import path_to_local
 from blacs import BLACS_DIR
+from blacs.autosave import changes, TABS
+from blacs.state_queue import StateQueue
+from blacs.worker_channel import WorkerChannel, EncodedMessage, get_codec, transfer_stats
+from blacs.shared_buffers import release_unopened
 
 process_tree = ProcessTree.instance()
 from labscript_utils import dedent
@@ -56,147 +61,14 @@ MODE_TRANSITION_TO_BUFFERED = 2
 MODE_TRANSITION_TO_MANUAL = 4
 MODE_BUFFERED = 8  
             
-class StateQueue(object):
-    # NOTE:
-    #
-    # It is theoretically possible to remove the dependency on the Qt Mainloop (remove inmain decorators and fnuction calls)
-    # by introducing a local lock object instead. However, be aware that right now, the Qt inmain lock is preventing the 
-    # statemachine loop (Tab.mainloop) from getting any states uot of the queue until after the entire tab is initialised 
-    # and the Qt mainloop starts.
-    #
-    # This is particularly important because we exploit this behaviour to make sure that Tab._initialise_worker is placed at the
-    # start of the StateQueue, and so the Tab.mainloop method is guaranteed to get this initialisation method as the first state 
-    # regardless of whether the mainloop is started before the state is inserted (the state should always be inserted as part of  
-    # the call to Tab.create_worker, in DeviceTab.initialise_workers in DeviceTab.__init__ )
-    #
-    
-    def __init__(self,device_name):
-        self.logger = logging.getLogger('BLACS.%s.state_queue'%(device_name))
-        self.logging_enabled = False
-        if self.logging_enabled:
-            self.logger.debug("started")
-        
-        self.list_of_states = []
-        self._last_requested_state = None
-        # A queue that blocks the get(requested_state) method until an entry in the queue has a state that matches the requested_state
-        self.get_blocking_queue = queue.Queue()
-
-    @property
-    @inmain_decorator(True)    
-    # This is always done in main so that we avoid a race condition between the get method and
-    # the put method accessing this property
-    def last_requested_state(self):
-        return self._last_requested_state
-    
-    @last_requested_state.setter
-    @inmain_decorator(True)
-    def last_requested_state(self, value):
-        self._last_requested_state = value
-     
-    def log_current_states(self):
-        if self.logging_enabled:
-            self.logger.debug('Current items in the state queue: %s'%str(self.list_of_states))
-     
-    # this should only happen in the main thread, as my implementation is not thread safe!
-    @inmain_decorator(True)   
-    def put(self, allowed_states, queue_state_indefinitely, delete_stale_states, data, priority=0):
-        """Add a state to the queue. Lower number for priority indicates the state will
-        be executed before any states with higher numbers for their priority"""
-        # State data starts with priority, and then with a unique id that monotonically
-        # increases. This way, sorting the queue will sort first by priority and then by
-        # order added.
-        state_data = [priority, get_unique_id(), allowed_states, queue_state_indefinitely, delete_stale_states,data]
-        # Insert the task into the queue, retaining sort order first by priority and then by order added:
-        insort(self.list_of_states, state_data)
-        # if this state is one the get command is waiting for, notify it!
-        if self.last_requested_state is not None and allowed_states&self.last_requested_state:
-            self.get_blocking_queue.put('new item')
-        
-        if self.logging_enabled:
-            if not isinstance(data[0],str):
-                self.logger.debug('New state queued up. Allowed modes: %d, queue state indefinitely: %s, delete stale states: %s, function: %s'%(allowed_states,str(queue_state_indefinitely),str(delete_stale_states),data[0].__name__))
-        self.log_current_states()
-    
-    # this should only happen in the main thread, as my implementation is not thread safe!
-    @inmain_decorator(True)
-    def check_for_next_item(self,state):
-        # We reset the queue here, as we are about to traverse the tree, which contains any new items that
-        # are described in messages in this queue, so let's not keep those messages around anymore.
-        # Put another way, we want to block until a new item is added, if we don't find an item in this function
-        # So it's best if the queue is empty now!
-        if self.logging_enabled:
-            self.logger.debug('Re-initialsing self._get_blocking_queue')
-        self.get_blocking_queue = queue.Queue()
-
-        # traverse the list
-        delete_index_list = []
-        success = False
-        for i,item in enumerate(self.list_of_states):
-            priority, unique_id, allowed_states, queue_state_indefinitely, delete_stale_states, data = item
-            if self.logging_enabled:
-                self.logger.debug('iterating over states in queue')
-            if allowed_states&state:
-                # We have found one! Remove it from the list
-                delete_index_list.append(i)
-                
-                if self.logging_enabled:
-                    self.logger.debug('requested state found in queue')
-                
-                # If we are to delete stale states, see if the next state is the same statefunction.
-                # If it is, use that one, or whichever is the latest entry without encountering a different statefunction,
-                # and delete the rest
-                if delete_stale_states:
-                    state_function = data[0]
-                    i+=1
-                    while i < len(self.list_of_states) and state_function == self.list_of_states[i][5][0]:
-                        if self.logging_enabled:
-                            self.logger.debug('requesting deletion of stale state')
-                        priority, unique_id, allowed_states, queue_state_indefinitely, delete_stale_states, data = self.list_of_states[i]
-                        delete_index_list.append(i)
-                        i+=1
-                
-                success = True
-                break
-            elif not queue_state_indefinitely:
-                if self.logging_enabled:
-                    self.logger.debug('state should not be queued indefinitely')
-                delete_index_list.append(i)
-        
-        # do this in reverse order so that the first delete operation doesn't mess up the indices of subsequent ones
-        for index in reversed(sorted(delete_index_list)):
-            if self.logging_enabled:
-                self.logger.debug('deleting state')
-            del self.list_of_states[index]
-            
-        if not success:
-            data = None
-        return success,data    
-        
-    # this method should not be called in the main thread, because it will block until something is found...
-    # Please, only have one thread ever accessing this...I have no idea how it will behave if multiple threads are trying to get
-    # items from the queue...
-    #
-    # This method will block until a item found in the queue is found to be allowed during the specified 'state'.
-    def get(self,state):
-        if self.last_requested_state:
-            raise Exception('You have multiple threads trying to get from this queue at the same time. I won\'t allow it!')
-    
-        self.last_requested_state = state
-        while True:
-            if self.logging_enabled:
-                self.logger.debug('requesting next item in queue with mode %d'%state)
-                inmain(self.log_current_states)
-            status,data = self.check_for_next_item(state)
-            if not status:
-                # we didn't find anything useful, so we'll wait until a useful state is added!
-                self.get_blocking_queue.get()
-            else:
-                self.last_requested_state = None
-                return data
-
+# The newest version of the protocol between tabs and workers. In version 1, workers
+# acknowledge each job once they have found the method to run, and then send its
+# results. In version 2, tabs check the method exists before sending the job, using a
+# list of the worker's methods, and workers send only the results. Workers start in
+# version 1 and the newest version both ends support is chosen once they have started:
+WORKER_PROTOCOL = 2
 
-# A counter for uniqely numbering timeouts and numbering queued states monotinically,
-# such that sort order coresponds to the order the state was added to the queue:
+# A counter for uniqely numbering timeouts:
 get_unique_id = Counter().get
 
 def define_state(allowed_modes,queue_state_indefinitely,delete_stale_states=False):
@@ -211,6 +83,8 @@ def define_state(allowed_modes,queue_state_indefinitely,delete_stale_states=Fals
             #setattr(self,escapedname,function)
             self.event_queue.put(allowed_modes,queue_state_indefinitely,delete_stale_states,[function,[args,kwargs]])
         f.__name__ = unescaped_name
+        # So that inspect.signature() gives the signature of the wrapped function:
+        f.__wrapped__ = function
         f._allowed_modes = allowed_modes
         return f        
     return wrap
@@ -250,10 +124,31 @@ class Tab(object):
         self._timeouts = set()
         self._timeout_ids = {}
         self._force_full_buffered_reprogram = True
+        # Digest of the device's group in the last shot successfully transitioned to
+        # buffered, as computed by blacs.shot_manifest.device_group_digest():
+        self._last_programmed_digest = None
+        # Tokens reported by each worker identifying what its hardware was programmed
+        # with in that shot, and the digest and tokens saved by a previous session,
+        # which are not trusted until the workers confirm them:
+        self._programmed_state_tokens = {}
+        self._unconfirmed_programmed_state = None
         self.event_queue = StateQueue(self.device_name)
         self.workers = {}
+        # The optional keyword arguments each worker's transition_to_buffered() method
+        # accepts, by worker name:
+        self._worker_parameters = {}
+        # The codec each worker's messages are encoded with, and the channels they are
+        # sent through, by worker name:
+        self._worker_codecs = {}
+        self._worker_channels = {}
+        # The protocol version each worker uses, and the names of its methods, by
+        # worker name:
+        self._worker_protocols = {}
+        self._worker_methods = {}
         self._supports_smart_programming = False
         self._restart_receiver = []
+        # Restart receivers are connected and disconnected by the queue manager thread:
+        self._restart_receiver_lock = threading.Lock()
         self.shutdown_workers_complete = False
 
         self.remote_process_client = self._get_remote_configuration()
@@ -294,6 +189,13 @@ class Tab(object):
         
         # Restore settings:
         self.restore_builtin_save_data(self.settings.get('saved_data', {}))
+        # What the hardware was programmed with before BLACS or the tab was restarted.
+        # Not restored with the rest of the builtin save data, as that may come from
+        # front panels loaded from other files:
+        self._unconfirmed_programmed_state = self.settings.get('saved_data', {}).get('_programmed_state')
+        if self._unconfirmed_programmed_state is not None:
+            # Let the user discard it:
+            self._ui.button_clear_smart_programming.setEnabled(True)
 
         # This should be done beofre the main_loop starts or else there is a race condition as to whether the 
         # self._mode variable is even defined!
@@ -310,6 +212,10 @@ class Tab(object):
         self._mainloop_thread = threading.Thread(target = self.mainloop)
         self._mainloop_thread.daemon = True
         self._mainloop_thread.start()
+        # Let the mainloop get states once the Qt mainloop is running, by which time the
+        # tab will be initialised and Tab._initialise_worker, queued with priority -1
+        # by create_worker(), will be at the start of the state queue:
+        inmain_later(self.event_queue.start)
                 
         # Add the tab to the notebook
         self.notebook.addTab(self._ui,self.device_name)
@@ -339,7 +245,33 @@ class Tab(object):
         """Get builtin settings to be restored like whether the terminal is
         visible. Not to be overridden."""
         return {'_terminal_visible': self._ui.button_show_terminal.isChecked(),
-                '_splitter_sizes': self._ui.splitter.sizes()}
+                '_splitter_sizes': self._ui.splitter.sizes(),
+                '_programmed_state': self.get_programmed_state()}
+
+    def get_programmed_state(self):
+        """Return the digest of the device's group in the last shot it was programmed
+        with and the tokens its workers reported for it, for confirming after a restart
+        that the hardware still holds that shot's instructions. None if unknown."""
+        if self._last_programmed_digest is not None and self._programmed_state_tokens:
+            return {'digest': self._last_programmed_digest,
+                    'tokens': dict(self._programmed_state_tokens)}
+        # Keep that of the previous session until it has been checked:
+        return self._unconfirmed_programmed_state
+
+    def invalidate_programmed_state(self):
+        """Forget what the hardware was last programmed with, so that workers are not
+        told the next shot is unchanged, including after a restart. Call this if the
+        hardware may have been reprogrammed outside of a shot."""
+        if (
+            self._last_programmed_digest is None
+            and not self._programmed_state_tokens
+            and self._unconfirmed_programmed_state is None
+        ):
+            return
+        self._last_programmed_digest = None
+        self._programmed_state_tokens = {}
+        self._unconfirmed_programmed_state = None
+        changes.mark(TABS)
 
     def get_all_save_data(self):
         save_data = self.get_builtin_save_data()
@@ -378,11 +310,15 @@ class Tab(object):
     @force_full_buffered_reprogram.setter
     def force_full_buffered_reprogram(self,value):
         self._force_full_buffered_reprogram = bool(value)
+        if self._force_full_buffered_reprogram:
+            # Workers should not be told that shots are unchanged until reprogrammed:
+            self.invalidate_programmed_state()
         self._ui.button_clear_smart_programming.setEnabled(not bool(value))
     
     @property
-    @inmain_decorator(True)
     def error_message(self):
+        # Only ever set in the main thread, but may be read from any thread without
+        # waiting on the Qt mainloop:
         return self._error
     
     @error_message.setter
@@ -480,7 +416,7 @@ class Tab(object):
         
         # Todo: Update icon in tab
     
-    def create_worker(self,name,WorkerClass,workerargs=None):
+    def create_worker(self,name,WorkerClass,workerargs=None,codec='pickle'):
         """Set up a worker process. WorkerClass can either be a subclass of Worker, or a
         string containing a fully qualified import path to a worker. The latter is
         useful if the worker class is in a separate file with global imports or other
@@ -489,10 +425,17 @@ class Tab(object):
         case once remote worker processes are implemented and the worker may be on a
         separate computer). The worker process will not be started immediately, it will
         be started once the state machine mainloop begins running. This way errors in
-        startup will be handled using the normal state machine machinery."""
+        startup will be handled using the normal state machine machinery.
+
+        codec is the name of the codec that jobs sent to the worker and their results are
+        encoded with, one of those in blacs.worker_channel."""
 
-        if workerargs is None:
-            workerargs = {}
+        # A copy, so as not to modify the caller's dict:
+        workerargs = dict(workerargs) if workerargs is not None else {}
+        # Raise an exception now if the codec is not available:
+        get_codec(codec)
+        self._worker_codecs[name] = codec
+        workerargs['_codec'] = codec
         # Add all connection table properties, if they were not already specified in
         # workerargs:
         conntable = self.settings['connection_table']
@@ -534,6 +477,33 @@ class Tab(object):
         yield (self.queue_work(worker_name, 'init', worker_name, self.device_name, workerargs))
         if self.error_message:
             raise Exception('Device failed to initialise')
+        negotiated = yield (self.queue_work(worker_name, '_negotiate_protocol', WORKER_PROTOCOL))
+        if negotiated is None:
+            # A worker from an older version of BLACS, such as on a remote computer. It
+            # stays on protocol 1 and is only sent the arguments it has always accepted:
+            self._worker_parameters[worker_name] = set()
+            return
+        protocol, methods = negotiated
+        self._worker_methods[worker_name] = set(methods)
+        self._worker_protocols[worker_name] = protocol
+        parameters = yield (self.queue_work(worker_name, '_transition_to_buffered_parameters'))
+        self._worker_parameters[worker_name] = set(parameters or ())
+
+    def worker_protocol(self, worker_name):
+        """The version of the protocol used with the named worker. Workers on version 1
+        are from older versions of BLACS, and have none of the worker methods added
+        since, such as _prepare_buffered() and _programmed_state_token()"""
+        return self._worker_protocols.get(worker_name, 1)
+
+    def worker_accepts(self, worker_name, parameter):
+        """Whether the transition_to_buffered() method of the named worker accepts the
+        given optional keyword argument"""
+        return parameter in self._worker_parameters.get(worker_name, ())
+
+    def workers_accept(self, parameter):
+        """Whether the transition_to_buffered() method of any of the tab's workers
+        accepts the given optional keyword argument"""
+        return any(parameter in parameters for parameters in self._worker_parameters.values())
                
     @define_state(MODE_MANUAL|MODE_BUFFERED|MODE_TRANSITION_TO_BUFFERED|MODE_TRANSITION_TO_MANUAL,True)  
     def _timeout_add(self,delay,execute_timeout):
@@ -646,6 +616,7 @@ class Tab(object):
             for name in self.workers.copy():
                 worker, _, _ = self.workers.pop(name)
                 worker.terminate(**kwargs)
+                self._close_worker_channel(name, worker)
         except Interrupted:
             self.logger.warning(
                 "Terminating workers of %s timed out", self.device_name
@@ -658,17 +629,31 @@ class Tab(object):
                 inmain(timer.stop)
         
 
+    def _close_worker_channel(self, name, worker):
+        # Free the shared memory of any messages the terminated worker will not reply
+        # to, and of any it was sending that we will not open:
+        channel = self._worker_channels.pop(name, None)
+        if channel is None:
+            return
+        channel.close()
+        if channel.shared_memory and worker.child is not None:
+            release_unopened(worker.child.pid)
+
     def connect_restart_receiver(self,function):
-        if function not in self._restart_receiver:
-            self._restart_receiver.append(function)
+        with self._restart_receiver_lock:
+            if function not in self._restart_receiver:
+                self._restart_receiver.append(function)
             
     def disconnect_restart_receiver(self,function):
-        if function in self._restart_receiver:
-            self._restart_receiver.remove(function)
+        with self._restart_receiver_lock:
+            if function in self._restart_receiver:
+                self._restart_receiver.remove(function)
     
     def restart(self,*args):
         # notify all connected receivers:
-        for f in self._restart_receiver:
+        with self._restart_receiver_lock:
+            restart_receivers = list(self._restart_receiver)
+        for f in restart_receivers:
             try:
                 f(self.device_name)
             except Exception:
@@ -717,6 +702,9 @@ class Tab(object):
         # self.BLACS.current_queue.put('abort')
     
     def queue_work(self,worker_process,worker_function,*args,**kwargs):
+        # To be yielded from a state. A list of these for different workers may instead
+        # be yielded to have the workers do them at the same time, in which case a list
+        # of their results is sent back:
         return worker_process,worker_function,args,kwargs
         
     def set_terminal_visible(self, visible):
@@ -764,6 +752,9 @@ class Tab(object):
         # Store a reference to the state queue and workers, this way if the tab is restarted, we won't ever get access to the new state queue created then
         event_queue = self.event_queue
         workers = self.workers
+        worker_channels = self._worker_channels
+        worker_protocols = self._worker_protocols
+        worker_methods = self._worker_methods
         
         try:
             while True:
@@ -785,59 +776,116 @@ class Tab(object):
                 if type(generator) == GeneratorType:
                     # We need to call next recursively, queue up work and send the results back until we get a StopIteration exception
                     generator_running = True
-                    # get the data from the first yield function
-                    worker_process,worker_function,worker_args,worker_kwargs = inmain(generator.__next__)
+                    # get the data from the first yield function. This is either a single
+                    # job, or a list of jobs for different workers to do at the same time:
+                    next_yield = inmain(generator.__next__)
                     # Continue until we get a StopIteration exception, or the user requests a restart
                     while generator_running:
                         try:
-                            logger.debug('Instructing worker %s to do job %s'%(worker_process,worker_function) )
-                            if worker_function == 'init':
-                                # Start the worker process before running its init() method:
-                                self.state = '%s (%s)'%('Starting worker process', worker_process)
-                                worker, _, _ = self.workers[worker_process]
-                                to_worker, from_worker = worker.start(*worker_args)
-                                self.workers[worker_process] = (worker, to_worker, from_worker)
-                                worker_args = ()
-                                del worker # Do not gold a reference indefinitely
-                            worker_arg_list = (worker_function,worker_args,worker_kwargs)
-                            # This line is to catch if you try to pass unpickleable objects.
-                            try:
-                                pickle.dumps(worker_arg_list)
-                            except Exception:
-                                self.error_message += 'Attempt to pass unserialisable object to child process:'
-                                raise
-                            # Send the command to the worker
-                            to_worker = workers[worker_process][1]
-                            from_worker = workers[worker_process][2]
-                            to_worker.put(worker_arg_list)
-                            self.state = '%s (%s)'%(worker_function,worker_process)
-                            # Confirm that the worker got the message:
-                            logger.debug('Waiting for worker to acknowledge job request')
-                            success, message, results = from_worker.get()
-                            if not success:
-                                logger.info('Worker reported failure to start job')
-                                raise Exception(message)
-                            # Wait for and get the results of the work:
-                            logger.debug('Worker reported job started, waiting for completion')
-                            success,message,results = from_worker.get()
-                            if not success:
-                                logger.info('Worker reported exception during job')
-                                now = time.strftime('%a %b %d, %H:%M:%S ',time.localtime())
-                                self.error_message += ('Exception in worker - %s:<br />' % now +
-                                               '<FONT COLOR=\'#ff0000\'>%s</FONT><br />'%escape(message).replace(' ','&nbsp;').replace('\n','<br />'))
-                            else:
-                                logger.debug('Job completed')
-                            
-                            # Reset the hide_not_responding_error_until, since we have now heard from the child                        
-                            self.hide_not_responding_error_until = 0
+                            parallel = isinstance(next_yield, list)
+                            jobs = next_yield if parallel else [next_yield]
+                            if len(set(job[0] for job in jobs)) < len(jobs):
+                                raise ValueError('Jobs yielded together must be for different workers')
+                            # Send all the jobs before waiting for any of them:
+                            sent_jobs = []
+                            for worker_process,worker_function,worker_args,worker_kwargs in jobs:
+                                logger.debug('Instructing worker %s to do job %s'%(worker_process,worker_function) )
+                                if worker_function == 'init':
+                                    # Start the worker process before running its init() method:
+                                    self.state = '%s (%s)'%('Starting worker process', worker_process)
+                                    worker, _, _ = self.workers[worker_process]
+                                    to_worker, from_worker = worker.start(*worker_args)
+                                    self.workers[worker_process] = (worker, to_worker, from_worker)
+                                    worker_channels[worker_process] = WorkerChannel(
+                                        self._worker_codecs[worker_process],
+                                        shared_memory=self.remote_process_client is None,
+                                    )
+                                    worker_protocols[worker_process] = 1
+                                    worker_args = ()
+                                    del worker # Do not gold a reference indefinitely
+                                protocol = worker_protocols[worker_process]
+                                if protocol >= 2 and worker_function not in worker_methods[worker_process]:
+                                    # Don't send a job the worker can't start:
+                                    logger.info('Worker has no method for job')
+                                    raise Exception(
+                                        'Worker %s of %s has no method %s' %
+                                        (worker_process, self.device_name, worker_function)
+                                    )
+                                worker_arg_list = (worker_function,worker_args,worker_kwargs)
+                                # This line is to catch if you try to pass unpickleable
+                                # objects. The encoded message is what is sent, except
+                                # under protocol 1, as older workers cannot decode it:
+                                channel = worker_channels[worker_process]
+                                try:
+                                    if protocol >= 2:
+                                        request = channel.pack(worker_arg_list)
+                                    else:
+                                        pickle.dumps(worker_arg_list)
+                                        request = worker_arg_list
+                                except Exception:
+                                    self.error_message += 'Attempt to pass unserialisable object to child process:'
+                                    raise
+                                # Send the command to the worker
+                                to_worker = workers[worker_process][1]
+                                to_worker.put(request)
+                                sent_jobs.append((worker_process, worker_function, protocol, channel, request))
+                            self.state = ', '.join(
+                                '%s (%s)'%(worker_function,worker_process)
+                                for worker_process, worker_function, _, _, _ in sent_jobs
+                            )
+                            all_results = []
+                            for worker_process, worker_function, protocol, channel, request in sent_jobs:
+                                from_worker = workers[worker_process][2]
+                                if protocol < 2:
+                                    # Confirm that the worker got the message:
+                                    logger.debug('Waiting for worker to acknowledge job request')
+                                    success, message, results = channel.unpack(from_worker.get())
+                                    if not success and worker_function == '_negotiate_protocol':
+                                        # A worker from an older version of BLACS, which
+                                        # sends nothing more. It stays on protocol 1:
+                                        logger.info('Worker does not support protocol negotiation')
+                                        all_results.append(None)
+                                        continue
+                                    if not success:
+                                        logger.info('Worker reported failure to start job')
+                                        raise Exception(message)
+                                # Wait for and get the results of the work:
+                                logger.debug('Waiting for job completion')
+                                reply = from_worker.get()
+                                start_time = time.perf_counter()
+                                success,message,results = channel.unpack(reply)
+                                if success is None:
+                                    # Protocol version 2 only, the worker could not start
+                                    # the job after all:
+                                    logger.info('Worker reported failure to start job')
+                                    raise Exception(message)
+                                if isinstance(request, EncodedMessage) and isinstance(reply, EncodedMessage):
+                                    decode_time = time.perf_counter() - start_time
+                                    transfer_stats.record(
+                                        self.device_name, worker_process, worker_function,
+                                        request, reply, decode_time,
+                                    )
+                                    logger.debug(
+                                        'Job %s sent %d bytes and received %d bytes' %
+                                        (worker_function, request.nbytes, reply.nbytes)
+                                    )
+                                if not success:
+                                    logger.info('Worker reported exception during job')
+                                    now = time.strftime('%a %b %d, %H:%M:%S ',time.localtime())
+                                    self.error_message += ('Exception in worker - %s:<br />' % now +
+                                                   '<FONT COLOR=\'#ff0000\'>%s</FONT><br />'%escape(message).replace(' ','&nbsp;').replace('\n','<br />'))
+                                else:
+                                    logger.debug('Job completed')
                                 
-                            # Send the results back to the GUI function
+                                # Reset the hide_not_responding_error_until, since we have now heard from the child                        
+                                self.hide_not_responding_error_until = 0
+                                all_results.append(results)
+                                
+                            # Send the results back to the GUI function, as a list
+                            # if the jobs were yielded as one:
                             logger.debug('returning worker results to function %s' % func.__name__)
                             self.state = '%s (GUI)'%func.__name__
-                            next_yield = inmain(generator.send,results) 
-                            # If there is another yield command, put the data in the required variables for the next loop iteration
-                            if next_yield:
-                                worker_process,worker_function,worker_args,worker_kwargs = next_yield
+                            next_yield = inmain(generator.send,all_results if parallel else all_results[0])
                         except StopIteration:
                             # The generator has finished. Ignore the error, but stop the loop
                             logger.debug('Finalising function')
@@ -861,7 +909,80 @@ class Tab(object):
         logger.info('Exiting')
         
         
+def _nbytes(obj):
+    # Approximate memory used by the data in obj, counting only arrays and bytes, which
+    # dominate the size of device instructions:
+    nbytes = getattr(obj, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(_nbytes(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(item) for item in obj)
+    return 0
+
+
+class PreparedBuffers(object):
+    """Instructions prepared by a worker's prepare_buffered() method, by shot file,
+    discarding the least recently prepared once their total size exceeds
+    max_nbytes. Entries are discarded if their shot file has since been modified."""
+    def __init__(self, max_nbytes):
+        self.max_nbytes = max_nbytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _stat(h5_file):
+        stat = os.stat(h5_file)
+        return stat.st_size, stat.st_mtime_ns
+
+    def __contains__(self, h5_file):
+        return h5_file in self._entries
+
+    def add(self, h5_file, stat, buffers):
+        """Store buffers prepared from h5_file, which had the given stat when it was
+        read. Return whether they were stored"""
+        self.discard(h5_file)
+        nbytes = _nbytes(buffers)
+        if nbytes > self.max_nbytes:
+            return False
+        self._entries[h5_file] = (stat, nbytes, buffers)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_nbytes:
+            _, (_, oldest_nbytes, _) = self._entries.popitem(last=False)
+            self.nbytes -= oldest_nbytes
+        return True
+
+    def discard(self, h5_file):
+        try:
+            _, nbytes, _ = self._entries.pop(h5_file)
+        except KeyError:
+            return
+        self.nbytes -= nbytes
+
+    def pop(self, h5_file):
+        """Remove and return the buffers prepared from h5_file, or None if there are
+        none or the file has changed since"""
+        try:
+            stat, nbytes, buffers = self._entries.pop(h5_file)
+        except KeyError:
+            return None
+        self.nbytes -= nbytes
+        try:
+            if self._stat(h5_file) != stat:
+                return None
+        except OSError:
+            return None
+        return buffers
+
+
 class Worker(Process):
+    # The memory that instructions returned by prepare_buffered() may occupy whilst
+    # waiting to be used. Override in subclasses as appropriate:
+    prepared_buffers_memory = 256 * 1024**2
+
     def init(self):
         # To be overridden by subclasses
         pass
@@ -880,6 +1001,11 @@ class Worker(Process):
         process_tree = ProcessTree.instance()
         import labscript_utils.h5_lock
         process_tree.zlock_client.set_process_name(log_name)
+        # For encoding messages to and from the tab, with the codec it chose:
+        self._channel = WorkerChannel(
+            extraargs.pop('_codec', 'pickle'),
+            shared_memory=not extraargs.get('is_remote', False),
+        )
         for name, value in extraargs.items():
             if hasattr(self, name):
                 msg = """attribute `{}` overwrites an attribute of the Worker base class
@@ -888,22 +1014,164 @@ class Worker(Process):
                 warnings.warn(dedent(msg).format(name), RuntimeWarning)
             else:
                 setattr(self, name, value)
-        self.mainloop()
+        self._prepared_buffers = PreparedBuffers(self.prepared_buffers_memory)
+        # Shots queued to be prepared by the thread running _prepare_loop(), and the
+        # one it is preparing. The condition protects these and self._prepared_buffers:
+        self._prepare_condition = threading.Condition()
+        self._prepare_pending = []
+        self._preparing = None
+        self._prepare_thread = None
+        # Until the tab negotiates a newer version:
+        self._protocol = 1
+        try:
+            self.mainloop()
+        finally:
+            # If we are exiting other than by being terminated, free the shared memory
+            # of any reply the tab has not opened:
+            self._channel.close()
 
-    def _transition_to_buffered(self, device_name, h5_file, front_panel_values, fresh):
+    def _transition_to_buffered(self, device_name, h5_file, front_panel_values, fresh, unchanged=False, device_group=None):
         # The h5_file arg was converted to network-agnostic before being sent to us.
         # Convert it to a local path before calling the subclass's
         # transition_to_buffered() method
         h5_file = path_to_local(h5_file)
+        # unchanged is True if the device's group in the shot file is identical to
+        # that of the last shot transitioned to buffered, in which case the worker
+        # may skip programming its tables. It is only passed to subclasses whose
+        # transition_to_buffered() method accepts it. device_group is the device's group
+        # in the shot file, read by BLACS, for subclasses that accept it:
+        kwargs = {}
+        if unchanged and 'unchanged' in self._transition_to_buffered_parameters():
+            kwargs['unchanged'] = True
+        if device_group is not None and 'device_group' in self._transition_to_buffered_parameters():
+            kwargs['device_group'] = device_group
         return self.transition_to_buffered(
-            device_name, h5_file, front_panel_values, fresh
+            device_name, h5_file, front_panel_values, fresh, **kwargs
         )
 
+    def _negotiate_protocol(self, version):
+        # Switch to the newest protocol version both we and the tab support, version
+        # being the newest the tab supports. Takes effect from the next job, as this
+        # one has already been acknowledged. Returns the version, and our methods for
+        # the tab to check jobs against:
+        self._protocol = min(version, WORKER_PROTOCOL)
+        methods = [
+            name for name in dir(type(self)) if callable(getattr(type(self), name, None))
+        ]
+        methods.extend(name for name, value in vars(self).items() if callable(value))
+        return self._protocol, methods
+
+    def _prepare_buffered(self, h5_file):
+        # Called ahead of time for shots in the queue. Returns whether the subclass
+        # implements prepare_buffered(), in which case the shot is queued to be
+        # prepared in a separate thread, and this returns straight away, so that the
+        # tab may ask for it whilst a shot is running. The instructions returned are
+        # kept for the subclass's transition_to_buffered() method to retrieve with
+        # get_prepared_buffers():
+        if not hasattr(self, 'prepare_buffered'):
+            return False
+        h5_file = path_to_local(h5_file)
+        with self._prepare_condition:
+            if (
+                h5_file not in self._prepared_buffers
+                and h5_file not in self._prepare_pending
+                and h5_file != self._preparing
+            ):
+                self._prepare_pending.append(h5_file)
+                if self._prepare_thread is None:
+                    self._prepare_thread = threading.Thread(
+                        target=self._prepare_loop, daemon=True
+                    )
+                    self._prepare_thread.start()
+                self._prepare_condition.notify_all()
+        return True
+
+    def _cancel_prepared_buffers(self, h5_files):
+        # Called for shots no longer coming up in the queue, to not prepare them, or
+        # discard their instructions if already prepared:
+        with self._prepare_condition:
+            for h5_file in map(path_to_local, h5_files):
+                if h5_file in self._prepare_pending:
+                    self._prepare_pending.remove(h5_file)
+                if h5_file == self._preparing:
+                    # The result will be discarded once prepare_buffered() returns:
+                    self._preparing = None
+                self._prepared_buffers.discard(h5_file)
+            self._prepare_condition.notify_all()
+
+    def _prepare_loop(self):
+        while True:
+            with self._prepare_condition:
+                while not self._prepare_pending:
+                    self._prepare_condition.wait()
+                h5_file = self._prepare_pending.pop(0)
+                self._preparing = h5_file
+            stat = buffers = None
+            try:
+                # Stat before reading, so that changes whilst reading are also
+                # detected:
+                stat = PreparedBuffers._stat(h5_file)
+                buffers = self.prepare_buffered(h5_file)
+            except Exception:
+                self.logger.exception('Could not prepare %s' % h5_file)
+            with self._prepare_condition:
+                if self._preparing == h5_file:
+                    self._preparing = None
+                    if buffers is not None and not self._prepared_buffers.add(
+                        h5_file, stat, buffers
+                    ):
+                        self.logger.warning(
+                            'Instructions prepared from %s exceed prepared_buffers_memory'
+                            % h5_file
+                        )
+                self._prepare_condition.notify_all()
+
+    def get_prepared_buffers(self, h5_file):
+        """Return the instructions returned by prepare_buffered(h5_file) if it was
+        called ahead of time and the file has not changed since, otherwise None. Each
+        is returned only once. If the shot is still being prepared, waits for it to be
+        done, and if it has not yet started being prepared, it no longer will be."""
+        with self._prepare_condition:
+            if h5_file in self._prepare_pending:
+                self._prepare_pending.remove(h5_file)
+            while self._preparing == h5_file:
+                self._prepare_condition.wait()
+            return self._prepared_buffers.pop(h5_file)
+
+    def _programmed_state_token(self):
+        # A token identifying what the hardware currently holds, from the subclass's
+        # programmed_state_token() method if it has one, or None:
+        if not hasattr(self, 'programmed_state_token'):
+            return None
+        try:
+            return self.programmed_state_token()
+        except Exception:
+            self.logger.exception('Could not get programmed state token')
+            return None
+
+    def _confirm_programmed_state(self, token):
+        # Whether the hardware still holds what it held when token was reported:
+        current_token = self._programmed_state_token()
+        return current_token is not None and current_token == token
+
+    def _transition_to_buffered_parameters(self):
+        # The names of the parameters of the subclass's transition_to_buffered()
+        # method, so that optional arguments are only passed if it accepts them:
+        try:
+            return self._transition_to_buffered_parameter_names
+        except AttributeError:
+            parameters = inspect.signature(self.transition_to_buffered).parameters
+            self._transition_to_buffered_parameter_names = list(parameters)
+            return self._transition_to_buffered_parameter_names
+
     def mainloop(self):
         while True:
             # Get the next task to be done:
             self.logger.debug('Waiting for next job request')
-            funcname, args, kwargs = self.from_parent.get()
+            request = self.from_parent.get()
+            start_time = time.perf_counter()
+            funcname, args, kwargs = self._channel.unpack(request)
+            decode_time = time.perf_counter() - start_time
             self.logger.debug('Got job request %s' % funcname)
             try:
                 # See if we have a method with that name:
@@ -914,8 +1182,15 @@ class Worker(Process):
                 success = False
                 message = traceback.format_exc()
                 self.logger.error('Couldn\'t start job:\n %s'%message)
-            # Report to the parent whether method lookup was successful or not:
-            self.to_parent.put((success,message,None))
+            # The protocol this job is done under, as _negotiate_protocol() only
+            # changes it from the next job:
+            protocol = self._protocol
+            if protocol < 2:
+                # Report to the parent whether method lookup was successful or not:
+                self.to_parent.put((success,message,None))
+            elif not success:
+                # Reported in place of the results instead:
+                self.to_parent.put((None,message,None))
             if success:
                 # Try to do the requested work:
                 self.logger.debug('Starting job %s'%funcname)
@@ -931,18 +1206,24 @@ class Worker(Process):
                     del traceback_lines[1]
                     message = ''.join(traceback_lines)
                     self.logger.error('Exception in job:\n%s'%message)
-                # Check if results object is serialisable:
+                # Check if results object is serialisable. Under protocol 2 the encoded
+                # message is what is sent, whereas tabs of older versions of BLACS
+                # expect the results as they are:
                 try:
-                    pickle.dumps(results)
+                    if protocol < 2:
+                        pickle.dumps(results)
+                        reply = (success,message,results)
+                    else:
+                        reply = self._channel.pack((success,message,results))
+                        reply.peer_decode_time = decode_time
                 except Exception:
                     message = traceback.format_exc()
                     self.logger.error('Job returned unserialisable datatypes, cannot pass them back to parent.\n' + message)
                     message = 'Attempt to pass unserialisable object %s to parent process:\n' % str(results) + message
-                    success = False
-                    results = None
+                    reply = (False,message,None)
                 # Report to the parent whether work was successful or not,
                 # and what the results were:
-                self.to_parent.put((success,message,results))
+                self.to_parent.put(reply)
 
 
 class PluginTab(object):
@@ -0,0 +1,279 @@
+#####################################################################
+#                                                                   #
+# /worker_channel.py                                                #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Encoding of the messages sent between tabs and their worker processes.
+
+Each job sent to a worker, and the results it returns, are encoded once, with a codec
+chosen per worker, and sent through the worker's zprocess queues as an EncodedMessage,
+whose encoded data zprocess then pickles as a single bytes object. Encoding doubles as
+the check that the message can be sent at all. The available codecs are:
+
+``'pickle'``
+    The default. Pickle protocol 5, with buffers of at least MIN_SHARED_NBYTES, such
+    as large numpy arrays, placed in shared memory for local workers (see
+    blacs.shared_buffers) rather than in the pickle.
+``'pickle+lz4'``
+    Pickle, compressed with lz4, for remote workers on slow networks. Requires the
+    lz4 package.
+``'msgpack'``
+    msgpack, for messages made only of basic types and numpy arrays. Tuples are
+    received as lists. Requires the msgpack package.
+
+The size of each message, and the time taken to encode and decode it, are added to
+transfer_stats, by device, worker and job."""
+import time
+import pickle
+import logging
+import threading
+from collections import defaultdict
+
+from blacs.shared_buffers import shared_memory_supported, share, open_shared, release
+
+logger = logging.getLogger('BLACS.worker_channel')
+
+# Smaller buffers are pickled in-band as usual:
+MIN_SHARED_NBYTES = 1 << 20
+
+
+class EncodedMessage(object):
+    """A message encoded with the named codec. shared is None, or the name, size and
+    buffer regions of a shared memory mapping holding the message's out-of-band
+    buffers. encode_time is the time the sender took to encode it, and
+    peer_decode_time, in replies, the time the sender took to decode the message
+    being replied to."""
+    __slots__ = ('codec', 'data', 'shared', 'encode_time', 'peer_decode_time')
+
+    def __init__(self, codec, data, shared=None, encode_time=0.0, peer_decode_time=0.0):
+        self.codec = codec
+        self.data = data
+        self.shared = shared
+        self.encode_time = encode_time
+        self.peer_decode_time = peer_decode_time
+
+    def __getstate__(self):
+        return (self.codec, self.data, self.shared, self.encode_time, self.peer_decode_time)
+
+    def __setstate__(self, state):
+        self.codec, self.data, self.shared, self.encode_time, self.peer_decode_time = state
+
+    @property
+    def nbytes(self):
+        """The size of the encoded message, including any buffers in shared memory"""
+        nbytes = len(self.data)
+        if self.shared is not None:
+            nbytes += sum(region_nbytes for _, region_nbytes in self.shared[2])
+        return nbytes
+
+
+class PickleCodec(object):
+    name = 'pickle'
+    supports_buffers = True
+
+    def dumps(self, obj, buffer_callback=None):
+        return pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+
+    def loads(self, data, buffers=None):
+        return pickle.loads(data, buffers=buffers)
+
+
+class LZ4PickleCodec(object):
+    name = 'pickle+lz4'
+    supports_buffers = False
+
+    def __init__(self):
+        import lz4.frame
+        self._lz4 = lz4.frame
+
+    def dumps(self, obj):
+        return self._lz4.compress(pickle.dumps(obj, protocol=5))
+
+    def loads(self, data):
+        return pickle.loads(self._lz4.decompress(data))
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    supports_buffers = False
+    # msgpack extension type code for numpy arrays:
+    _NDARRAY = 1
+
+    def __init__(self):
+        import msgpack
+        import numpy
+        self._msgpack = msgpack
+        self._numpy = numpy
+
+    def _default(self, obj):
+        numpy = self._numpy
+        if isinstance(obj, numpy.ndarray) and not obj.dtype.hasobject and obj.dtype.names is None:
+            data = self._msgpack.packb(
+                [obj.dtype.str, list(obj.shape), numpy.ascontiguousarray(obj).tobytes()]
+            )
+            return self._msgpack.ExtType(self._NDARRAY, data)
+        if isinstance(obj, numpy.generic):
+            return obj.item()
+        raise TypeError('Cannot encode object of type %s with msgpack' % type(obj).__name__)
+
+    def _ext_hook(self, code, data):
+        if code == self._NDARRAY:
+            dtype, shape, array_bytes = self._msgpack.unpackb(data)
+            array = self._numpy.frombuffer(array_bytes, dtype=self._numpy.dtype(dtype))
+            return array.reshape(shape).copy()
+        return self._msgpack.ExtType(code, data)
+
+    def dumps(self, obj):
+        return self._msgpack.packb(obj, default=self._default, use_bin_type=True)
+
+    def loads(self, data):
+        return self._msgpack.unpackb(
+            data, ext_hook=self._ext_hook, raw=False, strict_map_key=False
+        )
+
+
+_CODEC_CLASSES = {cls.name: cls for cls in [PickleCodec, LZ4PickleCodec, MsgpackCodec]}
+_codecs = {}
+
+
+def get_codec(name):
+    """Return the codec of the given name. Raises ValueError if there is no such
+    codec, and ImportError if a package it requires is not installed"""
+    try:
+        return _codecs[name]
+    except KeyError:
+        pass
+    try:
+        cls = _CODEC_CLASSES[name]
+    except KeyError:
+        msg = 'Unknown codec %r, must be one of %s' % (name, ', '.join(_CODEC_CLASSES))
+        raise ValueError(msg) from None
+    codec = _codecs[name] = cls()
+    return codec
+
+
+class WorkerChannel(object):
+    """One end of the connection between a tab and one of its workers. Messages to be
+    sent are passed through pack(), and messages received through unpack(). Shared
+    memory is only used if shared_memory is True, which it should not be for remote
+    workers, and the codec supports it.
+
+    The sender keeps its end of each shared memory mapping until it next receives a
+    message from the other end, which, as tabs and workers take turns sending to each
+    other, will have unpacked it by then, or until close() is called."""
+    def __init__(self, codec='pickle', shared_memory=True):
+        self.codec = get_codec(codec)
+        self.shared_memory = (
+            shared_memory and self.codec.supports_buffers and shared_memory_supported()
+        )
+        # Mappings we have sent that the other end may not have opened yet:
+        self._unconfirmed = []
+
+    def pack(self, obj):
+        """Return obj encoded as an EncodedMessage. Raises an exception if obj cannot
+        be encoded"""
+        start_time = time.perf_counter()
+        if not self.shared_memory:
+            message = EncodedMessage(self.codec.name, self.codec.dumps(obj))
+            message.encode_time = time.perf_counter() - start_time
+            return message
+        buffers = []
+
+        def buffer_callback(buffer):
+            # Returning True pickles the buffer in-band:
+            if buffer.raw().nbytes < MIN_SHARED_NBYTES:
+                return True
+            buffers.append(buffer.raw())
+            return False
+
+        data = self.codec.dumps(obj, buffer_callback=buffer_callback)
+        shared = None
+        if buffers:
+            try:
+                name, size, regions, handle = share(buffers)
+            except OSError:
+                logger.warning('Could not create shared memory, sending buffers in-band')
+                data = self.codec.dumps(obj)
+            else:
+                shared = (name, size, regions)
+                self._unconfirmed.append(handle)
+        return EncodedMessage(
+            self.codec.name, data, shared, encode_time=time.perf_counter() - start_time
+        )
+
+    def unpack(self, message):
+        """Return the object sent as message. Messages that are not EncodedMessages
+        are returned as they are"""
+        # The other end has unpacked everything we sent it before sending this:
+        self.release()
+        if not isinstance(message, EncodedMessage):
+            return message
+        codec = get_codec(message.codec)
+        if message.shared is not None:
+            # Arrays made from the buffers point into the shared memory:
+            return codec.loads(message.data, buffers=open_shared(*message.shared))
+        return codec.loads(message.data)
+
+    def release(self):
+        """Free mappings we have sent, once the other end has opened them"""
+        while self._unconfirmed:
+            release(self._unconfirmed.pop())
+
+    def close(self):
+        """Free all mappings we have sent, for when the other end will not reply, such
+        as when the worker is being restarted or is exiting"""
+        self.release()
+
+
+class TransferStats(object):
+    """Totals of the number of jobs sent to workers, the sizes of the messages sent
+    and received, and the time spent encoding and decoding them on both ends, by
+    device, worker and job. Thread-safe."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = defaultdict(lambda: [0, 0, 0, 0.0])
+
+    def record(self, device_name, worker_name, job, sent, received, decode_time):
+        """Add a job whose request and reply were the EncodedMessages sent and
+        received, and whose reply took decode_time to decode"""
+        serialisation_time = (
+            sent.encode_time + received.encode_time
+            + received.peer_decode_time + decode_time
+        )
+        with self._lock:
+            totals = self._totals[device_name, worker_name, job]
+            totals[0] += 1
+            totals[1] += sent.nbytes
+            totals[2] += received.nbytes
+            totals[3] += serialisation_time
+
+    def totals(self):
+        """Return a dict of (jobs, bytes sent, bytes received, serialisation time)
+        tuples, by (device name, worker name, job) tuples"""
+        with self._lock:
+            return {key: tuple(totals) for key, totals in self._totals.items()}
+
+    def summary(self, n=20):
+        """Return a table of the n jobs that have moved the most data"""
+        totals = sorted(
+            self.totals().items(), key=lambda item: item[1][1] + item[1][2], reverse=True
+        )
+        lines = ['%-40s %8s %12s %12s %10s' % ('job', 'count', 'sent (kB)', 'received (kB)', 'time (ms)')]
+        for (device_name, worker_name, job), (count, sent, received, seconds) in totals[:n]:
+            name = '%s.%s.%s' % (device_name, worker_name, job)
+            lines.append(
+                '%-40s %8d %12.1f %12.1f %10.1f'
+                % (name, count, sent / 1e3, received / 1e3, seconds * 1e3)
+            )
+        return '\n'.join(lines)
+
+
+# Added to by all tabs:
+transfer_stats = TransferStats()
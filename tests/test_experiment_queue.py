@@ -0,0 +1,99 @@
+#####################################################################
+#                                                                   #
+# /tests/test_experiment_queue.py                                   #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+import os
+import logging
+import threading
+
+import pytest
+
+pytest.importorskip('qtutils')
+
+from blacs.experiment_queue import QueueManager
+from blacs.queue_journal import file_stat
+
+
+class RestoringQueueManager(object):
+    # The attributes of a QueueManager used to check the files restored to the queue
+    # from the journal, with validation of files recorded rather than done:
+    _check_restored_files = QueueManager._check_restored_files
+    _check_restored_file = QueueManager._check_restored_file
+
+    def __init__(self, restored_stats, valid=True):
+        self._restored_stats = dict(restored_stats)
+        self._restored_stats_lock = threading.Lock()
+        self._logger = logging.getLogger('BLACS.test')
+        self.valid = valid
+        self.validated = []
+
+    def _validate_request(self, h5_filepath, in_queue):
+        self.validated.append(h5_filepath)
+        if not self.valid:
+            return None, 'Invalid\n'
+        return h5_filepath.replace('.h5', '_rep00001.h5'), 'Copied\n'
+
+
+@pytest.fixture
+def shots(tmp_path):
+    # Files with stats recorded when they were validated, modified since, missing, and
+    # without a recorded stat:
+    paths = [str(tmp_path / ('%s.h5' % name)) for name in ['unchanged', 'modified', 'missing', 'unknown']]
+    for path in paths:
+        with open(path, 'wb') as f:
+            f.write(b'shot')
+    stats = {path: file_stat(path) for path in paths}
+    with open(paths[1], 'ab') as f:
+        f.write(b' modified')
+    os.unlink(paths[2])
+    stats[paths[3]] = None
+    return paths, stats
+
+
+def test_check_restored_files(shots):
+    paths, stats = shots
+    manager = RestoringQueueManager(stats)
+    manager._check_restored_files()
+    # Only unchanged files are trusted, the others are left to be validated:
+    assert set(manager._restored_stats) == set(paths[1:])
+    assert manager.validated == []
+
+
+def test_unchanged_file_run_without_validation(shots):
+    paths, stats = shots
+    manager = RestoringQueueManager(stats)
+    assert manager._check_restored_file(paths[0]) == paths[0]
+    assert manager.validated == []
+    assert paths[0] not in manager._restored_stats
+
+
+@pytest.mark.parametrize('index', [1, 2, 3])
+def test_changed_file_validated_before_run(shots, index):
+    paths, stats = shots
+    manager = RestoringQueueManager(stats)
+    assert manager._check_restored_file(paths[index]) == paths[index].replace('.h5', '_rep00001.h5')
+    assert manager.validated == [paths[index]]
+    # Not validated again:
+    assert manager._check_restored_file(paths[index]) == paths[index]
+    assert manager.validated == [paths[index]]
+
+
+def test_invalid_file_not_run(shots):
+    paths, stats = shots
+    manager = RestoringQueueManager(stats, valid=False)
+    assert manager._check_restored_file(paths[1]) is None
+
+
+def test_files_not_restored_run_without_validation(shots):
+    paths, stats = shots
+    manager = RestoringQueueManager({})
+    assert manager._check_restored_file(paths[1]) == paths[1]
+    assert manager.validated == []
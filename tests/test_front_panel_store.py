@@ -0,0 +1,177 @@
+#####################################################################
+#                                                                   #
+# /tests/test_front_panel_store.py                                  #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+import os
+
+import pytest
+
+pytest.importorskip('qtutils')
+# Imports h5py, which must not be imported before it:
+pytest.importorskip('labscript_utils.h5_lock')
+
+from blacs.front_panel_settings import (
+    FrontPanelStore,
+    build_front_panel_tables,
+    read_front_panel_tables,
+    front_panel_rows,
+)
+import h5py
+
+N_CHANNELS = 100
+
+
+def shot_tables(values=None, queue_data=None):
+    # The tables saved to a shot file for a device with N_CHANNELS analog outputs,
+    # with the given values by channel number:
+    values = values or {}
+    front_panel = {}
+    for i in range(N_CHANNELS):
+        front_panel['ao%d' % i] = {
+            'name': 'channel_%d' % i,
+            'base_value': float(values.get(i, 0)),
+            'locked': False,
+            'base_step_size': 0.1,
+            'current_units': 'V',
+        }
+    tab_data = {'device': {'front_panel': front_panel, 'save_data': {'mode': 'manual'}}}
+    notebook_data = {'device': {'notebook': '1', 'page': 0, 'visible': True}}
+    main_window = {
+        'width': 800,
+        'height': 600,
+        'xpos': 0,
+        'ypos': 0,
+        'maximized': False,
+        'frame_height': 0,
+        'frame_width': 0,
+        '_analysis': {},
+        '_queue': queue_data or {},
+    }
+    window_data = {'_main_window': main_window, 'pane': 100}
+    return build_front_panel_tables(tab_data, notebook_data, window_data, {}, shot_file=True)
+
+
+def store_shot(store, path, tables):
+    with h5py.File(path, 'w') as hdf5_file:
+        store.store_deduplicated(hdf5_file.create_group('front_panel'), *tables)
+
+
+def read_shot(path):
+    with h5py.File(path, 'r') as hdf5_file:
+        data_group = hdf5_file['front_panel']
+        attrs = dict(data_group.attrs)
+        datasets = set(data_group)
+        tables = read_front_panel_tables(data_group)
+    return tables, attrs, datasets
+
+
+def snapshots(store_path):
+    with h5py.File(store_path, 'r') as hdf5_file:
+        return set(hdf5_file['snapshots'])
+
+
+def assert_tables_equal(tables, expected):
+    front_panel_array, tab_array, attrs = tables
+    expected_front_panel_array, expected_tab_array, expected_attrs = expected
+    assert front_panel_rows(front_panel_array) == front_panel_rows(expected_front_panel_array)
+    assert tab_array.tolist() == expected_tab_array.tolist()
+    assert attrs == expected_attrs
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'front_panel_store.h5')
+
+
+def test_identical_front_panels_stored_once(tmp_path, store_path):
+    store = FrontPanelStore(store_path)
+    tables = shot_tables()
+    for i in range(3):
+        store_shot(store, str(tmp_path / ('shot_%d.h5' % i)), tables)
+    digest = FrontPanelStore.digest(*tables)
+    assert snapshots(store_path) == {digest}
+    for i in range(3):
+        shot_front_panel, attrs, datasets = read_shot(str(tmp_path / ('shot_%d.h5' % i)))
+        assert attrs['snapshot'] == digest
+        assert datasets == set()
+        assert_tables_equal(shot_front_panel, tables)
+    # Also stored once by a new store, without the most recent front panel in memory:
+    store = FrontPanelStore(store_path)
+    store_shot(store, str(tmp_path / 'shot_3.h5'), tables)
+    assert snapshots(store_path) == {digest}
+    assert_tables_equal(store.get(digest), tables)
+
+
+def test_few_changes_stored_in_shot(tmp_path, store_path):
+    store = FrontPanelStore(store_path)
+    base_tables = shot_tables()
+    store_shot(store, str(tmp_path / 'base.h5'), base_tables)
+    tables = shot_tables({3: 1.5, 7: -2})
+    store_shot(store, str(tmp_path / 'changed.h5'), tables)
+    assert snapshots(store_path) == {FrontPanelStore.digest(*base_tables)}
+    shot_front_panel, attrs, datasets = read_shot(str(tmp_path / 'changed.h5'))
+    assert attrs['snapshot'] == FrontPanelStore.digest(*base_tables)
+    assert datasets == {'front_panel_changes'}
+    assert_tables_equal(shot_front_panel, tables)
+
+
+@pytest.mark.parametrize(
+    'tables',
+    [
+        # More than MAX_CHANGED_FRACTION of the channels changed:
+        shot_tables({i: 1 for i in range(N_CHANNELS // 2)}),
+        # Anything other than channel values changed:
+        shot_tables(queue_data={'files_queued': ['shot.h5']}),
+    ],
+)
+def test_other_changes_stored_as_new_front_panel(tmp_path, store_path, tables):
+    store = FrontPanelStore(store_path)
+    store_shot(store, str(tmp_path / 'base.h5'), shot_tables())
+    store_shot(store, str(tmp_path / 'changed.h5'), tables)
+    digest = FrontPanelStore.digest(*tables)
+    assert digest in snapshots(store_path)
+    assert len(snapshots(store_path)) == 2
+    shot_front_panel, attrs, datasets = read_shot(str(tmp_path / 'changed.h5'))
+    assert attrs['snapshot'] == digest
+    assert datasets == set()
+    assert_tables_equal(shot_front_panel, tables)
+
+
+def test_rotation_at_max_bytes(tmp_path, store_path):
+    # Small enough that every new front panel fills a file:
+    store = FrontPanelStore(store_path, max_bytes=1)
+    all_tables = [shot_tables({j: i for j in range(N_CHANNELS)}) for i in range(3)]
+    for i, tables in enumerate(all_tables):
+        store_shot(store, str(tmp_path / ('shot_%d.h5' % i)), tables)
+    store_paths = [
+        store_path,
+        str(tmp_path / 'front_panel_store_1.h5'),
+        str(tmp_path / 'front_panel_store_2.h5'),
+    ]
+    for i, tables in enumerate(all_tables):
+        # Each front panel is in its own file, and shots refer to it there rather
+        # than to changes from a front panel in another file:
+        assert snapshots(store_paths[i]) == {FrontPanelStore.digest(*tables)}
+        shot_front_panel, attrs, datasets = read_shot(str(tmp_path / ('shot_%d.h5' % i)))
+        assert os.path.basename(attrs['snapshot_store']) == os.path.basename(store_paths[i])
+        assert datasets == set()
+        assert_tables_equal(shot_front_panel, tables)
+    # A new store carries on with the newest file:
+    store = FrontPanelStore(store_path, max_bytes=1)
+    assert store.path == store_paths[2]
+
+
+def test_no_rotation_below_max_bytes(tmp_path, store_path):
+    store = FrontPanelStore(store_path, max_bytes=int(100e6))
+    for i in range(3):
+        store_shot(store, str(tmp_path / ('shot_%d.h5' % i)), shot_tables({j: i for j in range(N_CHANNELS)}))
+    assert len(snapshots(store_path)) == 3
+    assert not os.path.exists(str(tmp_path / 'front_panel_store_1.h5'))
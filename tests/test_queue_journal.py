@@ -0,0 +1,219 @@
+#####################################################################
+#                                                                   #
+# /tests/test_queue_journal.py                                      #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+import json
+import time
+
+import pytest
+
+from blacs.queue_journal import QueueJournal, apply_record, file_stat
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = QueueJournal(str(tmp_path / 'queue_journal.jsonl'))
+    # Without the sync thread, so that the journal is only compacted when a test
+    # compacts it:
+    journal._sync_loop = lambda: None
+    yield journal
+    journal.close()
+
+
+def read_lines(journal):
+    with open(journal.path, encoding='utf8') as f:
+        return [json.loads(line) for line in f]
+
+
+RECORDS = [
+    ('append', ['a.h5', 'b.h5', 'c.h5'], [[1, 10], [2, 20], None]),
+    ('prepend', 'd.h5', [4, 40]),
+    ('move', 0, 2, 4),
+    ('pop',),
+    ('append', ['e.h5', 'f.h5'], [None, None]),
+    ('remove', 1, 1),
+    ('remove_rows', [0, 2]),
+    ('move', 1, 1, 0),
+]
+
+
+def test_apply_records():
+    paths = ['x.h5']
+    stats = {}
+    expected = [
+        ['x.h5', 'a.h5', 'b.h5', 'c.h5'],
+        ['d.h5', 'x.h5', 'a.h5', 'b.h5', 'c.h5'],
+        ['a.h5', 'b.h5', 'd.h5', 'x.h5', 'c.h5'],
+        ['b.h5', 'd.h5', 'x.h5', 'c.h5'],
+        ['b.h5', 'd.h5', 'x.h5', 'c.h5', 'e.h5', 'f.h5'],
+        ['b.h5', 'x.h5', 'c.h5', 'e.h5', 'f.h5'],
+        ['x.h5', 'e.h5', 'f.h5'],
+        ['e.h5', 'x.h5', 'f.h5'],
+    ]
+    for record, expected_paths in zip(RECORDS, expected):
+        apply_record(paths, stats, record)
+        assert paths == expected_paths
+    apply_record(paths, stats, ('clear',))
+    assert paths == []
+
+
+def test_malformed_record_not_applied():
+    paths = ['a.h5', 'b.h5']
+    stats = {}
+    for record in [('move', 0, 1), ('prepend', 'c.h5'), ('unknown', 1)]:
+        with pytest.raises(Exception):
+            apply_record(paths, stats, record)
+        assert paths == ['a.h5', 'b.h5']
+
+
+def test_replay_without_journal(journal):
+    assert journal.replay() == (None, None)
+
+
+def test_replay(journal):
+    journal.open(['x.h5'], {'x.h5': [3, 30]})
+    paths = ['x.h5']
+    stats = {'x.h5': [3, 30]}
+    for record in RECORDS:
+        journal.record(*record)
+        apply_record(paths, stats, record)
+    journal.close()
+    assert journal.replay() == (paths, stats)
+
+
+def test_replay_stops_at_truncated_record(journal):
+    journal.open(['x.h5'])
+    journal.record('append', ['a.h5', 'b.h5'], [None, None])
+    journal.close()
+    with open(journal.path, 'a', encoding='utf8') as f:
+        # As if BLACS crashed whilst writing a record:
+        f.write('["append", ["c.h')
+    paths, _ = journal.replay()
+    assert paths == ['x.h5', 'a.h5', 'b.h5']
+
+
+@pytest.mark.parametrize(
+    'bad_line',
+    [
+        'not json',
+        '["remove_rows"]',
+        '["move", 0, 1]',
+        '["unknown"]',
+        '{"op": "pop"}',
+    ],
+)
+def test_replay_stops_at_corrupt_record(journal, bad_line):
+    journal.open(['x.h5'])
+    journal.record('append', ['a.h5', 'b.h5'], [None, None])
+    journal.close()
+    with open(journal.path, 'a', encoding='utf8') as f:
+        f.write(bad_line + '\n')
+        # Records after a bad one are not trusted:
+        f.write(json.dumps(['pop']) + '\n')
+    paths, _ = journal.replay()
+    assert paths == ['x.h5', 'a.h5', 'b.h5']
+
+
+def test_open_replaces_journal_with_snapshot(journal):
+    journal.open(['x.h5'])
+    journal.record('append', ['a.h5'], [None])
+    journal.open(['y.h5'], {'y.h5': [1, 2]})
+    assert read_lines(journal) == [['snapshot', ['y.h5'], [[1, 2]]]]
+    journal.record('pop')
+    journal.close()
+    assert journal.replay() == ([], {'y.h5': [1, 2]})
+
+
+def test_records_after_close_ignored(journal):
+    journal.open(['x.h5'])
+    journal.close()
+    journal.record('pop')
+    assert journal.replay()[0] == ['x.h5']
+
+
+def test_compaction(journal):
+    journal.COMPACT_AFTER = 5
+    journal.open(['x.h5'])
+    paths = ['x.h5']
+    stats = {'x.h5': None}
+    for i in range(4):
+        record = ('append', ['%d.h5' % i], [[i, i]])
+        journal.record(*record)
+        apply_record(paths, stats, record)
+    assert not journal._compact_requested
+    journal.record('pop')
+    apply_record(paths, stats, ('pop',))
+    assert journal._compact_requested
+    journal._compact()
+    assert read_lines(journal) == [['snapshot', paths, [stats[path] for path in paths]]]
+    # Recording carries on after the snapshot:
+    journal.record('remove', 0, 1)
+    apply_record(paths, stats, ('remove', 0, 1))
+    assert len(read_lines(journal)) == 2
+    journal.close()
+    replayed_paths, _ = journal.replay()
+    assert replayed_paths == paths
+
+
+def test_records_written_during_compaction_kept(journal, monkeypatch):
+    journal.open(['x.h5'])
+    journal.record('append', ['a.h5'], [None])
+    write_snapshot = journal._write_snapshot
+
+    def write_snapshot_whilst_recording(paths, stats):
+        # Changes made to the queue whilst the snapshot is written outside the lock:
+        journal.record('append', ['b.h5'], [None])
+        journal.record('remove', 0, 1)
+        return write_snapshot(paths, stats)
+
+    monkeypatch.setattr(journal, '_write_snapshot', write_snapshot_whilst_recording)
+    journal._compact()
+    lines = read_lines(journal)
+    assert lines[0] == ['snapshot', ['x.h5', 'a.h5'], [None, None]]
+    assert len(lines) == 3
+    journal.close()
+    assert journal.replay()[0] == ['a.h5', 'b.h5']
+
+
+def test_compaction_by_sync_thread(tmp_path):
+    journal = QueueJournal(str(tmp_path / 'queue_journal.jsonl'))
+    journal.COMPACT_AFTER = 3
+    journal.SYNC_INTERVAL = 0.01
+    journal.open([])
+    try:
+        for i in range(3):
+            journal.record('append', ['%d.h5' % i], [None])
+        # The sync thread compacts the journal once it wakes up:
+        for _ in range(500):
+            if len(read_lines(journal)) == 1:
+                break
+            time.sleep(0.01)
+        assert read_lines(journal) == [['snapshot', ['0.h5', '1.h5', '2.h5'], [None, None, None]]]
+    finally:
+        journal.close()
+
+
+def test_stats_replayed(journal, tmp_path):
+    path = tmp_path / 'shot.h5'
+    path.write_bytes(b'shot')
+    stat = file_stat(str(path))
+    journal.open(['x.h5'], {'x.h5': [1, 2], 'removed.h5': [3, 4]})
+    journal.record('append', [str(path), 'a.h5'], [stat, None])
+    journal.record('prepend', 'b.h5', [5, 6])
+    journal.record('remove', 0, 1)
+    journal._compact()
+    journal.close()
+    paths, stats = journal.replay()
+    assert paths == ['x.h5', str(path), 'a.h5']
+    # Stats of files not in the queue are forgotten:
+    assert stats == {'x.h5': [1, 2], str(path): stat, 'a.h5': None}
+    path.write_bytes(b'modified shot')
+    assert file_stat(str(path)) != stat
@@ -0,0 +1,108 @@
+#####################################################################
+#                                                                   #
+# /tests/test_saved_data.py                                         #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+import numpy
+import pytest
+
+from blacs import saved_data
+
+
+def assert_same(restored, original):
+    # Equal, and of the same types all the way down:
+    assert type(restored) is type(original)
+    if isinstance(original, numpy.ndarray):
+        assert restored.dtype == original.dtype
+        assert restored.shape == original.shape
+        assert restored.tolist() == original.tolist()
+    elif isinstance(original, dict):
+        assert list(restored) == list(original)
+        for key in original:
+            assert_same(restored[key], original[key])
+    elif isinstance(original, (list, tuple)):
+        assert len(restored) == len(original)
+        for item, original_item in zip(restored, original):
+            assert_same(item, original_item)
+    else:
+        assert restored == original
+
+
+@pytest.mark.parametrize(
+    'obj',
+    [
+        None,
+        {},
+        ['C:\\Experiments\\shot_%d.h5' % i for i in range(1000)],
+        {'text': 'μs', 'int': 1, 'float': 0.5, 'bool': True, 'none': None},
+        {'tuple': (1, (2, 3)), 'list_of_tuples': [(1, 'a'), (2, 'b')]},
+        {'set': {1, 2, 3}, 'bytes': b'\x00\xff'},
+        {1: 'one', (2, 3): 'tuple key', None: 'none key'},
+        # Dictionaries whose keys look like the tags saved_data uses:
+        {'__tuple__': [1, 2]},
+        {'__repr__': 'not a repr'},
+        {'array': numpy.arange(12, dtype=numpy.float32).reshape(3, 4)},
+        {'structured': numpy.array([(b'a', 1.5), (b'bc', 2.5)], dtype=[('name', 'S2'), ('value', float)])},
+        {'objects': numpy.array([1, 'a', None], dtype=object)},
+        {'nested': {'queue': [['shot.h5', {'repeat': (1, 2)}]], 'empty': ((), [], {})}},
+    ],
+)
+def test_round_trip(obj):
+    s = saved_data.dumps(obj)
+    assert s.startswith(saved_data.FORMAT_PREFIX)
+    assert_same(saved_data.loads(s), obj)
+    assert_same(saved_data.loads(s.encode('utf8')), obj)
+
+
+def test_numpy_scalars_restored_as_python_types():
+    obj = {'float': numpy.float64(0.25), 'int': numpy.int32(3), 'bool': numpy.bool_(True)}
+    assert_same(saved_data.loads(saved_data.dumps(obj)), {'float': 0.25, 'int': 3, 'bool': True})
+
+
+def test_unknown_objects_saved_as_repr():
+    class Literal(object):
+        def __repr__(self):
+            return "('restored', 1)"
+
+    class NotLiteral(object):
+        def __repr__(self):
+            return '<not a literal>'
+
+    restored = saved_data.loads(saved_data.dumps({'literal': Literal(), 'other': NotLiteral()}))
+    assert restored == {'literal': ('restored', 1), 'other': None}
+
+
+@pytest.mark.parametrize(
+    'obj',
+    [
+        {'queue': ['shot_0.h5', 'shot_1.h5'], 'repeat': 2, 'paused': False},
+        {'ip': '127.0.0.1', 'ports': (42517, 42518), 'options': {1: None}},
+        [1.5, -2, {'nested': [(), set()]}],
+    ],
+)
+def test_legacy_repr_read_as_literal(obj):
+    assert_same(saved_data.loads(repr(obj)), obj)
+    assert_same(saved_data.loads(repr(obj).encode('utf8')), obj)
+
+
+def test_legacy_repr_of_numpy_arrays_evaluated():
+    obj = {'array': numpy.array([1.0, numpy.nan, numpy.inf])}
+    restored = saved_data.loads(repr(obj))
+    numpy.testing.assert_array_equal(restored['array'], obj['array'])
+
+
+def test_legacy_repr_of_unknown_objects_raises():
+    with pytest.raises(NameError):
+        saved_data.loads("{'widget': QWidget()}")
+
+
+def test_newer_format_rejected():
+    with pytest.raises(ValueError):
+        saved_data.loads('blacs-json-%d:{}' % (saved_data.FORMAT_VERSION + 1))
@@ -0,0 +1,171 @@
+#####################################################################
+#                                                                   #
+# /tests/test_state_queue.py                                        #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+import random
+import threading
+from bisect import insort
+from itertools import count
+
+import pytest
+
+from blacs.state_queue import StateQueue
+
+MODE_MANUAL = 1
+MODE_TRANSITION_TO_BUFFERED = 2
+MODE_TRANSITION_TO_MANUAL = 4
+MODE_BUFFERED = 8
+MODES = [MODE_MANUAL, MODE_TRANSITION_TO_BUFFERED, MODE_TRANSITION_TO_MANUAL, MODE_BUFFERED]
+ALL_MODES = MODE_MANUAL | MODE_TRANSITION_TO_BUFFERED | MODE_TRANSITION_TO_MANUAL | MODE_BUFFERED
+
+
+class ListStateQueue(object):
+    # The previous StateQueue, a list sorted by priority and then order added, scanned
+    # from the start for each get:
+    def __init__(self):
+        self.list_of_states = []
+        self._ids = count(1)
+
+    def put(self, allowed_states, queue_state_indefinitely, delete_stale_states, data, priority=0):
+        state_data = [priority, next(self._ids), allowed_states, queue_state_indefinitely, delete_stale_states, data]
+        insort(self.list_of_states, state_data)
+
+    def check_for_next_item(self, state):
+        delete_index_list = []
+        success = False
+        for i, item in enumerate(self.list_of_states):
+            priority, unique_id, allowed_states, queue_state_indefinitely, delete_stale_states, data = item
+            if allowed_states & state:
+                delete_index_list.append(i)
+                if delete_stale_states:
+                    state_function = data[0]
+                    i += 1
+                    while i < len(self.list_of_states) and state_function == self.list_of_states[i][5][0]:
+                        priority, unique_id, allowed_states, queue_state_indefinitely, delete_stale_states, data = self.list_of_states[i]
+                        delete_index_list.append(i)
+                        i += 1
+                success = True
+                break
+            elif not queue_state_indefinitely:
+                delete_index_list.append(i)
+        for index in reversed(sorted(delete_index_list)):
+            del self.list_of_states[index]
+        return data if success else None
+
+
+def get(queue, mode):
+    # The next state allowed in the given mode, or None, without blocking:
+    with queue._lock:
+        return queue.check_for_next_item(mode)
+
+
+def check_same_as_list(operations):
+    # Check that StateQueue returns the same states as the previous implementation, and
+    # is left with the same states after each operation:
+    reference = ListStateQueue()
+    queue = StateQueue('test')
+    for operation in operations:
+        if operation[0] == 'put':
+            reference.put(*operation[1:])
+            queue.put(*operation[1:])
+        else:
+            assert get(queue, operation[1]) == reference.check_for_next_item(operation[1])
+        assert queue.list_of_states == reference.list_of_states
+
+
+def put(allowed_states, function, i, queue_state_indefinitely=True, delete_stale_states=False, priority=0):
+    return ('put', allowed_states, queue_state_indefinitely, delete_stale_states, [function, [(i,), {}]], priority)
+
+
+def test_priority():
+    check_same_as_list(
+        [
+            put(MODE_MANUAL, 'program_device', 0),
+            put(MODE_MANUAL, 'update_status', 1, priority=1),
+            put(MODE_MANUAL, 'initialise', 2, priority=-1),
+            put(MODE_MANUAL, 'program_device', 3),
+            put(MODE_MANUAL, 'quit', 4, priority=-1),
+        ]
+        + [('get', MODE_MANUAL)] * 6
+    )
+
+
+def test_delete_stale_states():
+    check_same_as_list(
+        [
+            put(MODE_MANUAL, 'program_device', 0, delete_stale_states=True),
+            put(MODE_MANUAL, 'program_device', 1, delete_stale_states=True),
+            put(MODE_BUFFERED, 'program_device', 2),
+            put(MODE_MANUAL, 'check_remote_values', 3),
+            put(MODE_MANUAL, 'program_device', 4, delete_stale_states=True),
+            # Stale states of the next priority follow those of the last priority:
+            put(MODE_MANUAL, 'program_device', 5, delete_stale_states=True, priority=-1),
+            put(MODE_MANUAL, 'check_remote_values', 6),
+            put(MODE_MANUAL, 'program_device', 7, delete_stale_states=True, priority=1),
+        ]
+        + [('get', MODE_MANUAL)] * 6
+        + [('get', MODE_BUFFERED)] * 2
+    )
+
+
+def test_transient_states():
+    check_same_as_list(
+        [
+            put(MODE_BUFFERED, 'update_status', 0, queue_state_indefinitely=False),
+            put(MODE_BUFFERED, 'update_status', 1),
+            put(MODE_MANUAL | MODE_BUFFERED, 'check_remote_values', 2, queue_state_indefinitely=False),
+            put(MODE_BUFFERED, 'update_status', 3, queue_state_indefinitely=False),
+            put(MODE_MANUAL, 'program_device', 4),
+            put(MODE_BUFFERED, 'update_status', 5, queue_state_indefinitely=False, priority=1),
+            # Transient states are deleted even if there is no state allowed:
+            ('get', MODE_TRANSITION_TO_MANUAL),
+            ('get', MODE_MANUAL),
+            ('get', MODE_MANUAL),
+            ('get', MODE_BUFFERED),
+            ('get', MODE_BUFFERED),
+        ]
+    )
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_operations(seed):
+    rng = random.Random(seed)
+    operations = []
+    for i in range(500):
+        if rng.random() < 0.6:
+            operations.append(
+                put(
+                    rng.choice([MODE_MANUAL, MODE_BUFFERED, MODE_MANUAL | MODE_BUFFERED, ALL_MODES]),
+                    rng.choice(['program_device', 'check_remote_values', 'update_status']),
+                    i,
+                    queue_state_indefinitely=rng.random() < 0.7,
+                    delete_stale_states=rng.random() < 0.5,
+                    priority=rng.choice([0, 0, 0, -1, 1]),
+                )
+            )
+        else:
+            operations.append(('get', rng.choice(MODES)))
+    operations += [('get', mode) for mode in MODES for _ in range(500)]
+    check_same_as_list(operations)
+
+
+def test_get_waits_for_start_and_allowed_state():
+    queue = StateQueue('test')
+    queue.put(MODE_BUFFERED, True, False, ['update_status', [(), {}]])
+    results = []
+    thread = threading.Thread(target=lambda: results.append(queue.get(MODE_MANUAL)))
+    thread.start()
+    queue.put(MODE_MANUAL, True, False, ['program_device', [(), {}]])
+    thread.join(0.1)
+    assert thread.is_alive()
+    queue.start()
+    thread.join(5)
+    assert results == [['program_device', [(), {}]]]